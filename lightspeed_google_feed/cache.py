@@ -1,30 +1,183 @@
 import time as system_time
 import logging
+import threading
+import weakref
+from collections import OrderedDict
+
+class _Computation:
+    ''' A value being computed by one caller, which other callers for the same key wait on '''
 
-class SimpleCache:
-    
     def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+class LRUCache:
+    ''' Thread-safe in-memory cache with a per-key expiration time and a maximum number of entries (least recently used are evicted first) '''
+
+    def __init__(self, max_entries=256, sweep_interval=60):
         self.logger = logging.getLogger(__name__)
-        self.cache = {}
-        self.cache_expiration = {}
-
-    def set(self, key, value, time=3600):
-        self.logger.info(f"Set cache: key: {key} | value: {value.__class__.__name__} | time: {time}")
-        self.cache[key] = value
-        self.cache_expiration[key] = system_time.time() + time
-        
+        self.max_entries = max_entries
+        # key -> (value, expiration timestamp, keep-as-stale-until timestamp), least recently used first
+        self.cache = OrderedDict()
+        self.lock = threading.RLock()
+        # key -> _Computation in progress (see get_or_compute)
+        self.computations = {}
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'stale_hits': 0,
+            'coalesced': 0,
+            'evictions': 0,
+            'expirations': 0
+        }
+        if sweep_interval:
+            CacheSweeper.register(self, sweep_interval)
+
+    def set(self, key, value, time=3600, stale_time=0):
+        ''' Caches value for `time` seconds, then keeps it for `stale_time` more seconds for get_or_compute(serve_stale=True) '''
+        with self.lock:
+            expires_at = system_time.time() + time
+            self.cache[key] = (value, expires_at, expires_at + stale_time)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_entries:
+                evicted_key, _ = self.cache.popitem(last=False)
+                self.stats['evictions'] += 1
+                self.logger.debug(f"Cache EVICTED key: {evicted_key}")
+
     def get(self, key):
-        if key in self.cache_expiration and system_time.time() > self.cache_expiration[key]:
-            self.logger.info(f"Cache EXPIRED for key: {key}")
-            del self.cache[key]
-            del self.cache_expiration[key]
-            return None
-        
-        value = self.cache.get(key)
-
-        if value is None:
-            self.logger.info(f"Cache MISS for key: {key}")
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+
+            value, expires_at, stale_until = entry
+            now = system_time.time()
+            if now > expires_at:
+                if now > stale_until:
+                    del self.cache[key]
+                    self.stats['expirations'] += 1
+                self.stats['misses'] += 1
+                return None
+
+            self.cache.move_to_end(key)
+            self.stats['hits'] += 1
+            return value
+
+    def get_or_compute(self, key, compute, time=3600, serve_stale=False, stale_time=0):
+        ''' Returns the cached value or computes it with compute(), once: concurrent callers for the same key wait for the same computation.
+
+        With serve_stale=True, an expired value (kept for stale_time seconds) is returned right away
+        while a background thread computes the new one.
+        '''
+        with self.lock:
+            now = system_time.time()
+            entry = self.cache.get(key)
+            if entry is not None and now <= entry[1]:
+                self.cache.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[0]
+
+            stale = serve_stale and entry is not None and now <= entry[2]
+            computation = self.computations.get(key)
+            is_owner = computation is None
+            if is_owner:
+                computation = _Computation()
+                self.computations[key] = computation
+
+            if stale:
+                self.stats['stale_hits'] += 1
+            elif is_owner:
+                self.stats['misses'] += 1
+            else:
+                self.stats['coalesced'] += 1
+
+        if stale:
+            if is_owner:
+                threading.Thread(target=self._compute, args=(key, computation, compute, time, stale_time), name=f"cache-refresh-{key}", daemon=True).start()
+            return entry[0]
+
+        if is_owner:
+            self._compute(key, computation, compute, time, stale_time)
         else:
-            self.logger.info(f"Cache HIT for key: {key}")
+            computation.done.wait()
+
+        if computation.error is not None:
+            raise computation.error
+        return computation.value
+
+    def _compute(self, key, computation, compute, time, stale_time):
+        try:
+            computation.value = compute()
+            self.set(key, computation.value, time=time, stale_time=stale_time)
+        except BaseException as e:
+            computation.error = e
+            self.logger.error(f"Error computing cache value for key {key}: {e}")
+        finally:
+            with self.lock:
+                self.computations.pop(key, None)
+            computation.done.set()
+
+    def delete(self, key):
+        with self.lock:
+            self.cache.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def sweep(self):
+        ''' Removes all expired entries (also done periodically in the background) '''
+        now = system_time.time()
+        with self.lock:
+            expired_keys = [key for key, (value, expires_at, stale_until) in self.cache.items() if now > stale_until]
+            for key in expired_keys:
+                del self.cache[key]
+            self.stats['expirations'] += len(expired_keys)
+        return len(expired_keys)
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, entries=len(self.cache))
+
+    def __len__(self):
+        with self.lock:
+            return len(self.cache)
+
+# kept for backwards compatibility
+SimpleCache = LRUCache
+
+class CacheSweeper:
+    ''' A single background thread that periodically sweeps expired entries from all caches '''
+
+    lock = threading.Lock()
+    caches = weakref.WeakKeyDictionary()
+    thread = None
+
+    @classmethod
+    def register(cls, cache, interval):
+        with cls.lock:
+            # caches are only weakly referenced, so the sweeper doesn't keep them alive
+            cls.caches[cache] = [interval, system_time.time() + interval]
+            if cls.thread is None or not cls.thread.is_alive():
+                cls.thread = threading.Thread(target=cls._run, name="cache-sweeper", daemon=True)
+                cls.thread.start()
 
-        return value
\ No newline at end of file
+    @classmethod
+    def _run(cls):
+        while True:
+            system_time.sleep(1)
+            now = system_time.time()
+            with cls.lock:
+                due = []
+                for cache, schedule in list(cls.caches.items()):
+                    if now >= schedule[1]:
+                        schedule[1] = now + schedule[0]
+                        due.append(cache)
+            for cache in due:
+                try:
+                    cache.sweep()
+                except Exception as e:
+                    cache.logger.error(f"Error sweeping cache: {e}")
+            del due
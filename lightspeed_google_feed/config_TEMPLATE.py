@@ -12,8 +12,44 @@ ECWID_BASE_URL = "https://app.ecwid.com/api/v3/YOUR_ECWID_STORE_ID"
 ECWID_API_KEY = "your_ecwid_api_key_here"
 ECWID_API_SECRET = "your_ecwid_api_secret_here"
 
+# Number of catalog pages fetched concurrently from the API (1 = one page at a time)
+FETCH_WORKERS = 8
+# Number of retries for a page request that was throttled (HTTP 429) or failed
+FETCH_MAX_RETRIES = 5
+# Timeout (in seconds) for each API request
+FETCH_TIMEOUT = 60
+# Only download products updated since the last refresh, with a full catalog download every FULL_SYNC_INTERVAL seconds
+DELTA_SYNC = True
+FULL_SYNC_INTERVAL = 24 * 3600
+# Keep a snapshot of the catalog in storage, used by new instances and when the API is down
+CATALOG_SNAPSHOT = True
+
+# How feeds are rendered: 'jinja' (from the templates) or 'xml' (written by code, faster, same elements as the templates)
+FEED_ENGINE = 'jinja'
+# Keep rendered feed items between refreshes (in memory and in storage), so only new or changed items are rendered again
+FRAGMENT_CACHE = True
+# Directory where compiled templates are cached (must be writable; App Engine only allows /tmp)
+#TEMPLATE_CACHE_DIR = '/tmp/lightspeed_google_feed_templates'
+
 # Google Cloud Storage config
 CLOUD_STORAGE_BUCKET_NAME = 'your_bucket_name_here'
+# Upload feed files (and their compressed variants) concurrently in background threads
+BACKGROUND_UPLOADS = True
+# Also write gzip (and brotli, if installed) compressed feeds, served to clients that accept them
+FEED_COMPRESSION = True
+# Feeds are served from memory; seconds between checks for a new version of a feed in storage
+FEED_CACHE_CHECK_INTERVAL = 30
+# When running locally, send feeds straight from disk (supports Range requests)
+LOCAL_ZERO_COPY = True
+# Seconds after which the lease of a refresh (one at a time across instances) is considered abandoned and taken over,
+# unless the refresh renewed it (every third of that)
+REFRESH_LEASE_TTL = 3600
+# After a delta catalog sync, feeds are patched in place (see GMCFeedGenerator.patch_feed_files) if at most this share of their items changed
+PATCH_MAX_CHANGES = 0.1
+# Number of feed generations kept in storage, to roll back to (see /feed_generations and /rollback_feeds)
+FEED_GENERATIONS_KEPT = 5
+# Token required (in the X-Admin-Token header) by admin endpoints such as /rollback_feeds on App Engine
+ADMIN_TOKEN = None
 
 # Shop info (for RSS feed metadata)
 SHOP = {
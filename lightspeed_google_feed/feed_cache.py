@@ -0,0 +1,162 @@
+import os
+import time as system_time
+import hashlib
+import logging
+import threading
+from datetime import datetime, timezone
+from . import config
+
+# seconds between checks for a new version of a feed in storage (metadata only, no download)
+FEED_CACHE_CHECK_INTERVAL = getattr(config, 'FEED_CACHE_CHECK_INTERVAL', 30)
+# in local mode, send feeds straight from disk instead of keeping them in memory
+LOCAL_ZERO_COPY = getattr(config, 'LOCAL_ZERO_COPY', True)
+HASH_CHUNK_SIZE = 1024 * 1024
+
+class CachedFeed:
+    ''' Content (bytes) of a feed file, as last downloaded from storage, with what's needed to answer conditional requests.
+
+    Feeds served from a local file have a path instead of content.
+    '''
+
+    def __init__(self, content, version, modified_at=None, path=None, etag=None):
+        self.content = content
+        self.path = path
+        self.version = version
+        # strong validator: hash of the content, computed once per version (not per request)
+        self.etag = etag if etag is not None else hashlib.sha256(content).hexdigest()
+        self.modified_at = modified_at
+        self.checked_at = system_time.time()
+
+class FeedServingCache:
+    ''' Keeps the latest content of each feed in memory, so serving a feed doesn't download it from storage every time.
+
+    At most every check_interval seconds, the version of the file in storage (the object generation in
+    Google Cloud Storage) is looked up, and the feed is only downloaded again if it changed.
+    '''
+
+    def __init__(self, storage, check_interval=None, zero_copy=None):
+        self.logger = logging.getLogger(__name__)
+        self.storage = storage
+        self.check_interval = FEED_CACHE_CHECK_INTERVAL if check_interval is None else check_interval
+        # local files are sent from disk (only their validators are kept in memory)
+        self.zero_copy = (LOCAL_ZERO_COPY and not storage.cloud) if zero_copy is None else zero_copy
+        self.feeds = {}
+        self.lock = threading.Lock()
+        # one lock per file, so concurrent requests wait for a single check/download
+        self.file_locks = {}
+        self.stats = {
+            'hits': 0,
+            'checks': 0,
+            'downloads': 0
+        }
+
+    def get(self, filename):
+        ''' Returns the CachedFeed for a file, or None if it doesn't exist '''
+        feed = self._get_fresh(filename)
+        if feed is not None:
+            return feed
+
+        with self._file_lock(filename):
+            # another request may have just checked it
+            feed = self._get_fresh(filename)
+            if feed is not None:
+                return feed
+            return self._refresh(filename)
+
+    def invalidate(self, filename=None):
+        ''' Forgets a file (or all of them), e.g. after it was replaced by this instance '''
+        with self.lock:
+            if filename is None:
+                self.feeds.clear()
+            else:
+                self.feeds.pop(filename, None)
+
+    def retain(self, filenames):
+        ''' Forgets every file but the given ones, e.g. those of an old feed generation, which are never served again '''
+        filenames = set(filenames)
+        with self.lock:
+            for filename in [filename for filename in self.feeds if filename not in filenames]:
+                del self.feeds[filename]
+            for filename in [filename for filename in self.file_locks if filename not in filenames]:
+                del self.file_locks[filename]
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, feeds=len(self.feeds))
+
+    def _get_fresh(self, filename):
+        with self.lock:
+            feed = self.feeds.get(filename)
+            if feed is not None and system_time.time() - feed.checked_at < self.check_interval:
+                self.stats['hits'] += 1
+                return feed
+        return None
+
+    def _file_lock(self, filename):
+        with self.lock:
+            return self.file_locks.setdefault(filename, threading.Lock())
+
+    def _refresh(self, filename):
+        with self.lock:
+            feed = self.feeds.get(filename)
+
+        if self.zero_copy:
+            return self._refresh_local_file(filename, feed)
+
+        if feed is not None:
+            try:
+                with self.lock:
+                    self.stats['checks'] += 1
+                version = self.storage.get_version(filename)
+            except Exception as e:
+                # storage is unavailable: keep serving what we have and check again later
+                self.logger.error(f"Error checking version of [{filename}], serving cached feed: {e}")
+                feed.checked_at = system_time.time()
+                return feed
+            if version is not None and version == feed.version:
+                feed.checked_at = system_time.time()
+                return feed
+
+        try:
+            content, version, modified_at = self.storage.read_versioned(filename)
+        except Exception as e:
+            if feed is None:
+                raise
+            self.logger.error(f"Error downloading [{filename}], serving cached feed: {e}")
+            feed.checked_at = system_time.time()
+            return feed
+        with self.lock:
+            self.stats['downloads'] += 1
+            if content is None:
+                self.feeds.pop(filename, None)
+                return None
+            feed = CachedFeed(content, version, modified_at)
+            self.feeds[filename] = feed
+        self.logger.info(f"Feed [{filename}] loaded into the serving cache: {len(content)} bytes, version {version}")
+        return feed
+
+    def _refresh_local_file(self, filename, feed):
+        with self.lock:
+            self.stats['checks'] += 1
+        path = self.storage.get_local_path(filename)
+        try:
+            with open(path, 'rb') as f:
+                # version of the file that was opened, even if it's replaced while being hashed
+                stat = os.fstat(f.fileno())
+                version = (stat.st_mtime_ns, stat.st_size)
+                if feed is not None and version == feed.version:
+                    feed.checked_at = system_time.time()
+                    return feed
+                digest = hashlib.sha256()
+                for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+        except FileNotFoundError:
+            with self.lock:
+                self.feeds.pop(filename, None)
+            return None
+
+        feed = CachedFeed(None, version, datetime.fromtimestamp(stat.st_mtime, timezone.utc), path=path, etag=digest.hexdigest())
+        with self.lock:
+            self.feeds[filename] = feed
+        self.logger.info(f"Feed [{filename}] will be served from disk: {stat.st_size} bytes, version {version}")
+        return feed
@@ -0,0 +1,35 @@
+import functools
+from decimal import Decimal
+
+# Formatting of values into what GMC expects, used to normalise the feed items once (see GMCFeedTemplateData)
+# and by the template filters (see TemplateEngine)
+
+CENTS = Decimal('0.01')
+
+def cdata(value):
+    if not value:
+        return value
+    return f"<![CDATA[ {value} ]]>"
+
+@functools.lru_cache(maxsize=8192)
+def money(value):
+    ''' Price as a decimal string with at least 2 decimal places (e.g. "$1,299.5" -> "1299.50"), without float rounding '''
+    amount = Decimal(str(value).replace('$', '').replace(',', ''))
+    if amount.as_tuple().exponent > -2:
+        amount = amount.quantize(CENTS)
+    return format(amount, 'f')
+
+def absolute_url(value, domain):
+    ''' https URL, with the shop domain added to relative URLs '''
+    if value:
+        value = value.replace('http://', 'https://')
+        if not value.startswith(domain) and not value.startswith(domain.replace('://www.', '://')):
+            value = f"{domain}{value}"
+    return value
+
+@functools.lru_cache(maxsize=8192)
+def image_url(value):
+    ''' URL of the full size image (Lightspeed "file.jpg" URLs point to the uploaded file) '''
+    if value:
+        value = value.replace('/file.jpg', '/image.jpg')
+    return value
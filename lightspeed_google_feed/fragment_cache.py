@@ -0,0 +1,99 @@
+import io
+import os
+import gzip
+import json
+import hashlib
+import logging
+import time as system_time
+
+def fingerprint(item):
+    ''' Digest of an item's template data: items with the same fingerprint render to the same fragment.
+
+    Items are plain data (dicts, lists, strings, numbers) always built with their keys in the same order,
+    so their repr is stable (and much faster than serializing them to JSON).
+    '''
+    return hashlib.blake2b(repr(item).encode('utf-8'), digest_size=16).hexdigest()
+
+class FragmentCache:
+    ''' Rendered item fragments (the "item" block of a feed template), kept between refreshes so that only new
+    or changed items are rendered again (see TemplateEngine.render_feeds).
+
+    Fragments are keyed by the item's fingerprint and only valid for the template hash they were rendered with
+    (the template source and shop info), so editing a template invalidates them. They're kept in memory and,
+    if a storage is given, persisted per template (a one-line header followed by gzip-compressed JSON, like
+    CatalogSnapshotStore) so new instances start with them.
+    '''
+
+    MAGIC = b"LSGF-FRAGMENT-CACHE"
+    VERSION = 1
+
+    def __init__(self, storage=None):
+        self.logger = logging.getLogger(__name__)
+        self.storage = storage
+        # template name -> (template hash, {fingerprint: fragment})
+        self.templates = {}
+        self.stats = {
+            'rendered': 0,
+            'reused': 0
+        }
+
+    def get_filename(self, template_name):
+        return f"fragment_cache_{os.path.splitext(os.path.basename(template_name))[0]}.json.gz"
+
+    def get_fragments(self, template_name, template_hash):
+        ''' Fragments rendered with the given template hash by the last refresh ({fingerprint: fragment}, maybe empty) '''
+        cached = self.templates.get(template_name)
+        if cached is None and self.storage is not None:
+            cached = self._load(template_name)
+        if cached is None or cached[0] != template_hash:
+            return {}
+        return cached[1]
+
+    def update(self, template_name, template_hash, fragments, rendered=0):
+        ''' Replaces the fragments of a template with those of the last refresh (dropping the ones no longer used) '''
+        self.templates[template_name] = (template_hash, fragments)
+        self.stats['rendered'] += rendered
+        self.stats['reused'] += len(fragments) - rendered
+        if self.storage is not None:
+            try:
+                self._save(template_name, template_hash, fragments)
+            except Exception as e:
+                # the cache is only an optimization, the refresh goes on without it
+                self.logger.error(f"Error saving fragment cache for template {template_name}: {e}")
+
+    def get_stats(self):
+        return dict(self.stats, templates=len(self.templates), fragments=sum(len(cached[1]) for cached in self.templates.values()))
+
+    def _save(self, template_name, template_hash, fragments):
+        start = system_time.time()
+        filename = self.get_filename(template_name)
+        with self.storage.open_writer(filename, content_type='application/octet-stream', binary=True) as f:
+            f.write(self.MAGIC + f" {self.VERSION}\n".encode('ascii'))
+            with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=1) as compressed:
+                with io.TextIOWrapper(compressed, encoding='utf-8') as text:
+                    json.dump({'template_hash': template_hash, 'fragments': fragments}, text, separators=(',', ':'))
+        self.logger.info(f"Fragment cache saved: {len(fragments)} fragments of {template_name} in {system_time.time() - start:.2f}s")
+
+    def _load(self, template_name):
+        filename = self.get_filename(template_name)
+        try:
+            data = self.storage.read_bytes(filename)
+        except Exception as e:
+            self.logger.error(f"Error reading fragment cache [{filename}]: {e}")
+            return None
+        if data is None:
+            return None
+
+        header, _, payload = data.partition(b"\n")
+        try:
+            magic, version = header.split(b" ")
+            if magic != self.MAGIC or int(version) != self.VERSION:
+                self.logger.warning(f"Ignoring fragment cache with unsupported format: {header[:64]}")
+                return None
+            cached = json.loads(gzip.decompress(payload))
+        except (ValueError, OSError, EOFError) as e:
+            self.logger.warning(f"Ignoring unreadable fragment cache [{filename}]: {e}")
+            return None
+
+        self.logger.info(f"Fragment cache loaded: {len(cached['fragments'])} fragments of {template_name}")
+        return (cached['template_hash'], cached['fragments'])
@@ -0,0 +1,194 @@
+import time as system_time
+import uuid
+import json
+import logging
+import threading
+from datetime import datetime, timezone
+from . import config
+from .storage import variant_filename
+
+# number of feed generations kept in storage (the current one included), for rollbacks
+FEED_GENERATIONS_KEPT = getattr(config, 'FEED_GENERATIONS_KEPT', 5)
+# seconds between checks for a new version of the manifest in storage
+MANIFEST_CHECK_INTERVAL = getattr(config, 'FEED_CACHE_CHECK_INTERVAL', 30)
+
+class FeedGenerations:
+    ''' Versioned feed generations, published atomically.
+
+    Each refresh writes all its feeds under a new generation directory (generations/<id>/), which is never
+    modified afterwards. Once they are all complete, a small manifest (the "current" pointer, with the list of
+    kept generations) is replaced in one step, so readers always get a complete and consistent set of feeds.
+    Past generations are kept (up to keep) so that rolling back doesn't need regenerating anything. A feed that
+    didn't change since the previous generation isn't written again: the new generation refers to the same files.
+
+    Manifest format:
+        {"version": 1, "current": "<generation id>",
+         "generations": [{"id": "<generation id>", "created_at": "<ISO time>",
+                          "files": {"<feed filename>": {"path": "...", "size": 123, "variants": {"gzip": "..."},
+                                                        "index": "<item index path, optional>",
+                                                        "digest": "<content digest, optional>"}},
+                          "sources": {<what the feeds were generated from, optional>}}]}
+    (generations newest first)
+    '''
+
+    MANIFEST_FILENAME = 'feeds_manifest.json'
+    DIRECTORY = 'generations'
+    VERSION = 1
+
+    def __init__(self, storage, keep=None, check_interval=None):
+        self.logger = logging.getLogger(__name__)
+        self.storage = storage
+        self.keep = FEED_GENERATIONS_KEPT if keep is None else keep
+        self.check_interval = MANIFEST_CHECK_INTERVAL if check_interval is None else check_interval
+        self.lock = threading.Lock()
+        self.manifest = None
+        self.manifest_version = None
+        self.manifest_checked_at = 0
+
+    def new_generation_id(self):
+        # sortable by creation time, and unique across instances
+        return f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+    def get_path(self, generation_id, filename):
+        return f"{self.DIRECTORY}/{generation_id}/{filename}"
+
+    def publish(self, generation_id, files, sources=None):
+        ''' Makes a (completely written) generation the current one; files is {feed filename: {"path", "size", "variants", ...}} '''
+        with self.lock:
+            manifest = self._load_manifest() or self._empty_manifest()
+            generation = {
+                'id': generation_id,
+                'created_at': datetime.now(timezone.utc).isoformat(),
+                'files': files
+            }
+            if sources is not None:
+                generation['sources'] = sources
+            manifest['generations'].insert(0, generation)
+            manifest['current'] = generation_id
+            pruned = self._prune(manifest)
+            self._save_manifest(manifest)
+        self.logger.info(f"Feed generation {generation_id} published")
+
+        # old generations are only deleted once no new reader can get to them (files of unchanged feeds are still used)
+        kept_paths = set().union(*[self.get_paths(kept) for kept in manifest['generations']])
+        for old_generation in pruned:
+            self._delete_generation(old_generation, kept_paths)
+        return generation
+
+    def update_sources(self, generation_id, sources):
+        ''' Records what a kept generation's feeds were generated from (when regenerating them gave the same feeds) '''
+        with self.lock:
+            manifest = self._load_manifest()
+            generation = self._find(manifest, generation_id) if manifest is not None else None
+            if generation is None:
+                raise ValueError(f"Unknown feed generation: {generation_id}")
+            generation['sources'] = sources
+            self._save_manifest(manifest)
+        return generation
+
+    def rollback(self, generation_id=None):
+        ''' Makes a kept generation (by default, the one before the current) the current one again '''
+        with self.lock:
+            manifest = self._load_manifest()
+            if manifest is None:
+                raise ValueError("There are no feed generations to roll back to")
+            ids = [generation['id'] for generation in manifest['generations']]
+            if generation_id is None:
+                position = ids.index(manifest['current']) + 1
+                if position >= len(ids):
+                    raise ValueError(f"There is no feed generation before {manifest['current']}")
+                generation_id = ids[position]
+            elif generation_id not in ids:
+                raise ValueError(f"Unknown feed generation: {generation_id}")
+            manifest['current'] = generation_id
+            self._save_manifest(manifest)
+        self.logger.info(f"Rolled back to feed generation {generation_id}")
+        return self._find(manifest, generation_id)
+
+    def get_manifest(self):
+        ''' Current manifest (checked for a new version in storage at most every check_interval seconds), or None '''
+        with self.lock:
+            if system_time.time() - self.manifest_checked_at >= self.check_interval:
+                try:
+                    self._load_manifest()
+                except Exception as e:
+                    # storage is unavailable: keep using what we have and check again later
+                    self.logger.error(f"Error loading feeds manifest, using the cached one: {e}")
+                    self.manifest_checked_at = system_time.time()
+            return self.manifest
+
+    def get_current(self):
+        manifest = self.get_manifest()
+        return self._find(manifest, manifest['current']) if manifest is not None else None
+
+    def resolve(self, filename, encoding=None):
+        ''' Path of a feed (or of its compressed variant) in the current generation, or None if it doesn't have it.
+
+        Before the first generation is published, feeds are looked up by their plain name.
+        '''
+        generation = self.get_current()
+        if generation is None:
+            return variant_filename(filename, encoding) if encoding is not None else filename
+
+        feed = generation['files'].get(filename)
+        if feed is None:
+            return None
+        if encoding is not None:
+            return feed['variants'].get(encoding)
+        return feed['path']
+
+    def get_paths(self, generation):
+        ''' Paths of all files of a generation (feeds, their variants and item indexes) '''
+        return {path for feed in generation['files'].values() for path in self._get_feed_paths(feed)}
+
+    def _load_manifest(self):
+        # always called with the lock held
+        version = self.storage.get_version(self.MANIFEST_FILENAME)
+        if version is None:
+            self.manifest = self.manifest_version = None
+        elif version != self.manifest_version:
+            content, version, modified_at = self.storage.read_versioned(self.MANIFEST_FILENAME)
+            self.manifest = json.loads(content) if content else None
+            self.manifest_version = version
+        self.manifest_checked_at = system_time.time()
+        return self.manifest
+
+    def _save_manifest(self, manifest):
+        with self.storage.open_writer(self.MANIFEST_FILENAME, content_type='application/json') as writer:
+            writer.write(json.dumps(manifest, indent=1))
+        self.manifest = manifest
+        self.manifest_version = self.storage.get_version(self.MANIFEST_FILENAME)
+        self.manifest_checked_at = system_time.time()
+
+    def _empty_manifest(self):
+        return {'version': self.VERSION, 'current': None, 'generations': []}
+
+    def _prune(self, manifest):
+        kept, pruned = [], []
+        for generation in manifest['generations']:
+            if len(kept) < self.keep or generation['id'] == manifest['current']:
+                kept.append(generation)
+            else:
+                pruned.append(generation)
+        manifest['generations'] = kept
+        return pruned
+
+    def _get_feed_paths(self, feed):
+        return [feed['path']] + list(feed['variants'].values()) + ([feed['index']] if feed.get('index') else [])
+
+    def _delete_generation(self, generation, kept_paths=()):
+        for feed in generation['files'].values():
+            for path in self._get_feed_paths(feed):
+                if path in kept_paths:
+                    continue
+                try:
+                    self.storage.delete_file(path)
+                except Exception as e:
+                    self.logger.warning(f"Could not delete [{path}] from old feed generation {generation['id']}: {e}")
+        self.logger.info(f"Old feed generation {generation['id']} deleted")
+
+    def _find(self, manifest, generation_id):
+        for generation in manifest['generations']:
+            if generation['id'] == generation_id:
+                return generation
+        return None
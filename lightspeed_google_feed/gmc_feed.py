@@ -1,38 +1,412 @@
+import io
 import re
 import logging
 import json
-from . import lightspeed, storage, template_engine
+import hashlib
+import functools
+from contextlib import ExitStack
+from . import lightspeed, storage, template_engine, xml_engine, formatting
+from .feed_cache import FeedServingCache
+from .generations import FeedGenerations
+from .fragment_cache import FragmentCache
+from . import config
 from .config import SHOP, API_TYPE
 
+# also write precompressed (gzip, and brotli if available) variants of the feeds, served to clients that accept them
+FEED_COMPRESSION = getattr(config, 'FEED_COMPRESSION', True)
+# how feeds are rendered: "jinja" (from the templates) or "xml" (written by code, faster; see XMLFeedEngine)
+FEED_ENGINE = getattr(config, 'FEED_ENGINE', 'jinja')
+# keep rendered items (in memory and in storage), so only new or changed items are rendered from the templates
+FRAGMENT_CACHE = getattr(config, 'FRAGMENT_CACHE', True)
+# feeds are patched in place (see patch_feed_files) only if at most this share of their items changed
+PATCH_MAX_CHANGES = getattr(config, 'PATCH_MAX_CHANGES', 0.1)
+
+class FeedDigestWriter:
+    ''' Feed writer (see storage.StorageWriter) that also computes a digest of what is written, to tell whether a feed
+    changed since it was last published.
+
+    Comments outside items (such as the generation date in the header) are left out of the digest, so a feed
+    generated again from the same catalog has the same digest. A comment may be split across several writes
+    (templates without blocks are written in whatever chunks Jinja generates). Items (see write_item) are digested
+    regardless of their order: a patched feed has the same digest as the same items rendered in catalog order.
+    '''
+
+    COMMENT_START = '<!--'
+    COMMENT_END = '-->'
+    # item digests are added up modulo this (the size of a SHA-256 digest)
+    ITEMS_DIGEST_MODULUS = 2 ** 256
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.digest = hashlib.sha256()
+        # sum of the digests of the items, the same in any order
+        self.items_digest = 0
+        self.in_comment = False
+        # end of the last write, that may be the beginning of a comment start/end split across writes
+        self.pending = ""
+
+    @property
+    def size(self):
+        return self.writer.size
+
+    @property
+    def items(self):
+        return self.writer.items
+
+    def write(self, text):
+        self._update_without_comments(text)
+        return self.writer.write(text)
+
+    def write_item(self, item_id, text):
+        if not self.in_comment:
+            # what was kept in case a comment started is plain text after all
+            self.digest.update(self.pending.encode('utf-8'))
+            self.pending = ""
+        item_digest = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest(), 'big')
+        self.items_digest = (self.items_digest + item_digest) % self.ITEMS_DIGEST_MODULUS
+        self.writer.write_item(item_id, text)
+
+    def discard(self):
+        self.writer.discard()
+
+    def hexdigest(self):
+        digest = self.digest.copy()
+        if not self.in_comment:
+            digest.update(self.pending.encode('utf-8'))
+        digest.update(self.items_digest.to_bytes(32, 'big'))
+        return digest.hexdigest()
+
+    def _update_without_comments(self, text):
+        text = self.pending + text
+        self.pending = ""
+        while text:
+            if self.in_comment:
+                end = text.find(self.COMMENT_END)
+                if end < 0:
+                    self.pending = text[-(len(self.COMMENT_END) - 1):]
+                    return
+                text = text[end + len(self.COMMENT_END):]
+                self.in_comment = False
+            else:
+                start = text.find(self.COMMENT_START)
+                if start < 0:
+                    partial = next((length for length in range(len(self.COMMENT_START) - 1, 0, -1) if text.endswith(self.COMMENT_START[:length])), 0)
+                    self.digest.update(text[:len(text) - partial].encode('utf-8'))
+                    self.pending = text[len(text) - partial:]
+                    return
+                self.digest.update(text[:start].encode('utf-8'))
+                text = text[start + len(self.COMMENT_START):]
+                self.in_comment = True
+
 class GMCFeedGenerator:
-    def __init__(self, cloud=False, api_type=None):
+    FEED_INDEX_VERSION = 2
+
+    def __init__(self, cloud=False, api_type=None, feed_engine=None):
         self.logger = logging.getLogger(__name__)
         self.TEMPLATE_SHOPPING_ONLINE_INVENTORY_FEED = 'TEMPLATE_gmc_shopping_online_inventory.xml'
         self.SHOPPING_ONLINE_INVENTORY_FEED_FILENAME = 'gmc_shopping_online_inventory_feed.xml'
         self.TEMPLATE_LOCAL_LISTINGS_FEED = 'TEMPLATE_gmc_local_listings.xml'
         self.LOCAL_LISTINGS_FEED_FILENAME = 'gmc_local_listings_feed.xml'
-        self.lightspeed_api = lightspeed.LightspeedAPI(api_type=api_type)
         self.storage = storage.Storage(cloud)
-        self.template_engine = template_engine.TemplateEngine()
+        self.feed_cache = FeedServingCache(self.storage)
+        self.generations = FeedGenerations(self.storage)
+        # generation whose feeds are in the serving cache (see get_feed)
+        self.served_generation_id = None
+        self.lightspeed_api = lightspeed.LightspeedAPI(api_type=api_type, storage=self.storage)
+        self.fragment_cache = FragmentCache(self.storage) if FRAGMENT_CACHE else None
+        self.template_engine = self._create_feed_engine(feed_engine if feed_engine is not None else FEED_ENGINE)
         self.template_data = GMCFeedTemplateData(api_type=api_type)
+        self.feeds = []
+        self.feed_encodings = storage.available_encodings() if FEED_COMPRESSION else []
+        self.register_feed(self.TEMPLATE_SHOPPING_ONLINE_INVENTORY_FEED, self.SHOPPING_ONLINE_INVENTORY_FEED_FILENAME)
+        self.register_feed(self.TEMPLATE_LOCAL_LISTINGS_FEED, self.LOCAL_LISTINGS_FEED_FILENAME)
+
+    def _create_feed_engine(self, feed_engine):
+        if feed_engine == "jinja":
+            return template_engine.TemplateEngine(fragment_cache=self.fragment_cache)
+        elif feed_engine == "xml":
+            # writing an item is about as fast as fingerprinting it, so the fragment cache is only used
+            # for feeds rendered from templates
+            return xml_engine.XMLFeedEngine(fragment_cache=self.fragment_cache)
+        raise ValueError(f"Invalid feed engine: {feed_engine} (must be 'jinja' or 'xml')")
+
+    def register_feed(self, template_filename, feed_filename):
+        ''' Adds a feed to be generated (from the given template) on every refresh '''
+        self.feeds.append((template_filename, feed_filename))
+
+    def refresh_feed_files(self, progress=None):
+        ''' Generates all feeds from the current catalog.
+
+        When the catalog was synced as a delta from the one the current feeds were generated from (with the same
+        templates), the feeds are patched: only the items of the products updated or removed by the sync are
+        rendered again (see patch_feed_files). A full sync, or a template change, generates them all again.
+
+        Feeds with the same content as the current ones (apart from their generation date) aren't saved again,
+        and if none changed nothing is published. Returns {"generation": the published generation (or None),
+        "published": names of the feeds saved, "unchanged": names of the feeds left as they were}.
+
+        progress, if given, is called as the refresh goes with its stage ("fetching", "preparing", "rendering"
+        or "patching", and "publishing") and/or counters of what was done so far (pages_fetched, items_rendered, etc.).
+        '''
+        if progress is None:
+            progress = lambda **fields: None
 
-    def refresh_feed_files(self):
         # Get products from Lightspeed API
-        products = self.lightspeed_api.get_all_visible_products()
+        progress(stage="fetching")
+        products = self.lightspeed_api.get_all_visible_products(progress=progress)
+        changes = self.lightspeed_api.get_last_changes()
 
         # Prepare template data/context for feed generation
+        progress(stage="preparing", products_visible=len(products))
         products_for_template = self.template_data.prepare_template_data(products)
-        
-        # Generate (render) feeds from templates
-        shopping_online_inventory_feed_output = self.template_engine.render(self.TEMPLATE_SHOPPING_ONLINE_INVENTORY_FEED, products_for_template)
-        local_listings_feed_output = self.template_engine.render(self.TEMPLATE_LOCAL_LISTINGS_FEED, products_for_template)
+        sources = self._get_feed_sources(changes)
+
+        result = self._patch_changed_products(products_for_template, changes, sources, progress)
+        if result is not None:
+            return result
+
+        # Generate (render) all feeds in a single pass over the products, streaming them straight into storage
+        # as a new generation (see FeedGenerations)
+        progress(stage="rendering", items_total=len(products_for_template))
+        generation_id = self.generations.new_generation_id()
+        item_groups = {item['id']: item['item_group_id'] for item in products_for_template}
+        files = {}
+        with ExitStack() as stack:
+            feed_writers = []
+            for template_filename, feed_filename in self.feeds:
+                path = self.generations.get_path(generation_id, feed_filename)
+                writer = FeedDigestWriter(stack.enter_context(self.storage.open_writer(path, encodings=self.feed_encodings)))
+                feed_writers.append((template_filename, writer))
+                files[feed_filename] = {
+                    'path': path,
+                    'variants': {encoding: storage.variant_filename(path, encoding) for encoding in self.feed_encodings},
+                    'writer': writer,
+                    'item_groups': item_groups
+                }
+            self.template_engine.render_feeds(feed_writers, products_for_template, progress=progress)
+            progress(stage="publishing")
+            self._discard_unchanged_feeds(files)
+
+        return self._publish_feeds(generation_id, files, sources)
+
+    def patch_feed_files(self, changed_items, removed_item_ids=(), progress=None):
+        ''' Updates the current feeds for a few changed, added or removed items, without rendering the others again.
+
+        changed_items is template data (as returned by prepare_template_data) of changed and new items, and
+        removed_item_ids the ids of the items that are gone. Each feed is rewritten in one sequential pass over
+        the current file, using its item index (the byte range of every item, saved with the feed): unchanged
+        items are streamed from the current file, changed ones replaced, removed ones dropped and new ones added
+        at the end. The patched feeds are published as a new generation, unless they didn't change (returns the
+        same as refresh_feed_files).
+
+        Falls back to a full refresh (refresh_feed_files) if the feeds have no index, a feed's template has no
+        header/item/footer blocks or more than PATCH_MAX_CHANGES of their items changed.
+        '''
+        if progress is None:
+            progress = lambda **fields: None
+
+        removed_item_ids = set(removed_item_ids)
+        changed_items = [item for item in changed_items if item['id'] not in removed_item_ids]
+        generation = self.generations.get_current()
+        indexes = self._load_feed_indexes(generation)
+        if indexes is None:
+            self.logger.info("Feeds have no item index to patch, refreshing them")
+            return self.refresh_feed_files(progress=progress)
+        # the patched feeds aren't generated from a synced catalog anymore: the next refresh generates them again
+        result = self._patch_feeds(generation, indexes, changed_items, removed_item_ids, None, progress)
+        if result is None:
+            return self.refresh_feed_files(progress=progress)
+        return result
+
+    def _get_feed_sources(self, changes):
+        # what feeds are generated from: a generation is only patched for a delta from the catalog it was
+        # generated from, with the same templates
+        return {
+            'catalog_synced_at': changes['synced_at'] if changes is not None else None,
+            'template_hashes': {feed_filename: self.template_engine.get_feed_hash(template_filename) for template_filename, feed_filename in self.feeds}
+        }
 
-        # Save feeds to files
-        self.storage.save_file(self.SHOPPING_ONLINE_INVENTORY_FEED_FILENAME, shopping_online_inventory_feed_output)
-        self.storage.save_file(self.LOCAL_LISTINGS_FEED_FILENAME, local_listings_feed_output)
+    def _patch_changed_products(self, items, changes, sources, progress):
+        ''' Patches the current feeds for the products a delta sync changed, or returns None if they have to be
+        generated again (see refresh_feed_files) '''
+        if changes is None or changes['since'] is None:
+            return None
+        generation = self.generations.get_current()
+        if generation is None or generation.get('sources') != dict(sources, catalog_synced_at=changes['since']):
+            self.logger.info("Current feeds weren't generated from the catalog the sync is a delta from, or with the same templates: generating them again")
+            return None
+        indexes = self._load_feed_indexes(generation)
+        if indexes is None:
+            return None
+
+        # every item (variant) of a changed product is rendered again; those no longer in the catalog are removed
+        changed_products = set(changes['updated']) | set(changes['removed'])
+        changed_items = [item for item in items if item['item_group_id'] in changed_products]
+        changed_ids = {item['id'] for item in changed_items}
+        removed_item_ids = {item_id for index in indexes.values() for item_id, start, end, group in index['items']
+                            if group in changed_products and item_id not in changed_ids}
+        return self._patch_feeds(generation, indexes, changed_items, removed_item_ids, sources, progress)
+
+    def _patch_feeds(self, generation, indexes, changed_items, removed_item_ids, sources, progress):
+        ''' Patches the feeds of a generation (see patch_feed_files), or returns None if they can't be patched '''
+        # templates without header/item/footer blocks are rendered as a whole: their feeds have no items to patch
+        whole_templates = [template_filename for template_filename, feed_filename in self.feeds if not self.template_engine.can_render_parts(template_filename)]
+        if whole_templates:
+            self.logger.info(f"Templates {whole_templates} have no header/item/footer blocks, refreshing feeds instead of patching them")
+            return None
+        item_count = max(len(index['items']) for index in indexes.values())
+        changes = len(changed_items) + len(removed_item_ids)
+        if changes > PATCH_MAX_CHANGES * item_count:
+            self.logger.info(f"{changes} changed items out of {item_count}, refreshing feeds instead of patching them")
+            return None
+
+        progress(stage="patching", items_changed=len(changed_items), items_removed=len(removed_item_ids))
+        if not changes:
+            self.logger.info("No item changed, nothing to patch")
+            return self._publish_feeds(generation['id'], {feed_filename: {'unchanged': generation['files'][feed_filename]} for template_filename, feed_filename in self.feeds}, sources)
+
+        generation_id = self.generations.new_generation_id()
+        files = {}
+        with ExitStack() as stack:
+            for template_filename, feed_filename in self.feeds:
+                current_feed = generation['files'][feed_filename]
+                index = indexes[feed_filename]
+                header, fragments, footer = self.template_engine.render_parts(template_filename, changed_items)
+                new_fragments = dict(zip([item['id'] for item in changed_items], fragments))
+                item_groups = {item_id: group for item_id, start, end, group in index['items']}
+                item_groups.update((item['id'], item['item_group_id']) for item in changed_items)
+
+                path = self.generations.get_path(generation_id, feed_filename)
+                writer = FeedDigestWriter(stack.enter_context(self.storage.open_writer(path, encodings=self.feed_encodings)))
+                writer.write(header)
+                # unchanged items are streamed from the current file, in file order
+                with self.storage.open_reader(current_feed['path']) as current_file:
+                    if current_file.seek(0, io.SEEK_END) != index['size']:
+                        raise ValueError(f"Feed [{current_feed['path']}] doesn't match its item index")
+                    for item_id, start, end, group in index['items']:
+                        if item_id in removed_item_ids:
+                            continue
+                        fragment = new_fragments.pop(item_id, None)
+                        if fragment is None:
+                            current_file.seek(start)
+                            fragment = current_file.read(end - start).decode('utf-8')
+                        writer.write_item(item_id, fragment)
+                # new items
+                for item_id, fragment in new_fragments.items():
+                    writer.write_item(item_id, fragment)
+                writer.write(footer)
+                files[feed_filename] = {
+                    'path': path,
+                    'variants': {encoding: storage.variant_filename(path, encoding) for encoding in self.feed_encodings},
+                    'writer': writer,
+                    'item_groups': item_groups
+                }
+            progress(stage="publishing")
+            self._discard_unchanged_feeds(files)
+
+        self.logger.info(f"Feeds patched: {len(changed_items)} items changed or added, {len(removed_item_ids)} removed")
+        return self._publish_feeds(generation_id, files, sources)
+
+    def _discard_unchanged_feeds(self, files):
+        # called before the feed writers are closed: a feed with the same digest as the current one is
+        # discarded instead of saved (and Merchant Center doesn't process it again)
+        current = self.generations.get_current()
+        for feed_filename, feed in files.items():
+            feed['digest'] = feed['writer'].hexdigest()
+            current_feed = current['files'].get(feed_filename) if current is not None else None
+            if current_feed is not None and current_feed.get('digest') == feed['digest']:
+                feed['writer'].discard()
+                feed['unchanged'] = current_feed
+
+    def _publish_feeds(self, generation_id, files, sources=None):
+        # all feeds are complete: switch to the new generation in one step (unchanged feeds keep their current files)
+        result = {
+            'generation': None,
+            'published': [feed_filename for feed_filename, feed in files.items() if 'unchanged' not in feed],
+            'unchanged': [feed_filename for feed_filename, feed in files.items() if 'unchanged' in feed]
+        }
+        if not result['published']:
+            self.logger.info("No feed changed since the last publish, nothing to publish")
+            # the current feeds are what this catalog generates too: the next delta sync can patch them
+            current = self.generations.get_current()
+            if sources is not None and current is not None and current.get('sources') != sources:
+                self.generations.update_sources(current['id'], sources)
+            return result
+
+        generation_files = {}
+        for feed_filename, feed in files.items():
+            if 'unchanged' in feed:
+                generation_files[feed_filename] = feed['unchanged']
+                continue
+            writer = feed.pop('writer')
+            generation_files[feed_filename] = {
+                'path': feed['path'],
+                'variants': feed['variants'],
+                'size': writer.size,
+                'index': self._save_feed_index(feed['path'], writer, feed['item_groups']),
+                'digest': feed['digest']
+            }
+        result['generation'] = self.generations.publish(generation_id, generation_files, sources)
+        self.feed_cache.invalidate()
+        self.logger.info(f"Feeds published: {result['published']}, unchanged: {result['unchanged']}")
+        return result
+
+    def _save_feed_index(self, path, writer, item_groups):
+        # byte range of every item in the feed, in file order, with the product (item group) it's a variant of
+        index_path = f"{path}.index.json"
+        index = {
+            'version': self.FEED_INDEX_VERSION,
+            'size': writer.size,
+            'items': [[item_id, start, end, item_groups.get(item_id)] for item_id, (start, end) in writer.items.items()]
+        }
+        with self.storage.open_writer(index_path, content_type='application/json') as index_writer:
+            index_writer.write(json.dumps(index, separators=(',', ':')))
+        return index_path
+
+    def _load_feed_indexes(self, generation):
+        ''' Item indexes of all feeds of a generation ({feed filename: index}), or None if any is missing '''
+        if generation is None:
+            return None
+        indexes = {}
+        for template_filename, feed_filename in self.feeds:
+            feed = generation['files'].get(feed_filename)
+            if feed is None or not feed.get('index'):
+                return None
+            content = self.storage.read_bytes(feed['index'])
+            if content is None:
+                return None
+            index = json.loads(content)
+            if index.get('version') != self.FEED_INDEX_VERSION:
+                return None
+            indexes[feed_filename] = index
+        return indexes
     
     def read_feed_file(self, filename):
-        return self.storage.read_file(filename)
+        return self.storage.read_file(self.generations.resolve(filename) or filename)
+
+    def get_feed(self, filename, encoding=None):
+        ''' Feed to be served from the current generation (see FeedServingCache), or None if it wasn't generated yet.
+
+        With an encoding (one of feed_encodings), returns the precompressed variant of the feed instead.
+        '''
+        generation = self.generations.get_current()
+        if generation is not None and generation['id'] != self.served_generation_id:
+            # the current generation changed (maybe published or rolled back by another instance):
+            # the feeds of the previous one aren't served anymore
+            self.feed_cache.retain(self.generations.get_paths(generation))
+            self.served_generation_id = generation['id']
+        path = self.generations.resolve(filename, encoding)
+        if path is None:
+            return None
+        return self.feed_cache.get(path)
+
+    def rollback_feeds(self, generation_id=None):
+        ''' Serves a previous generation of the feeds again (see FeedGenerations.rollback) '''
+        generation = self.generations.rollback(generation_id)
+        self.feed_cache.invalidate()
+        return generation
+
+HTML_TAG_PATTERN = re.compile(r'<[^>]+>')
 
 class GMCFeedTemplateData:
     def __init__(self, api_type=None):
@@ -51,7 +425,70 @@ class GMCFeedTemplateData:
             raise ValueError(f"Invalid API type: {self.api_type} (must be 'LS' or 'ECWID')")
     
     def prepare_template_data(self, products):
-        return self.template_data_provider.prepare_template_data(products)
+        template_data = self.template_data_provider.prepare_template_data(products)
+        # final GMC values are computed once per item here, so the templates only substitute them
+        shared = {}
+        for item in template_data:
+            self.normalize_item(item, shared)
+        return template_data
+
+    def normalize_item(self, item, shared=None):
+        ''' Adds the GMC-ready values of an item (formatted prices, absolute links, CDATA-wrapped text...) as item['gmc'].
+
+        shared caches values normalised from objects that all variants of a product share (images, categories,
+        description), so they're only normalised once per product.
+        '''
+        if shared is None:
+            shared = {}
+        currency = SHOP['currency'].upper()
+        price = item['price']
+        images = self._normalize_shared(shared, 'images', item['images'], self._normalize_images)
+        category_path, product_type = self._normalize_shared(shared, 'categories', item['categories'], self._normalize_categories)
+        brand = item.get('brand')
+        item['gmc'] = {
+            'price': f"{formatting.money(price['price_old_incl'] or price['price_incl'])} {currency}",
+            'sale_price': f"{formatting.money(price['price_incl'])} {currency}" if price['price_old_incl'] else None,
+            'link': formatting.absolute_url(f"{item['url']}?source=googlebase", SHOP['domain']),
+            'image_link': images[0] if images else None,
+            'additional_image_links': images[1:10],
+            'title': formatting.cdata(item['fulltitle']),
+            'description': self._normalize_shared(shared, 'description', item['description'], formatting.cdata),
+            'category_path': category_path,
+            'product_type': product_type,
+            'brand': formatting.cdata(brand['title']) if brand else None,
+            'gtin': formatting.cdata(item['ean']),
+            'mpn': formatting.cdata(item['code'])
+        }
+        return item
+
+    def _normalize_shared(self, shared, name, value, normalize):
+        # the values are kept alive by the items, so their ids aren't reused while normalising
+        key = (name, id(value))
+        if key not in shared:
+            shared[key] = normalize(value)
+        return shared[key]
+
+    def _normalize_images(self, images):
+        return [formatting.image_url(image) for image in (images or [])[:10]]
+
+    def _normalize_categories(self, categories):
+        category_path = self._get_category_path(categories)
+        return category_path, formatting.cdata(category_path)
+
+    def _get_category_path(self, categories):
+        # first top level category, its first 2 subcategories and all of theirs (e.g. "Men > MTB gear > Gloves")
+        # (Ecwid category trees end with None)
+        titles = []
+        for category in (categories or [])[:1]:
+            if category is None:
+                continue
+            titles.append(category['title'])
+            for subcategory in category['subs'][:2]:
+                if subcategory is None:
+                    continue
+                titles.append(subcategory['title'])
+                titles.extend(subsubcategory['title'] for subsubcategory in subcategory['subs'] if subsubcategory is not None)
+        return " > ".join(titles)
 
 class GMCFeedTemplateDataFromLightspeed:
     def __init__(self):
@@ -61,12 +498,21 @@ class GMCFeedTemplateDataFromLightspeed:
         # Transform products data for template
         template_data = []
         
+        # categories of the whole catalog, used to build every product's category tree
+        category_index = CategoryIndex.from_products(products)
+
         for product in products:
             self.logger.debug(f"Product: {product['id']} has {len(product['variants'])} variants")
+            # product-level data is computed once and shared (not copied) by all its variants
+            product_cache = {}
+            images = []
+            if product.get('images') and len(product.get('images')) > 0:
+                images = [image['src'] for image in sorted(product.get('images', {}).values(), key=lambda x: x['sortOrder'])]
+
             for product_variant in product["variants"].values():
                 try:
                     # for each combination of product and variant, create a GMCProduct object
-                    gmc_product = GMCFeedProductFromLightspeed(product['id'], product_variant['id'])
+                    gmc_product = GMCFeedProductFromLightspeed(product['id'], product_variant['id'], product_cache=product_cache, category_index=category_index)
                     gmc_product.set_url_slug(product['url'])
                     gmc_product.set_stock_level(product_variant.get("stockLevel"))
                     gmc_product.set_stock_tracking(product_variant.get("stockTracking"))
@@ -79,9 +525,7 @@ class GMCFeedTemplateDataFromLightspeed:
                     gmc_product.set_title(product['fulltitle'])
                     gmc_product.set_variant_title(product_variant.get('title'))
                     gmc_product.set_categories(product.get('categories'))
-
-                    if product.get('images') and len(product.get('images')) > 0:
-                        gmc_product.add_images([image['src'] for image in sorted(product.get('images', {}).values(), key=lambda x: x['sortOrder'])])
+                    gmc_product.set_images(images)
                     
                     if product.get('brand'):
                         gmc_product.set_brand_title(product['brand'].get('title', ''))
@@ -106,10 +550,20 @@ class GMCFeedTemplateDataFromEcwid:
         
         for product in products:
             self.logger.debug(f"Product: {product.get('id')} has {len(product.get('combinations'))} variants")
+            # product-level data is computed once and shared (not copied) by all its variants
+            product_cache = {}
+            images = []
+            if product.get('media') and product.get('media').get('images') and len(product.get('media').get('images')) > 0:
+                images = [image['imageOriginalUrl'] for image in sorted(product.get('media').get('images'), key=lambda x: x['orderBy'])]
+            brand_title = None
+            for attribute in product.get('attributes') or []:
+                if attribute.get('name') == 'Brand':
+                    brand_title = attribute.get('value')
+
             for product_variant in product.get("combinations"):
                 try:
                     # for each combination of product and variant, create a GMCProduct object
-                    gmc_product = GMCFeedProductFromEcwid(product.get('id'), product_variant.get('id'))
+                    gmc_product = GMCFeedProductFromEcwid(product.get('id'), product_variant.get('id'), product_cache=product_cache)
                     gmc_product.set_url_slug(product.get('autogeneratedSlug'))
                     gmc_product.set_url(product.get('url'))
                     gmc_product.set_stock_level(product_variant.get("quantity"))
@@ -123,14 +577,10 @@ class GMCFeedTemplateDataFromEcwid:
                     gmc_product.set_title(product.get('name'))
                     gmc_product.set_variant_attributes(product_variant.get('options'))
                     gmc_product.set_categories(product.get('categories'))
+                    gmc_product.set_images(images)
 
-                    if product.get('media') and product.get('media').get('images') and len(product.get('media').get('images')) > 0:
-                        gmc_product.add_images([image['imageOriginalUrl'] for image in sorted(product.get('media').get('images'), key=lambda x: x['orderBy'])])
-                    
-                    if product.get('attributes'):
-                        for attribute in product.get('attributes'):
-                            if attribute.get('name') == 'Brand':
-                                gmc_product.set_brand_title(attribute.get('value'))
+                    if brand_title is not None:
+                        gmc_product.set_brand_title(brand_title)
 
                     # add the template data from the GMCProduct
                     template_data.append(gmc_product.get_template_data())
@@ -142,8 +592,48 @@ class GMCFeedTemplateDataFromEcwid:
         
         return template_data
     
+def memoized(method):
+    ''' Caches what a GMCFeedProduct getter returns, until one of the product's setters is called '''
+    # keyed by qualified name, so a getter and the one it overrides (called through super()) are cached separately
+    key = method.__qualname__
+
+    @functools.wraps(method)
+    def wrapper(self):
+        if self._memo is None:
+            self._memo = {}
+        elif key in self._memo:
+            return self._memo[key]
+        value = self._memo[key] = method(self)
+        return value
+    return wrapper
+
+def memoized_per_product(*attributes):
+    ''' Like memoized, but the value is shared by all variants of the product (see GMCFeedProduct.product_cache).
+
+    Only for getters that depend on product-level attributes alone (the same for every variant), named in
+    attributes: the shared value is computed again whenever one of them was set to something else.
+    '''
+    def decorator(method):
+        key = method.__qualname__
+        per_object = memoized(method)
+
+        @functools.wraps(method)
+        def wrapper(self):
+            if self.product_cache is None:
+                return per_object(self)
+            return self.get_per_product(key, lambda: method(self), tuple(getattr(self, attribute) for attribute in attributes))
+        return wrapper
+    return decorator
+
 class GMCFeedProduct:
-    def __init__(self, id, variant_id):
+    # there's one object per product variant (tens of thousands for large catalogs), so no per-object __dict__
+    __slots__ = ('id', 'variant_id', 'images', 'stock_level', 'stock_tracking', 'url_slug', 'price', 'old_price',
+                 'title', 'brand_title', 'variant_title', 'variant_values', 'variant_attributes', 'ean', 'code',
+                 'description', 'categories', 'weight', 'product_cache', '_memo')
+
+    logger = logging.getLogger(__name__)
+
+    def __init__(self, id, variant_id, product_cache=None):
         self.id = id
         self.variant_id = variant_id
         self.images = []
@@ -165,14 +655,39 @@ class GMCFeedProduct:
         # it seems that GMC expects a weight for all products and 0 is not accepted
         # 25g is ~ 0.1oz, which is the minimum weight accepted by UPS ground
         self.weight = 25
+        # data derived from product-level attributes, shared by all variants of the product (a dict, see memoized_per_product)
+        self.product_cache = product_cache
+        # getter name -> value computed from the current attributes (see memoized)
+        self._memo = None
+
+    def get_per_product(self, key, compute, inputs=()):
+        ''' Value computed once for all variants of the product (or every time, without a product_cache).
+
+        inputs are the product-level values it's computed from: it's computed again if they changed (e.g. through
+        a setter) since it was shared. The same objects are set on every variant, so comparing them is cheap.
+        '''
+        if self.product_cache is None:
+            return compute()
+        cached = self.product_cache.get(key)
+        if cached is not None and cached[0] == inputs:
+            return cached[1]
+        value = compute()
+        self.product_cache[key] = (inputs, value)
+        return value
+
+    def _invalidate(self):
+        self._memo = None
 
     def set_stock_level(self, stock_level):
+        self._invalidate()
         self.stock_level = stock_level
     
     def set_stock_tracking(self, stock_tracking):
+        self._invalidate()
         self.stock_tracking = stock_tracking
     
     def set_url_slug(self, url_slug):
+        self._invalidate()
         self.url_slug = url_slug
     
     def get_url(self):
@@ -181,21 +696,31 @@ class GMCFeedProduct:
     def get_images(self):
         return self.images
     
+    def set_images(self, images):
+        ''' Sets the list of images, which can be shared with other variants (it's never modified in place) '''
+        self._invalidate()
+        self.images = images
+
     def add_image(self, image):
-        self.images.append(image)
+        self.add_images([image])
 
     def add_images(self, images):
-        self.images.extend(images)
+        self._invalidate()
+        self.images = self.images + list(images)
     
     def set_price(self, price):
+        self._invalidate()
         self.price = price
     
     def set_old_price(self, old_price):
+        self._invalidate()
         self.old_price = old_price
 
     def set_brand_title(self, brand_title):
+        self._invalidate()
         self.brand_title = brand_title
     
+    @memoized
     def get_brand(self):
         if self.brand_title:
             return {
@@ -205,21 +730,27 @@ class GMCFeedProduct:
             return None
     
     def set_ean(self, ean):
+        self._invalidate()
         self.ean = ean
     
     def set_code(self, code):
+        self._invalidate()
         self.code = code
     
     def set_weight(self, weight):
+        self._invalidate()
         if weight and weight > 0:
             self.weight = weight
 
     def set_title(self, title):
+        self._invalidate()
         self.title = title.strip()
     
     def set_description(self, description):
+        self._invalidate()
         self.description = description
     
+    @memoized
     def get_fulltitle(self):
         fulltitle = self.title
         
@@ -237,9 +768,11 @@ class GMCFeedProduct:
 
         return fulltitle
     
+    @memoized
     def get_color(self):
         return self.variant_attributes.get("Color", "").lower()
     
+    @memoized
     def get_size(self):
         size = self.variant_attributes.get("Size", "").lower()
         
@@ -272,6 +805,7 @@ class GMCFeedProduct:
             
         return size
 
+    @memoized
     def get_gender(self):
         # default gender is "Unisex" for all products
         gender = self.variant_attributes.get("Gender", "Unisex").lower()
@@ -285,7 +819,7 @@ class GMCFeedProduct:
             gender = "female"
         
         # also check description
-        description_words = self.description.lower().split()
+        description_words = self._get_description_words()
         if "men" in description_words or "men's" in description_words:
             gender = "male"
         elif "women" in description_words or "women's" in description_words:
@@ -293,6 +827,7 @@ class GMCFeedProduct:
         
         return gender
     
+    @memoized
     def get_age_group(self):
         # default age group is "Adult" for all products
         age_group = self.variant_attributes.get("Age Group", "Adult").lower()
@@ -300,13 +835,18 @@ class GMCFeedProduct:
         # while products are typically denominated as "youth", GMC expects "kids"
         # see https://support.google.com/merchants/answer/6324463?sjid=8143513646685484049-NC
         title_words = self.get_fulltitle().lower().split()
-        description_words = self.description.lower().split()
+        description_words = self._get_description_words()
         if "youth" in title_words or "youth" in description_words:
             age_group = "kids"
         
         return age_group
 
+    @memoized_per_product('description')
+    def _get_description_words(self):
+        return set(self.description.lower().split())
+
     def set_categories(self, categories):
+        self._invalidate()
         if categories:
             self.categories = categories
     
@@ -348,12 +888,83 @@ class GMCFeedProduct:
             'pickup_SLA': self.get_pickup_SLA()
         }
 
+class CategoryIndex:
+    ''' Lightspeed categories of the whole catalog, indexed by URL, built once per refresh.
+
+    A category's ancestors are the categories at the prefixes of its URL (e.g. "men" and "men/mtb-gear"
+    for "men/mtb-gear/gloves"), so a product's category tree is built with a lookup per category and level.
+    '''
+
+    def __init__(self, categories=()):
+        self.by_url = {}
+        # category URL -> categories from the root (depth 1) down to it, or None if its root is unknown
+        self.paths = {}
+        self.add(categories)
+
+    @classmethod
+    def from_products(cls, products):
+        index = cls()
+        for product in products:
+            if product.get('categories'):
+                index.add(product['categories'].values())
+        return index
+
+    def add(self, categories):
+        for category in categories:
+            if category.get('url'):
+                self.by_url[category['url']] = category
+        self.paths.clear()
+
+    def get_path(self, category):
+        url = category.get('url')
+        if not url:
+            return None
+        if url not in self.paths:
+            path = []
+            prefix = ""
+            for part in url.split('/'):
+                prefix = f"{prefix}/{part}" if prefix else part
+                ancestor = self.by_url.get(prefix, category if prefix == url else None)
+                if ancestor is not None:
+                    path.append(ancestor)
+            # only categories under a top level one are part of the tree
+            self.paths[url] = path if path[0].get('depth') == 1 else None
+        return self.paths[url]
+
+    def get_tree(self, categories):
+        ''' Builds the category tree (top level categories with their "subs", sorted by sortOrder) of a product '''
+        tree = []
+        nodes = {}
+        for category in categories:
+            path = self.get_path(category)
+            if path is None:
+                continue
+            subs = tree
+            for ancestor in path:
+                node = nodes.get(ancestor['url'])
+                if node is None:
+                    node = nodes[ancestor['url']] = {
+                        'title': ancestor['title'],
+                        'subs': [],
+                        'sortOrder': ancestor.get('sortOrder', 0)
+                    }
+                    subs.append(node)
+                subs = node['subs']
+        return self._sorted(tree)
+
+    def _sorted(self, nodes):
+        nodes.sort(key=lambda node: node['sortOrder'])
+        return [{'title': node['title'], 'subs': self._sorted(node['subs'])} for node in nodes]
+
 class GMCFeedProductFromLightspeed(GMCFeedProduct):
-    def __init__(self, id, variant_id):
-        super().__init__(id, variant_id)
-        self.logger = logging.getLogger(__name__)
-    
+    __slots__ = ('category_index',)
+
+    def __init__(self, id, variant_id, product_cache=None, category_index=None):
+        super().__init__(id, variant_id, product_cache=product_cache)
+        self.category_index = category_index
+
     def set_variant_title(self, variant_title):
+        self._invalidate()
         self.variant_values = []
         self.variant_attributes = {}
         self.variant_title = variant_title.strip()
@@ -375,103 +986,71 @@ class GMCFeedProductFromLightspeed(GMCFeedProduct):
     def is_available(self):
         return self.stock_level > 0 or self.stock_tracking == "disabled" or self.stock_tracking == "indicator"
 
+    @memoized
     def get_gender(self):
         gender = super().get_gender()
         
         if gender is None or gender == "" or gender == "unisex":
             # also check if any category is "men" or "women"
-            if len(self.categories) > 0:
-                for category in self.categories.values():
-                    if category.get('title', '').lower() == "men":
-                        gender = "male"
-                        break
-                    elif category.get('title', '').lower() == "women":
-                        gender = "female"
-                        break
+            gender = self._get_category_gender() or gender
 
         return gender
+
+    @memoized_per_product('categories')
+    def _get_category_gender(self):
+        for category in self.categories.values():
+            if category.get('title', '').lower() == "men":
+                return "male"
+            elif category.get('title', '').lower() == "women":
+                return "female"
+        return None
     
+    def set_category_index(self, category_index):
+        ''' Sets the CategoryIndex of the whole catalog, used to build the category tree '''
+        self._invalidate()
+        self.category_index = category_index
+
+    @memoized_per_product('categories', 'category_index')
     def get_categories(self):
         # build the list of product categories, translating from the Lightspeed 
         # category structure to what GMC expects
-        product_categories = []
-        # first, collect all categories by depth
-        depth1_cats = []
-        depth2_cats = []
-        depth3_cats = []
-        
-        product_category_values = []
-        if self.categories:
-            product_category_values = self.categories.values()
-        
-        for category in product_category_values:
-            if category['depth'] == 1:
-                depth1_cats.append(category)
-            elif category['depth'] == 2:
-                depth2_cats.append(category)
-            elif category['depth'] == 3:
-                depth3_cats.append(category)
-                
-        # Sort each level by sortOrder
-        depth1_cats.sort(key=lambda x: x['sortOrder'])
-        depth2_cats.sort(key=lambda x: x['sortOrder']) 
-        depth3_cats.sort(key=lambda x: x['sortOrder'])
-        
-        # Build hierarchical structure
-        for d1 in depth1_cats:
-            d1_cat = {
-                'title': d1['title'],
-                'subs': []
-            }
-            
-            # Find depth 2 categories under this depth 1
-            for d2 in depth2_cats:
-                # Check if this d2 belongs under d1 by checking if d1's URL is a prefix
-                if d2['url'].startswith(d1['url'] + '/'):
-                    d2_cat = {
-                        'title': d2['title'],
-                        'subs': []
-                    }
-                    
-                    # Find depth 3 categories under this depth 2
-                    for d3 in depth3_cats:
-                        if d3['url'].startswith(d2['url'] + '/'):
-                            d3_cat = {
-                                'title': d3['title'],
-                                'subs': []
-                            }
-                            d2_cat['subs'].append(d3_cat)
-                        break
-                    
-                    d1_cat['subs'].append(d2_cat)
-            
-            product_categories.append(d1_cat)
-        
-        self.logger.debug(f"Product categories for product id {self.id}_{self.variant_id}: {product_categories} (type: {type(product_categories)})")
+        category_index = self.category_index
+        if category_index is None:
+            # no catalog-wide index: only the product's own categories are known
+            category_index = CategoryIndex(self.categories.values() if self.categories else [])
+        product_categories = category_index.get_tree(self.categories.values() if self.categories else [])
+
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f"Product categories for product id {self.id}_{self.variant_id}: {product_categories} (type: {type(product_categories)})")
         return product_categories
 
 class GMCFeedProductFromEcwid(GMCFeedProduct):
-    def __init__(self, id, variant_id):
-        super().__init__(id, variant_id)
-        self.logger = logging.getLogger(__name__)
-    
+    __slots__ = ('url',)
+
     def set_description(self, description):
+        self._invalidate()
+        # all variants of a product have the same description: only clean it up once
+        self.description = self.get_per_product('description', lambda: self.strip_html(description), (description,))
+
+    @staticmethod
+    def strip_html(description):
         # Remove any HTML tags from description
         if description and isinstance(description, str):
-            self.description = re.sub(r'<[^>]+>', '', description)
-        else:
-            self.description = ""
+            return HTML_TAG_PATTERN.sub('', description)
+        return ""
     
     def is_available(self):
         return self.stock_level > 0 or self.stock_tracking == "ALLOW_PREORDER"
 
     def set_url(self, url):
+        self._invalidate()
         self.url = url
 
     def get_url(self):
         return self.url
     
     def set_variant_attributes(self, variant_attributes):
+        self._invalidate()
         self.variant_attributes = {}
         self.variant_values = []
         for attribute in variant_attributes:
@@ -482,6 +1061,7 @@ class GMCFeedProductFromEcwid(GMCFeedProduct):
                 self.variant_attributes[attribute.get('name')] = attribute.get('value')
                 self.variant_values.append(attribute.get('value'))
     
+    @memoized_per_product('categories')
     def get_categories(self):
         # build the list of product categories, translating from the Lightspeed 
         # category structure to what GMC expects
@@ -494,7 +1074,8 @@ class GMCFeedProductFromEcwid(GMCFeedProduct):
                 }
 
         product_categories = [last_product_category]
-        self.logger.debug(f"Product categories for product id {self.id}_{self.variant_id}: {product_categories} (type: {type(product_categories)})")
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f"Product categories for product id {self.id}_{self.variant_id}: {product_categories} (type: {type(product_categories)})")
         return product_categories
 
     def check_gender_in_category(self, category):
@@ -511,17 +1092,22 @@ class GMCFeedProductFromEcwid(GMCFeedProduct):
                     return gender
         return None
 
+    @memoized
     def get_gender(self):
         gender = super().get_gender()
         
         if gender is None or gender == "" or gender == "unisex":
             # also check if any category is "men" or "women"
-            categories = self.get_categories()
-            if categories and len(categories) > 0:
-                for category in categories:
-                    category_gender = self.check_gender_in_category(category)
-                    if category_gender is not None:
-                        gender = category_gender
-                        break
+            gender = self._get_category_gender() or gender
             
-        return gender
\ No newline at end of file
+        return gender
+
+    @memoized_per_product('categories')
+    def _get_category_gender(self):
+        categories = self.get_categories()
+        if categories and len(categories) > 0:
+            for category in categories:
+                category_gender = self.check_gender_in_category(category)
+                if category_gender is not None:
+                    return category_gender
+        return None
\ No newline at end of file
@@ -0,0 +1,322 @@
+import re
+import time as system_time
+import uuid
+import json
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+from . import config
+
+# seconds after which a refresh lease that wasn't renewed is considered abandoned (e.g. its instance was shut down
+# mid-refresh) and is taken over by another instance; a running refresh renews it every third of that
+REFRESH_LEASE_TTL = getattr(config, 'REFRESH_LEASE_TTL', 3600)
+# seconds between attempts to get the refresh lease while another instance is refreshing
+REFRESH_LEASE_POLL_INTERVAL = getattr(config, 'REFRESH_LEASE_POLL_INTERVAL', 10)
+# seconds between saves of a running job's status to storage (also saved whenever its stage changes)
+JOB_STATUS_SAVE_INTERVAL = 10
+# seconds after which the saved status of a job is deleted, if no instance did (e.g. it was shut down)
+JOB_STATUS_MAX_AGE = 24 * 3600
+
+class RefreshJob:
+    ''' A feed refresh running (or waiting to run) in the background, with its stage, progress and timing '''
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = self.QUEUED
+        self.stage = None
+        self.progress = {}
+        # how many refresh requests this job serves (later requests are merged into a queued job)
+        self.triggers = 1
+        self.error = None
+        # which feeds the refresh published (see GMCFeedGenerator.refresh_feed_files)
+        self.result = None
+        self.created_at = system_time.time()
+        self.started_at = None
+        self.finished_at = None
+        # stage -> seconds spent in it
+        self.stage_durations = OrderedDict()
+        self.stage_started_at = None
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def update(self, stage=None, **progress):
+        ''' Progress callback for GMCFeedGenerator.refresh_feed_files '''
+        with self.lock:
+            if stage is not None and stage != self.stage:
+                self._end_stage()
+                self.stage = stage
+                self.stage_started_at = system_time.time()
+            self.progress.update(progress)
+
+    def start(self):
+        with self.lock:
+            self.status = self.RUNNING
+            self.started_at = system_time.time()
+
+    def finish(self, error=None, result=None):
+        ''' Records how the job ended (the runner then sets done, once the outcome was saved) '''
+        with self.lock:
+            self._end_stage()
+            self.stage = None
+            self.status = self.FAILED if error is not None else self.SUCCEEDED
+            self.error = str(error) if error is not None else None
+            if result is not None:
+                generation = result['generation']
+                self.result = {
+                    'generation': generation['id'] if generation is not None else None,
+                    'published': result['published'],
+                    'unchanged': result['unchanged']
+                }
+            self.finished_at = system_time.time()
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    def to_dict(self):
+        with self.lock:
+            now = system_time.time()
+            stage_durations = dict(self.stage_durations)
+            if self.stage is not None:
+                stage_durations[self.stage] = stage_durations.get(self.stage, 0) + now - self.stage_started_at
+            return {
+                'id': self.id,
+                'status': self.status,
+                'stage': self.stage,
+                'progress': dict(self.progress),
+                'triggers': self.triggers,
+                'error': self.error,
+                'result': self.result,
+                'created_at': self._format_time(self.created_at),
+                'started_at': self._format_time(self.started_at),
+                'finished_at': self._format_time(self.finished_at),
+                'duration': round((self.finished_at or now) - self.started_at, 3) if self.started_at else None,
+                'stage_durations': {stage: round(duration, 3) for stage, duration in stage_durations.items()}
+            }
+
+    def _end_stage(self):
+        if self.stage is not None:
+            self.stage_durations[self.stage] = self.stage_durations.get(self.stage, 0) + system_time.time() - self.stage_started_at
+
+    def _format_time(self, timestamp):
+        return datetime.fromtimestamp(timestamp, timezone.utc).isoformat() if timestamp else None
+
+class RefreshLeaseLost(Exception):
+    ''' The refresh lease was taken over by another instance while this one was refreshing '''
+
+class RefreshLease:
+    ''' Lock shared by all instances of the app (through storage), so that a single refresh runs at a time for the store.
+
+    The lease is a small file, created only if it doesn't exist yet (see Storage.create_file), rewritten while
+    the refresh runs (see renew) and deleted when it's done. One not written for ttl seconds was abandoned and
+    is taken over.
+    '''
+
+    FILENAME = 'refresh_lease.json'
+
+    def __init__(self, storage, ttl=None):
+        self.logger = logging.getLogger(__name__)
+        self.storage = storage
+        self.ttl = REFRESH_LEASE_TTL if ttl is None else ttl
+        # version of the lease file while this instance holds it, and the job it's held for
+        self.version = None
+        self.job_id = None
+        self.renewed_at = None
+
+    def acquire(self, job_id):
+        ''' Takes the lease for a job; returns False if another one holds it '''
+        content = json.dumps({'job': job_id, 'acquired_at': datetime.now(timezone.utc).isoformat()})
+        if not self.storage.create_file(self.FILENAME, content):
+            holder, version, modified_at = self.storage.read_versioned(self.FILENAME)
+            if version is not None:
+                if (datetime.now(timezone.utc) - modified_at).total_seconds() < self.ttl:
+                    return False
+                self.logger.warning(f"Taking over abandoned refresh lease: {holder}")
+                # only if nobody else took it over in the meantime
+                if not self.storage.delete_file(self.FILENAME, version=version):
+                    return False
+            if not self.storage.create_file(self.FILENAME, content):
+                return False
+        self.version = self.storage.get_version(self.FILENAME)
+        self.job_id = job_id
+        self.renewed_at = system_time.time()
+        return True
+
+    def renew(self):
+        ''' Rewrites the lease so it isn't taken over; returns False if it already was '''
+        content = json.dumps({'job': self.job_id, 'renewed_at': datetime.now(timezone.utc).isoformat()})
+        if not self.storage.replace_file(self.FILENAME, content, self.version):
+            return False
+        self.version = self.storage.get_version(self.FILENAME)
+        self.renewed_at = system_time.time()
+        return True
+
+    def renew_if_due(self):
+        ''' Renews the lease every third of its ttl; raises RefreshLeaseLost if it was taken over '''
+        if system_time.time() - self.renewed_at >= self.ttl / 3 and not self.renew():
+            raise RefreshLeaseLost(f"Refresh lease of job {self.job_id} was taken over by another instance")
+
+    def release(self):
+        # unless it was taken over (it wasn't renewed in time)
+        self.storage.delete_file(self.FILENAME, version=self.version)
+        self.version = None
+        self.job_id = None
+
+class RefreshJobRunner:
+    ''' Runs feed refreshes in a background thread, one at a time for the store.
+
+    A refresh requested while another one is running is queued to start right after it (the running one may
+    have fetched the catalog already); any further requests are merged into that queued refresh.
+
+    With a storage, that holds across instances of the app: a refresh waits (stage "waiting") while another
+    instance holds the RefreshLease (renewed from the refresh progress callback; the refresh fails if it's lost),
+    and job statuses are saved to storage so any instance can report them (see get_job_status). Statuses older
+    than JOB_STATUS_MAX_AGE, left by instances that were shut down, are deleted. Without a storage, it only holds
+    within this instance.
+    '''
+
+    STATUS_DIRECTORY = 'refresh_jobs'
+
+    def __init__(self, feed_gen, storage=None, max_history=20, lease_poll_interval=None):
+        self.logger = logging.getLogger(__name__)
+        self.feed_gen = feed_gen
+        self.storage = storage
+        self.lease = RefreshLease(storage) if storage is not None else None
+        self.lease_poll_interval = REFRESH_LEASE_POLL_INTERVAL if lease_poll_interval is None else lease_poll_interval
+        self.max_history = max_history
+        self.lock = threading.Lock()
+        self.running = None
+        self.queued = None
+        # job id -> RefreshJob, for the status endpoint (oldest first)
+        self.jobs = OrderedDict()
+
+    def trigger(self):
+        ''' Starts a refresh (or merges this request into the queued one) and returns its RefreshJob '''
+        with self.lock:
+            if self.queued is not None:
+                with self.queued.lock:
+                    self.queued.triggers += 1
+                self.logger.info(f"Refresh request merged into queued job {self.queued.id}")
+                return self.queued
+
+            job = RefreshJob()
+            forgotten = self._remember(job)
+            if self.running is not None:
+                self.queued = job
+                self.logger.info(f"Refresh job {job.id} queued after running job {self.running.id}")
+            else:
+                self.running = job
+                threading.Thread(target=self._run, args=(job,), name=f"refresh-{job.id}", daemon=True).start()
+        self._save_status(job)
+        for forgotten_job in forgotten:
+            self._delete_status(forgotten_job)
+        return job
+
+    def get_job(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def get_job_status(self, job_id):
+        ''' Status of a job (see RefreshJob.to_dict) started by this or, with a storage, any instance; or None '''
+        job = self.get_job(job_id)
+        if job is not None:
+            return job.to_dict()
+        if self.storage is None or not re.fullmatch(r'[0-9a-f]{32}', job_id):
+            return None
+        content = self.storage.read_bytes(self._get_status_filename(job_id))
+        return json.loads(content) if content is not None else None
+
+    def _run(self, job):
+        while job is not None:
+            self.logger.info(f"Refresh job {job.id} started")
+            job.start()
+            self._save_status(job)
+            self._run_job(job)
+
+            with self.lock:
+                # the queued job (if any) runs next, in this same thread
+                job = self.running = self.queued
+                self.queued = None
+
+    def _run_job(self, job):
+        saved_at = system_time.time()
+
+        def progress(stage=None, **counters):
+            nonlocal saved_at
+            if leased:
+                # aborts the refresh before it publishes anything, if another instance took the lease over
+                self.lease.renew_if_due()
+            job.update(stage=stage, **counters)
+            if stage is not None or system_time.time() - saved_at >= JOB_STATUS_SAVE_INTERVAL:
+                saved_at = system_time.time()
+                self._save_status(job)
+
+        leased = False
+        try:
+            if self.lease is not None:
+                # another instance may be refreshing: this one runs right after it
+                while not self.lease.acquire(job.id):
+                    progress(stage="waiting")
+                    system_time.sleep(self.lease_poll_interval)
+                leased = True
+            result = self.feed_gen.refresh_feed_files(progress=progress)
+        except Exception as e:
+            self.logger.error(f"Refresh job {job.id} failed: {e}")
+            job.finish(error=e)
+        else:
+            job.finish(result=result)
+            self.logger.info(f"Refresh job {job.id} finished: {job.to_dict()}")
+
+        # saved before the lease is released, so it's reported finished by the time the next refresh starts
+        self._save_status(job)
+        if leased:
+            self._delete_stale_statuses()
+            try:
+                self.lease.release()
+            except Exception as e:
+                # it will be taken over once it expires
+                self.logger.error(f"Error releasing refresh lease: {e}")
+        job.done.set()
+
+    def _remember(self, job):
+        # returns the jobs that are forgotten to make room for it
+        forgotten = []
+        self.jobs[job.id] = job
+        while len(self.jobs) > self.max_history:
+            forgotten.append(self.jobs.popitem(last=False)[1])
+        return forgotten
+
+    def _get_status_filename(self, job_id):
+        return f"{self.STATUS_DIRECTORY}/{job_id}.json"
+
+    def _save_status(self, job):
+        if self.storage is None:
+            return
+        try:
+            with self.storage.open_writer(self._get_status_filename(job.id), content_type='application/json') as writer:
+                writer.write(json.dumps(job.to_dict()))
+        except Exception as e:
+            # the status is only informational, the refresh goes on without it
+            self.logger.error(f"Error saving status of refresh job {job.id}: {e}")
+
+    def _delete_status(self, job):
+        if self.storage is None:
+            return
+        try:
+            self.storage.delete_file(self._get_status_filename(job.id))
+        except Exception as e:
+            self.logger.warning(f"Could not delete status of refresh job {job.id}: {e}")
+
+    def _delete_stale_statuses(self):
+        try:
+            now = datetime.now(timezone.utc)
+            for filename, modified_at in self.storage.list_files(self.STATUS_DIRECTORY):
+                if (now - modified_at).total_seconds() >= JOB_STATUS_MAX_AGE:
+                    self.storage.delete_file(filename)
+        except Exception as e:
+            self.logger.warning(f"Could not delete stale refresh job statuses: {e}")
@@ -1,63 +1,192 @@
-import math
-import requests
+import time as system_time
 import logging
+from datetime import datetime, timezone
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from . import config
 from .config import API_TYPE, LS_API_KEY, LS_API_SECRET, LS_BASE_URL, ECWID_API_KEY, ECWID_API_SECRET, ECWID_BASE_URL
-from .cache import SimpleCache
+from .cache import LRUCache
+from .scheduler import RequestScheduler
+from .snapshot import CatalogSnapshotStore
 
-class LightspeedEcomAPI:
-    def __init__(self):
-        self.BASE_URL = LS_BASE_URL
-        self.AUTH = (LS_API_KEY, LS_API_SECRET)
+# number of catalog pages downloaded concurrently (1 = one page at a time)
+FETCH_WORKERS = getattr(config, 'FETCH_WORKERS', 8)
+# how many times a throttled (429) or failed page request is retried before the refresh fails
+FETCH_MAX_RETRIES = getattr(config, 'FETCH_MAX_RETRIES', 5)
+# seconds to wait for the API to respond before a page request is retried
+FETCH_TIMEOUT = getattr(config, 'FETCH_TIMEOUT', 60)
+# only download products updated since the last sync (instead of the whole catalog every time)
+DELTA_SYNC = getattr(config, 'DELTA_SYNC', True)
+# seconds between full catalog downloads when delta sync is enabled (deleted products are only dropped then)
+FULL_SYNC_INTERVAL = getattr(config, 'FULL_SYNC_INTERVAL', 24 * 3600)
+# seconds of overlap between consecutive delta syncs, to tolerate clock differences with the API
+SYNC_OVERLAP = getattr(config, 'SYNC_OVERLAP', 300)
+# keep a persistent snapshot of the catalog in storage (starting point for new instances, fallback when the API is down)
+CATALOG_SNAPSHOT = getattr(config, 'CATALOG_SNAPSHOT', True)
+
+def create_session(pool_size):
+    ''' Creates a requests session with keep-alive connections pooled per host (one connection per fetch worker) '''
+    session = requests.Session()
+    # retries are handled by the RequestScheduler, not by urllib3
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({
+        'Accept-Encoding': 'gzip, deflate',
+        'Connection': 'keep-alive'
+    })
+    return session
+
+def get_session_pool_stats(session):
+    ''' Connections opened vs. requests sent (and therefore connections reused) across the session pools '''
+    stats = {
+        'connections_opened': 0,
+        'requests': 0,
+        'connections_reused': 0
+    }
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                stats['connections_opened'] += pool.num_connections
+                stats['requests'] += pool.num_requests
+    stats['connections_reused'] = max(0, stats['requests'] - stats['connections_opened'])
+    return stats
+
+class LightspeedBaseAPI:
+    ''' Plumbing shared by the API clients: concurrency, pooled session, cache and catalog sync state '''
+
+    def __init__(self, workers=None):
         self.logger = logging.getLogger(__name__)
-        self.cache = SimpleCache()
+        self.cache = LRUCache()
+        self.workers = max(1, workers if workers is not None else FETCH_WORKERS)
+        self.scheduler = RequestScheduler(max_concurrency=self.workers, max_retries=FETCH_MAX_RETRIES)
+        self.session = create_session(pool_size=self.workers)
+        self.delta_sync = DELTA_SYNC
+        # last synced catalog (product id -> product) and when it was synced
+        self.catalog = None
+        self.last_sync_at = None
+        self.last_full_sync_at = None
+        # optional persistent copy of the catalog (see CatalogSnapshotStore)
+        self.snapshot_store = None
+        # what the last sync changed in the catalog (see get_last_changes)
+        self.last_changes = None
 
-    def get_product_count(self):
-        total_count = self.cache.get(key=f"api-product-count")
-        
-        if total_count is None:
-            url = f"{self.BASE_URL}/catalog/count.json"
-            response = requests.get(url, auth=self.AUTH)
-            total_count = response.json()["count"]
-            
-            self.cache.set(key=f"api-product-count", value=total_count, time=30)
-        
-        self.logger.info(f"Total products: {total_count}")
-        return total_count
+    def get_pool_stats(self):
+        return get_session_pool_stats(self.session)
 
-    def get_all_products(self):
-        products = self.cache.get(key=f"api-all-products")
-        
-        if products is None:
-            products = []
-            
-            # Get total count and calculate number of pages needed
-            total_count = self.get_product_count()
-            per_page = 250
-            total_pages = math.ceil(total_count / per_page)
-            
-            # Fetch each page of products
-            for page in range(1, total_pages + 1):
-                url = f"{self.BASE_URL}/catalog.json"
-                params = {
-                    "limit": per_page,
-                    "page": page
-                }
-                
-                response = requests.get(url, auth=self.AUTH, params=params)
-                page_products = response.json()["products"]
-                products.extend(page_products)
-                
-                self.logger.info(f"Fetched page {page}/{total_pages}")
-            
-            self.cache.set(key=f"api-all-products", value=products, time=30)
+    def get_last_changes(self):
+        ''' What the last sync changed: {"synced_at": sync time, "since": time of the sync it's a delta from (None for a
+        full sync), "updated": ids of the products updated or added, "removed": ids of the products dropped} '''
+        return self.last_changes
+
+    def sync_catalog(self, progress=None):
+        ''' Downloads the catalog: the whole of it or, when possible, only the products updated since the last sync.
+
+        progress, if given, is called with the number of pages and products fetched so far after every page.
+        '''
+        sync_started_at = system_time.time()
+
+        # a new instance starts from the last saved snapshot instead of nothing
+        if self.catalog is None:
+            self._load_snapshot()
+
+        try:
+            if self._needs_full_sync(sync_started_at):
+                products = self._fetch_all_pages(progress=progress)
+                self.catalog = {product["id"]: product for product in products}
+                self.last_full_sync_at = sync_started_at
+                changes = {'since': None, 'updated': list(self.catalog), 'removed': []}
+                self.logger.info(f"Full catalog sync: {len(self.catalog)} products")
+            else:
+                # overlap a bit with the previous sync so clock differences don't make us miss updates
+                updated_since = self.last_sync_at - SYNC_OVERLAP
+                updated_products = self._fetch_all_pages(filters=self._updated_since_filter(updated_since), progress=progress)
+                # merge by product id: updated products are replaced in place, new ones are appended, and the ones
+                # a full sync wouldn't list anymore (e.g. disabled) are dropped
+                changes = {'since': self.last_sync_at, 'updated': [], 'removed': []}
+                for product in updated_products:
+                    if self._is_listed(product):
+                        self.catalog[product["id"]] = product
+                        changes['updated'].append(product["id"])
+                    elif self.catalog.pop(product["id"], None) is not None:
+                        changes['removed'].append(product["id"])
+                self.logger.info(f"Delta catalog sync: {len(updated_products)} products updated since {datetime.fromtimestamp(updated_since, timezone.utc).isoformat()} ({len(changes['removed'])} no longer listed)")
+        except requests.exceptions.RequestException as e:
+            if self.catalog is None:
+                raise
+            # the API is down (or too slow): fall back to the last synced catalog instead of failing the refresh
+            self.logger.error(f"Catalog sync failed, using the last synced catalog ({len(self.catalog)} products): {e}")
+            # nothing changed since the last sync
+            self.last_changes = {'synced_at': self.last_sync_at, 'since': self.last_sync_at, 'updated': [], 'removed': []}
+            return list(self.catalog.values())
+
+        self.last_changes = dict(changes, synced_at=sync_started_at)
+        self.last_sync_at = sync_started_at
+        self.logger.info(f"HTTP connection pool: {self.get_pool_stats()}")
+        self._save_snapshot()
+        return list(self.catalog.values())
+
+    def _load_snapshot(self):
+        if self.snapshot_store is None:
+            return
+        snapshot = self.snapshot_store.load()
+        if snapshot is not None:
+            self.catalog = {product["id"]: product for product in snapshot['products']}
+            self.last_sync_at = snapshot['last_sync_at']
+            self.last_full_sync_at = snapshot['last_full_sync_at']
+
+    def _save_snapshot(self):
+        if self.snapshot_store is None:
+            return
+        try:
+            self.snapshot_store.save(list(self.catalog.values()), self.last_sync_at, self.last_full_sync_at)
+        except Exception as e:
+            # the snapshot is only an optimization, the refresh goes on without it
+            self.logger.error(f"Error saving catalog snapshot: {e}")
+
+    def _needs_full_sync(self, now):
+        # deleted products never show up in a delta, so a periodic full sync drops them (and any other drift)
+        return (not self.delta_sync
+                or self.catalog is None
+                or self.last_full_sync_at is None
+                or now - self.last_full_sync_at >= FULL_SYNC_INTERVAL)
+
+    def _updated_since_filter(self, timestamp):
+        raise NotImplementedError
+
+    def _is_listed(self, product):
+        ''' Whether a product returned by a delta sync would be returned by a full sync too '''
+        return True
+
+    def _fetch_all_pages(self, filters=None, progress=None):
+        raise NotImplementedError
+
+    def _report_progress(self, progress, pages_fetched, products_fetched):
+        if progress is not None:
+            progress(pages_fetched=pages_fetched, products_fetched=products_fetched)
+
+class LightspeedEcomAPI(LightspeedBaseAPI):
+    def __init__(self, workers=None):
+        super().__init__(workers=workers)
+        self.BASE_URL = LS_BASE_URL
+        self.AUTH = (LS_API_KEY, LS_API_SECRET)
+        self.PER_PAGE = 250
+
+    def get_all_products(self, progress=None):
+        # concurrent refreshes share a single catalog download
+        products = self.cache.get_or_compute(key=f"api-all-products", compute=lambda: self.sync_catalog(progress), time=30)
             
         self.logger.info(f"Successfully retrieved {len(products)} products")
 
         return products
 
-    def get_all_visible_products(self):
+    def get_all_visible_products(self, progress=None):
         # Get all products
-        products = self.get_all_products()
+        products = self.get_all_products(progress)
         
         # Filter visible products only
         visible_products = [p for p in products if p["isVisible"]]
@@ -65,68 +194,150 @@ class LightspeedEcomAPI:
         
         return visible_products
 
-class LightspeedEcwidAPI:
-    def __init__(self):
+    def _updated_since_filter(self, timestamp):
+        return {"updated_at_min": datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')}
+
+    def _fetch_page(self, page, filters=None):
+        url = f"{self.BASE_URL}/catalog.json"
+        params = {
+            "limit": self.PER_PAGE,
+            "page": page
+        }
+        if filters:
+            params.update(filters)
+        
+        response = self.scheduler.request(self.session.get, url, auth=self.AUTH, params=params, timeout=FETCH_TIMEOUT)
+        page_products = response.json()["products"]
+        
+        self.logger.info(f"Fetched page {page} ({len(page_products)} products)")
+        return page_products
+
+    def _fetch_all_pages(self, filters=None, progress=None):
+        # The catalog endpoint doesn't report a total, so instead of asking count.json
+        # first, request pages ahead and stop at the first short page (which marks the
+        # end of the catalog). Pages are consumed in page order. A request past the end
+        # is wasted (it can't be cancelled once running), so the pages requested ahead
+        # start at one and double with every full page, up to `workers`; a full sync
+        # requests as many pages as the last synced catalog had right away (and only
+        # requests more once it got them all).
+        products = self._fetch_page(1, filters)
+        pages_fetched = 1
+        self._report_progress(progress, pages_fetched, len(products))
+        if len(products) < self.PER_PAGE:
+            return products
+
+        expected_pages = -(-len(self.catalog) // self.PER_PAGE) if not filters and self.catalog else 0
+        ahead = 1
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            next_page = 2
+            pending = deque()
+            while True:
+                while len(pending) < self.workers and (next_page <= expected_pages or len(pending) < ahead):
+                    pending.append(executor.submit(self._fetch_page, next_page, filters))
+                    next_page += 1
+
+                page_products = pending.popleft().result()
+                products.extend(page_products)
+                pages_fetched += 1
+                self._report_progress(progress, pages_fetched, len(products))
+                if len(page_products) < self.PER_PAGE:
+                    break
+                if pages_fetched >= expected_pages:
+                    # the catalog is bigger than expected
+                    ahead = min(self.workers, ahead * 2)
+
+            # pages past the end of the catalog are not needed anymore
+            for future in pending:
+                future.cancel()
+
+        return products
+
+class LightspeedEcwidAPI(LightspeedBaseAPI):
+    def __init__(self, workers=None):
+        super().__init__(workers=workers)
         self.BASE_URL = ECWID_BASE_URL
         self.AUTH = (ECWID_API_KEY, ECWID_API_SECRET)
-        self.logger = logging.getLogger(__name__)
-        self.cache = SimpleCache()
+        self.PER_PAGE = 100
     
     def get_product_count(self):
-        total_count = self.cache.get(key=f"api-product-count")
-        
-        if total_count is None:
-            url = f"{self.BASE_URL}/products"
-            params = {
-                "enabled": "true",
-                "visibleInStorefront": "true",
-                "offset": "0",
-                "limit": "1"
-            }
-            response = requests.get(url, params=params, headers={"Authorization": f"Bearer {self.AUTH[1]}"})
-            total_count = response.json()["total"]
-            
-            self.cache.set(key=f"api-product-count", value=total_count, time=30)
+        # concurrent callers share a single request (see LRUCache.get_or_compute)
+        total_count = self.cache.get_or_compute(key=f"api-product-count", compute=self._fetch_product_count, time=30)
         
         self.logger.info(f"Total products: {total_count}")
         return total_count
 
-    def get_all_visible_products(self):
-        products = self.cache.get(key=f"api-all-products")
-        
-        if products is None:
-            products = []
-            
-            # Get total count and calculate number of pages needed
-            total_count = self.get_product_count()
-            per_page = 100
-            total_pages = math.ceil(total_count / per_page)
-            
-            # Fetch each page of products
-            for page in range(0, total_pages):
-                url = f"{self.BASE_URL}/products"
-                params = {
-                    "enabled": "true",
-                    "visibleInStorefront": "true",
-                    "sortBy": "NAME_ASC",
-                    "offset": str(page * per_page),
-                    "limit": str(per_page)
-                }
-                
-                response = requests.get(url, params=params, headers={"Authorization": f"Bearer {self.AUTH[1]}"})
-                page_products = response.json()["items"]
-                products.extend(page_products)
-                
-                self.logger.info(f"Fetched page {page}/{total_pages}")
-            
-            self.cache.set(key=f"api-all-products", value=products, time=30)
+    def get_all_visible_products(self, progress=None):
+        # concurrent refreshes share a single catalog download
+        products = self.cache.get_or_compute(key=f"api-all-products", compute=lambda: self.sync_catalog(progress), time=30)
             
         self.logger.info(f"Successfully retrieved {len(products)} products")
 
         return products
 
+    def _fetch_product_count(self):
+        url = f"{self.BASE_URL}/products"
+        params = {
+            "enabled": "true",
+            "visibleInStorefront": "true",
+            "offset": "0",
+            "limit": "1"
+        }
+        response = self.scheduler.request(self.session.get, url, params=params, headers={"Authorization": f"Bearer {self.AUTH[1]}"}, timeout=FETCH_TIMEOUT)
+        return response.json()["total"]
+
+    def _updated_since_filter(self, timestamp):
+        return {"updatedFrom": str(int(timestamp))}
+
+    def _is_listed(self, product):
+        # what the enabled/visibleInStorefront filters of a full sync keep: enabled products, in at least one
+        # enabled category if they have any
+        categories = product.get("categories") or []
+        return product.get("enabled", True) and (not categories or any(category.get("enabled", True) for category in categories))
+
+    def _fetch_page(self, offset, filters=None):
+        url = f"{self.BASE_URL}/products"
+        params = {
+            "sortBy": "NAME_ASC",
+            "offset": str(offset),
+            "limit": str(self.PER_PAGE)
+        }
+        if filters:
+            # a delta also needs the products disabled or hidden since the last sync, to drop them (see _is_listed)
+            params.update(filters)
+        else:
+            params.update({"enabled": "true", "visibleInStorefront": "true"})
+        
+        response = self.scheduler.request(self.session.get, url, params=params, headers={"Authorization": f"Bearer {self.AUTH[1]}"}, timeout=FETCH_TIMEOUT)
+        page = response.json()
+        
+        self.logger.info(f"Fetched page at offset {offset} ({len(page['items'])} products)")
+        return page
+
+    def _fetch_all_pages(self, filters=None, progress=None):
+        # The first page also carries the total, so there's no need for a separate
+        # count request: the remaining pages are known upfront and fetched concurrently
+        first_page = self._fetch_page(0, filters)
+        products = list(first_page["items"])
+        total_count = first_page["total"]
+        pages_fetched = 1
+        self._report_progress(progress, pages_fetched, len(products))
+        if not filters:
+            self.cache.set(key=f"api-product-count", value=total_count, time=30)
+
+        offsets = range(self.PER_PAGE, total_count, self.PER_PAGE)
+        self.logger.info(f"Total products: {total_count} ({len(offsets) + 1} pages)")
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            # map() yields results in submission (page) order
+            for page in executor.map(lambda offset: self._fetch_page(offset, filters), offsets):
+                products.extend(page["items"])
+                pages_fetched += 1
+                self._report_progress(progress, pages_fetched, len(products))
+
+        return products
+
 class LightspeedAPI:
-    def __init__(self, api_type=None):
+    def __init__(self, api_type=None, workers=None, storage=None):
         self.logger = logging.getLogger(__name__)
         if api_type is not None:
             self.api_type = api_type
@@ -134,11 +345,21 @@ class LightspeedAPI:
             self.api_type = API_TYPE
 
         if self.api_type == "LS":
-            self.lightspeed_api = LightspeedEcomAPI()
+            self.lightspeed_api = LightspeedEcomAPI(workers=workers)
         elif self.api_type == "ECWID":
-            self.lightspeed_api = LightspeedEcwidAPI()
+            self.lightspeed_api = LightspeedEcwidAPI(workers=workers)
         else:
             raise ValueError(f"Invalid API type: {self.api_type} (must be 'LS' or 'ECWID')")
 
-    def get_all_visible_products(self):
-        return self.lightspeed_api.get_all_visible_products()
\ No newline at end of file
+        if storage is not None and CATALOG_SNAPSHOT:
+            snapshot_filename = f"catalog_snapshot_{self.api_type.lower()}.json.gz"
+            self.lightspeed_api.snapshot_store = CatalogSnapshotStore(storage, snapshot_filename, source=self.lightspeed_api.BASE_URL)
+
+    def get_all_visible_products(self, progress=None):
+        return self.lightspeed_api.get_all_visible_products(progress)
+
+    def get_last_changes(self):
+        return self.lightspeed_api.get_last_changes()
+
+    def get_pool_stats(self):
+        return self.lightspeed_api.get_pool_stats()
\ No newline at end of file
@@ -0,0 +1,162 @@
+import time as system_time
+import random
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+import requests
+
+class RequestScheduler:
+    ''' Runs API requests under an adaptive (AIMD) concurrency limit with a bounded retry budget per request '''
+
+    # responses worth retrying; the ones in THROTTLED_STATUS_CODES also shrink the concurrency limit
+    RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+    THROTTLED_STATUS_CODES = (429, 503)
+
+    def __init__(self, max_concurrency=8, initial_concurrency=None, max_retries=5, backoff=0.5, max_backoff=60):
+        self.logger = logging.getLogger(__name__)
+        self.max_concurrency = max(1, max_concurrency)
+        # start optimistic (the configured number of workers) and only back off once the API pushes back
+        self.limit = self.max_concurrency if initial_concurrency is None else max(1, min(initial_concurrency, self.max_concurrency))
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.successes = 0
+        self.epoch = 0
+        self.paused_until = 0
+        self.stats = {
+            'requests': 0,
+            'retries': 0,
+            'throttled': 0,
+            'failures': 0
+        }
+
+    def request(self, send, *args, **kwargs):
+        ''' Calls send(*args, **kwargs) (e.g. requests.get) under the scheduler, retrying throttled requests '''
+        attempt = 0
+        while True:
+            epoch = self._acquire()
+            response = None
+            try:
+                response = send(*args, **kwargs)
+                if response.status_code not in self.RETRYABLE_STATUS_CODES:
+                    self._on_success(response)
+                    return response
+                attempt += 1
+                delay = self._on_throttled(response, epoch, attempt)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    self._count('failures')
+                    raise
+                delay = self._backoff_delay(attempt)
+                self.logger.warning(f"Request failed ({e.__class__.__name__}), retrying in {delay:.2f}s (attempt {attempt}/{self.max_retries})")
+            finally:
+                # the slot is given back whatever happened (any other error is raised as is), and before waiting to retry
+                self._release()
+
+            if response is not None:
+                if attempt > self.max_retries:
+                    self._count('failures')
+                    self.logger.error(f"Giving up after {self.max_retries} retries (HTTP {response.status_code})")
+                    response.raise_for_status()
+                self.logger.warning(f"HTTP {response.status_code}, retrying in {delay:.2f}s (attempt {attempt}/{self.max_retries}, concurrency {self.limit})")
+            self._count('retries')
+            system_time.sleep(delay)
+
+    def get_stats(self):
+        with self.condition:
+            return dict(self.stats, concurrency=self.limit, in_flight=self.in_flight)
+
+    def _acquire(self):
+        with self.condition:
+            while True:
+                wait = self.paused_until - system_time.time()
+                if wait <= 0 and self.in_flight < self.limit:
+                    break
+                self.condition.wait(timeout=wait if wait > 0 else None)
+            self.in_flight += 1
+            self.stats['requests'] += 1
+            return self.epoch
+
+    def _release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def _count(self, stat):
+        with self.condition:
+            self.stats[stat] += 1
+
+    def _on_success(self, response):
+        with self.condition:
+            # additive increase: one more concurrent request after a full round of successes
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.max_concurrency:
+                self.limit += 1
+                self.successes = 0
+                self.condition.notify_all()
+
+            self._apply_rate_limit_headers(response.headers)
+
+    def _on_throttled(self, response, epoch, attempt):
+        with self.condition:
+            self.successes = 0
+            if response.status_code in self.THROTTLED_STATUS_CODES:
+                self.stats['throttled'] += 1
+                # multiplicative decrease, once per congestion event: requests that were
+                # already in flight when the limit was halved don't halve it again
+                if epoch == self.epoch:
+                    self.limit = max(1, self.limit // 2)
+                    self.epoch += 1
+
+            delay = self._retry_after(response.headers)
+            if delay is None:
+                delay = self._backoff_delay(attempt)
+            else:
+                # everybody waits for the API to be ready again, not only this request
+                self.paused_until = max(self.paused_until, system_time.time() + delay)
+
+            self._apply_rate_limit_headers(response.headers)
+            return delay
+
+    def _apply_rate_limit_headers(self, headers):
+        # Lightspeed reports one value per window (e.g. "X-RateLimit-Remaining: 299/2999/29999"
+        # with the matching "X-RateLimit-Reset: 276/3576/86376" in seconds); pause when any
+        # window is exhausted and never run more requests at once than the API has left
+        remaining = self._header_values(headers, 'X-RateLimit-Remaining', 'RateLimit-Remaining')
+        reset = self._header_values(headers, 'X-RateLimit-Reset', 'RateLimit-Reset')
+        for i, window_remaining in enumerate(remaining):
+            if window_remaining <= 0 and i < len(reset):
+                self.paused_until = max(self.paused_until, system_time.time() + min(reset[i], self.max_backoff))
+        if remaining:
+            self.limit = max(1, min(self.limit, int(min(remaining))))
+
+    def _header_values(self, headers, *names):
+        for name in names:
+            value = headers.get(name) if headers is not None else None
+            if isinstance(value, str):
+                try:
+                    return [float(v) for v in value.split('/') if v.strip()]
+                except ValueError:
+                    self.logger.debug(f"Ignoring malformed {name} header: {value}")
+        return []
+
+    def _retry_after(self, headers):
+        value = headers.get('Retry-After') if headers is not None else None
+        if not isinstance(value, str):
+            return None
+        try:
+            return min(self.max_backoff, max(0.0, float(value)))
+        except ValueError:
+            pass
+        try:
+            # Retry-After may also be an HTTP date
+            return min(self.max_backoff, max(0.0, parsedate_to_datetime(value).timestamp() - system_time.time()))
+        except (TypeError, ValueError):
+            return None
+
+    def _backoff_delay(self, attempt):
+        # exponential backoff with jitter, so retries of concurrent requests don't line up
+        return min(self.max_backoff, self.backoff * (2 ** (attempt - 1))) * random.uniform(0.5, 1.0)
@@ -0,0 +1,69 @@
+import io
+import gzip
+import json
+import logging
+import time as system_time
+
+class CatalogSnapshotStore:
+    ''' Persists the raw catalog (API product payloads and sync times) so new instances don't start from nothing.
+
+    The snapshot is a one-line header ("LSGF-CATALOG-SNAPSHOT <version>") followed by gzip-compressed JSON,
+    saved through Storage (a local file, or an object in the Google Cloud Storage bucket).
+    '''
+
+    MAGIC = b"LSGF-CATALOG-SNAPSHOT"
+    VERSION = 1
+
+    def __init__(self, storage, filename, source=None):
+        self.logger = logging.getLogger(__name__)
+        self.storage = storage
+        self.filename = filename
+        # identifies the catalog (e.g. the API base URL), so a snapshot from another store is never used
+        self.source = source
+
+    def save(self, products, last_sync_at, last_full_sync_at):
+        start = system_time.time()
+        snapshot = {
+            'source': self.source,
+            'saved_at': system_time.time(),
+            'last_sync_at': last_sync_at,
+            'last_full_sync_at': last_full_sync_at,
+            'products': products
+        }
+        with self.storage.open_writer(self.filename, content_type='application/octet-stream', binary=True) as f:
+            f.write(self.MAGIC + f" {self.VERSION}\n".encode('ascii'))
+            # fast compression: the snapshot is saved on every refresh
+            with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=1) as compressed:
+                with io.TextIOWrapper(compressed, encoding='utf-8') as text:
+                    json.dump(snapshot, text, separators=(',', ':'))
+        self.logger.info(f"Catalog snapshot saved: {len(products)} products in {system_time.time() - start:.2f}s")
+
+    def load(self):
+        ''' Returns the snapshot (a dict with products and sync times), or None if there's no usable snapshot '''
+        start = system_time.time()
+        try:
+            data = self.storage.read_bytes(self.filename)
+        except Exception as e:
+            self.logger.error(f"Error reading catalog snapshot [{self.filename}]: {e}")
+            return None
+        if data is None:
+            self.logger.info(f"No catalog snapshot found [{self.filename}]")
+            return None
+
+        header, _, payload = data.partition(b"\n")
+        try:
+            magic, version = header.split(b" ")
+            if magic != self.MAGIC or int(version) != self.VERSION:
+                self.logger.warning(f"Ignoring catalog snapshot with unsupported format: {header[:64]}")
+                return None
+            snapshot = json.loads(gzip.decompress(payload))
+        except (ValueError, OSError, EOFError) as e:
+            self.logger.warning(f"Ignoring unreadable catalog snapshot [{self.filename}]: {e}")
+            return None
+
+        if snapshot.get('source') != self.source:
+            self.logger.warning(f"Ignoring catalog snapshot from another source: {snapshot.get('source')}")
+            return None
+
+        self.logger.info(f"Catalog snapshot loaded: {len(snapshot['products'])} products in {system_time.time() - start:.2f}s")
+        return snapshot
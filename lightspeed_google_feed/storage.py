@@ -1,19 +1,226 @@
-from google.cloud import storage
+import os
+import zlib
+import queue
 import logging
+import threading
+from datetime import datetime, timezone
+from contextlib import contextmanager, ExitStack
+from google.cloud import storage
+from google.cloud.exceptions import NotFound
+from google.api_core.exceptions import PreconditionFailed
+from . import config
 from .config import CLOUD_STORAGE_BUCKET_NAME
 
+try:
+    import brotli
+except ImportError:
+    # optional: only gzip variants are written without it
+    brotli = None
+
+# resumable uploads to Google Cloud Storage are sent in chunks of this size (must be a multiple of 256 KB),
+# so that's roughly all the memory a streamed upload needs (streamed downloads are read in chunks of this size too)
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# streamed uploads run in background threads, so several files (e.g. all feeds and their variants) upload concurrently
+BACKGROUND_UPLOADS = getattr(config, 'BACKGROUND_UPLOADS', True)
+# data handed over to a background upload at a time, and how many of those can be waiting to be uploaded
+BACKGROUND_UPLOAD_BUFFER_SIZE = 256 * 1024
+BACKGROUND_UPLOAD_MAX_PENDING = 64
+
+# precompressed variants of a file are stored next to it: encoding -> (file name suffix, content type)
+COMPRESSED_VARIANTS = {
+    'br': ('.br', 'application/x-brotli'),
+    'gzip': ('.gz', 'application/gzip')
+}
+# compression is done once per file (not per request), so it can be slow and thorough
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9
+
+def available_encodings():
+    ''' Encodings that compressed variants can be written with, in order of preference '''
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+def variant_filename(filename, encoding):
+    return filename + COMPRESSED_VARIANTS[encoding][0]
+
+class CompressedWriter:
+    ''' Binary stream that compresses what is written to it (gzip or brotli) into another binary file/upload '''
+
+    def __init__(self, sink, encoding):
+        self.sink = sink
+        self.encoding = encoding
+        if encoding == 'gzip':
+            # gzip container with no timestamp, so the same content always compresses to the same bytes
+            compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+            self._compress, self._finish = compressor.compress, compressor.flush
+        elif encoding == 'br' and brotli is not None:
+            compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=BROTLI_QUALITY)
+            self._compress, self._finish = compressor.process, compressor.finish
+        else:
+            raise ValueError(f"Unsupported encoding: {encoding}")
+
+    def write(self, data):
+        compressed = self._compress(data)
+        if compressed:
+            self.sink.write(compressed)
+        return len(data)
+
+    def finish(self):
+        self.sink.write(self._finish())
+
+class CancellableUpload:
+    ''' Binary stream to a Google Cloud Storage resumable upload (see Blob.open) that can be cancelled instead of
+    closed: the upload isn't finalized, so nothing is stored '''
+
+    def __init__(self, blob_writer):
+        self.blob_writer = blob_writer
+
+    def write(self, data):
+        return self.blob_writer.write(data)
+
+    def close(self):
+        self.blob_writer.close()
+
+    def cancel(self):
+        # nothing is sent before the first full chunk; after that, the upload session has to be deleted
+        # (BlobWriter has no API for it)
+        upload_and_transport = self.blob_writer._upload_and_transport
+        if upload_and_transport is not None:
+            upload, transport = upload_and_transport
+            transport.delete(upload.resumable_url)
+
+class BackgroundWriter:
+    ''' Binary stream that hands what is written to it over to a background thread, which writes it to another
+    binary file/upload (and closes it), so the caller doesn't wait for the upload '''
+
+    def __init__(self, sink, name=None):
+        self.sink = sink
+        self.buffer = bytearray()
+        self.pending = queue.Queue(maxsize=BACKGROUND_UPLOAD_MAX_PENDING)
+        self.error = None
+        self.finished = False
+        self.cancelled = False
+        self.thread = threading.Thread(target=self._run, name=f"upload-{name}", daemon=True)
+        self.thread.start()
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        self.buffer += data
+        if len(self.buffer) >= BACKGROUND_UPLOAD_BUFFER_SIZE:
+            self.pending.put(bytes(self.buffer))
+            self.buffer.clear()
+        return len(data)
+
+    def flush(self):
+        # data is written as soon as the background thread gets to it
+        pass
+
+    def finish(self):
+        ''' Hands over the rest of the data and lets the sink be closed in the background (see close) '''
+        if not self.finished:
+            self.finished = True
+            if self.buffer:
+                self.pending.put(bytes(self.buffer))
+                self.buffer.clear()
+            self.pending.put(None)
+
+    def close(self):
+        ''' Waits until everything was written and the sink was closed '''
+        self.finish()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def cancel(self):
+        ''' Drops the data not written yet and cancels the sink (see CancellableUpload) instead of closing it '''
+        self.cancelled = True
+        self.finish()
+        self.thread.join()
+
+    def _run(self):
+        try:
+            while True:
+                data = self.pending.get()
+                if data is None:
+                    break
+                if self.error is None and not self.cancelled:
+                    self.sink.write(data)
+        except BaseException as e:
+            self.error = e
+            # keep consuming, so the writer is never blocked on a full queue
+            while self.pending.get() is not None:
+                pass
+        finally:
+            try:
+                if self.cancelled:
+                    self.sink.cancel()
+                else:
+                    self.sink.close()
+            except BaseException as e:
+                if self.error is None:
+                    self.error = e
+
+class StorageWriter:
+    ''' Text stream that encodes what is written to it and hands it over to a binary file/upload (and its compressed variants) '''
+
+    def __init__(self, sink, variants=()):
+        self.sink = sink
+        self.variants = list(variants)
+        self.size = 0
+        # item id -> (start, end) byte range in the file, of the items written with write_item
+        self.items = {}
+        self.discarded = False
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        self.sink.write(data)
+        for variant in self.variants:
+            variant.write(data)
+        self.size += len(data)
+        return len(text)
+
+    def write_item(self, item_id, text):
+        ''' Writes an item (e.g. a feed <item>), recording where it is in the file '''
+        start = self.size
+        self.write(text)
+        self.items[item_id] = (start, self.size)
+
+    def discard(self):
+        ''' Drops everything written: the file (and its variants) is left as it was when the writer is closed '''
+        self.discarded = True
+
+    def finish(self):
+        for variant in self.variants:
+            variant.finish()
+
+class WriteDiscarded(Exception):
+    ''' Raised within Storage.open_writer to clean up a discarded write like a failed one '''
+
 class Storage:
 
-    def __init__(self, cloud=False):
+    def __init__(self, cloud=False, client=None):
         self.logger = logging.getLogger(__name__)
         self.cloud = cloud
+        # Google Cloud Storage client and bucket, created once on first use and shared by all threads
+        # (a client can be given, e.g. a fake one for tests)
+        self.storage_client = client
+        self.bucket = None
+        self.lock = threading.Lock()
+        self.background_uploads = BACKGROUND_UPLOADS
+
+    def get_bucket(self):
+        if self.bucket is None:
+            with self.lock:
+                if self.bucket is None:
+                    if self.storage_client is None:
+                        self.storage_client = storage.Client()
+                    self.bucket = self.storage_client.bucket(CLOUD_STORAGE_BUCKET_NAME)
+        return self.bucket
 
     def save_file(self, filename, content):
         if self.cloud:
             # Save to Google Cloud Storage bucket
-            self.storage_client = storage.Client()
-            bucket = self.storage_client.bucket(CLOUD_STORAGE_BUCKET_NAME)
-            
+            bucket = self.get_bucket()
             blob = bucket.blob(filename)
             blob.upload_from_string(content, content_type='application/xml')
             self.logger.info(f"File saved to Google Cloud Storage: {filename}")
@@ -23,12 +230,98 @@ class Storage:
                 f.write(content)
             self.logger.info(f"File saved to local filesystem: {filename}")
 
+    def save_stream(self, filename, chunks, content_type='application/xml', encodings=()):
+        ''' Saves a file from an iterable of text chunks without holding the whole content in memory '''
+        with self.open_writer(filename, content_type=content_type, encodings=encodings) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+
+    @contextmanager
+    def open_writer(self, filename, content_type='application/xml', binary=False, encodings=()):
+        ''' Writable text (or binary) stream to a file; the file is only replaced if everything was written successfully.
+
+        For text streams, a compressed variant of the file is written at the same time for each of the given
+        encodings (see COMPRESSED_VARIANTS and variant_filename). If the writer is discarded (see
+        StorageWriter.discard), the file and its variants are left untouched.
+        '''
+        try:
+            with ExitStack() as stack:
+                sink = stack.enter_context(self._open_sink(filename, content_type))
+                if binary:
+                    yield sink
+                    return
+
+                variants = []
+                for encoding in encodings:
+                    variant_sink = stack.enter_context(self._open_sink(variant_filename(filename, encoding), COMPRESSED_VARIANTS[encoding][1]))
+                    variants.append(CompressedWriter(variant_sink, encoding))
+                writer = StorageWriter(sink, variants)
+                yield writer
+                if writer.discarded:
+                    # the temporary files/uploads are cleaned up like after an error
+                    raise WriteDiscarded()
+                writer.finish()
+                # background uploads of the file and its variants are all finalized at the same time
+                for background_sink in [sink] + [variant.sink for variant in variants]:
+                    if isinstance(background_sink, BackgroundWriter):
+                        background_sink.finish()
+        except WriteDiscarded:
+            self.logger.info(f"Write to {filename} discarded")
+
+    @contextmanager
+    def _open_sink(self, filename, content_type):
+        if self.cloud:
+            # Stream to a temporary object with a resumable upload (one chunk in memory at a time),
+            # then move it over the real one
+            bucket = self.get_bucket()
+            temp_blob = bucket.blob(f"{filename}.tmp")
+
+            upload = CancellableUpload(temp_blob.open('wb', chunk_size=UPLOAD_CHUNK_SIZE, content_type=content_type, ignore_flush=True))
+            if self.background_uploads:
+                upload = BackgroundWriter(upload, name=filename)
+            closing = False
+            try:
+                yield upload
+                closing = True
+                upload.close()
+            except BaseException:
+                try:
+                    if closing:
+                        # the upload may have been finalized, but only under the temporary name
+                        temp_blob.delete()
+                    else:
+                        # a discarded (or failed) write isn't uploaded: its upload is cancelled, not finalized
+                        upload.cancel()
+                except Exception as e:
+                    self.logger.warning(f"Could not clean up interrupted upload [{filename}.tmp]: {e}")
+                raise
+            bucket.rename_blob(temp_blob, filename)
+            self.logger.info(f"File streamed to Google Cloud Storage: {filename}")
+        else:
+            temp_filename = f"{filename}.tmp"
+            directory = os.path.dirname(filename)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            try:
+                with open(temp_filename, 'wb') as f:
+                    yield f
+                os.replace(temp_filename, filename)
+            except BaseException:
+                if os.path.exists(temp_filename):
+                    os.remove(temp_filename)
+                if directory:
+                    try:
+                        os.removedirs(directory)
+                    except OSError:
+                        # not empty
+                        pass
+                raise
+            self.logger.info(f"File streamed to local filesystem: {filename}")
+
     def read_file(self, filename):
         if self.cloud:
             try:
-                storage_client = storage.Client()
-                bucket = storage_client.bucket(CLOUD_STORAGE_BUCKET_NAME)
-                blob = bucket.blob(filename)
+                blob = self.get_bucket().blob(filename)
                 return blob.download_as_string()
             except Exception as e:
                 self.logger.error(f"Error reading file [{filename}] from Google Cloud Storage: {e}")
@@ -39,4 +332,147 @@ class Storage:
                     return f.read()
             except FileNotFoundError:
                 self.logger.error(f"File not found: {filename}")
-            return "<error>Feed file not found. Please generate a feed first.</error>"
\ No newline at end of file
+            return "<error>Feed file not found. Please generate a feed first.</error>"
+
+    def open_reader(self, filename):
+        ''' Opens a file to be read as a binary file object (with seek), in chunks: it's never in memory all at once '''
+        if self.cloud:
+            return self.get_bucket().blob(filename).open('rb', chunk_size=UPLOAD_CHUNK_SIZE)
+        return open(filename, 'rb')
+
+    def read_bytes(self, filename):
+        ''' Reads a file as bytes, or returns None if it doesn't exist '''
+        if self.cloud:
+            bucket = self.get_bucket()
+            try:
+                return bucket.blob(filename).download_as_bytes()
+            except NotFound:
+                return None
+        else:
+            try:
+                with open(filename, 'rb') as f:
+                    return f.read()
+            except FileNotFoundError:
+                return None
+
+    def create_file(self, filename, content, content_type='application/json'):
+        ''' Writes a file only if it doesn't exist yet, in one step (of concurrent callers, in any instance, only
+        one creates it); returns whether it was created '''
+        if self.cloud:
+            try:
+                # generation 0: the object must not exist
+                self.get_bucket().blob(filename).upload_from_string(content, content_type=content_type, if_generation_match=0)
+            except PreconditionFailed:
+                return False
+            return True
+        else:
+            directory = os.path.dirname(filename)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            try:
+                with open(filename, 'x', encoding='utf-8') as f:
+                    f.write(content)
+            except FileExistsError:
+                return False
+            return True
+
+    def replace_file(self, filename, content, version, content_type='application/json'):
+        ''' Writes a file only if it's still the given version (see get_version), in one step in the cloud;
+        returns whether it was written '''
+        if self.cloud:
+            try:
+                self.get_bucket().blob(filename).upload_from_string(content, content_type=content_type, if_generation_match=version)
+            except PreconditionFailed:
+                return False
+            return True
+        else:
+            if self.get_version(filename) != version:
+                return False
+            with self.open_writer(filename, content_type=content_type) as writer:
+                writer.write(content)
+            return True
+
+    def list_files(self, directory):
+        ''' Files in a directory (not in its subdirectories), as [(filename, modification time (UTC))] '''
+        if self.cloud:
+            blobs = self.get_bucket().list_blobs(prefix=f"{directory}/", delimiter='/')
+            return [(blob.name, blob.updated) for blob in blobs]
+        else:
+            try:
+                entries = list(os.scandir(directory))
+            except FileNotFoundError:
+                return []
+            return [(f"{directory}/{entry.name}", datetime.fromtimestamp(entry.stat().st_mtime, timezone.utc)) for entry in entries if entry.is_file()]
+
+    def delete_file(self, filename, version=None):
+        ''' Deletes a file (and, locally, its directory if it's left empty); files that don't exist are ignored.
+
+        With a version (see get_version), the file is only deleted if it's still that version; returns whether
+        it was deleted (or didn't exist).
+        '''
+        if self.cloud:
+            try:
+                if version is not None:
+                    self.get_bucket().blob(filename).delete(if_generation_match=version)
+                else:
+                    self.get_bucket().blob(filename).delete()
+            except NotFound:
+                pass
+            except PreconditionFailed:
+                return False
+        else:
+            if version is not None and self.get_version(filename) not in (None, version):
+                return False
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            directory = os.path.dirname(filename)
+            if directory:
+                try:
+                    os.removedirs(directory)
+                except OSError:
+                    # not empty
+                    pass
+        return True
+
+    def get_local_path(self, filename):
+        ''' Path of a file in the local filesystem, or None in cloud mode '''
+        return None if self.cloud else os.path.abspath(filename)
+
+    def get_version(self, filename):
+        ''' Cheap check of the current version of a file (no content download), or None if it doesn't exist '''
+        if self.cloud:
+            bucket = self.get_bucket()
+            # metadata only: the object generation changes every time it's replaced
+            blob = bucket.get_blob(filename)
+            return blob.generation if blob is not None else None
+        else:
+            try:
+                stat = os.stat(filename)
+            except FileNotFoundError:
+                return None
+            return (stat.st_mtime_ns, stat.st_size)
+
+    def read_versioned(self, filename):
+        ''' Reads a file as bytes along with its version (see get_version) and modification time (UTC),
+        or returns (None, None, None) if it doesn't exist '''
+        if self.cloud:
+            bucket = self.get_bucket()
+            blob = bucket.get_blob(filename)
+            if blob is None:
+                return None, None, None
+            try:
+                # downloads the generation the metadata is about, even if the object is replaced meanwhile
+                content = blob.download_as_bytes()
+            except NotFound:
+                return None, None, None
+            return content, blob.generation, blob.updated
+        else:
+            try:
+                with open(filename, 'rb') as f:
+                    # version of the file that was opened, even if it's replaced while being read
+                    stat = os.fstat(f.fileno())
+                    return f.read(), (stat.st_mtime_ns, stat.st_size), datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+            except FileNotFoundError:
+                return None, None, None
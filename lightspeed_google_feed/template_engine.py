@@ -1,60 +1,202 @@
+import os
+import json
+import hashlib
+import tempfile
 from datetime import datetime
 import logging
 import pytz
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+from . import config, formatting
+from .fragment_cache import fingerprint
 from .config import SHOP
 
+# compiled templates are kept on disk here, so new instances don't have to compile them again
+# (App Engine only allows writing to /tmp)
+TEMPLATE_CACHE_DIR = getattr(config, 'TEMPLATE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'lightspeed_google_feed_templates'))
+
 class TemplateEngine:
 
-    def __init__(self):
-        self.TEMPLATES_DIR = 'templates'
+    # blocks a template needs to take part in a single-pass, multi-feed render
+    FEED_BLOCKS = ('header', 'item', 'footer')
+    # items rendered between progress reports (see render_feeds)
+    PROGRESS_INTERVAL = 100
+
+    def __init__(self, templates_dir='templates', cache_dir=None, fragment_cache=None):
+        self.TEMPLATES_DIR = templates_dir
         self.SHOP = SHOP
         self.logger = logging.getLogger(__name__)
+        self.env = self._create_environment(cache_dir if cache_dir is not None else TEMPLATE_CACHE_DIR)
+        # rendered items reused between refreshes (see FragmentCache), if given
+        self.fragment_cache = fragment_cache
     
+    def precompile(self):
+        ''' Loads (compiles) all templates upfront, e.g. when the app starts '''
+        template_names = self.env.list_templates()
+        for template_name in template_names:
+            self.env.get_template(template_name)
+        self.logger.info(f"Precompiled {len(template_names)} templates")
+        return template_names
+
     def render(self, template_filename, template_products):
-        # Setup Jinja environment
-        env = Environment(loader=FileSystemLoader('.'))
-        env.filters['cdata'] = self._jinja_cdata
-        env.filters['url'] = self._jinja_url
-        env.filters['url_image'] = self._jinja_url_image
-        env.filters['limit'] = self._jinja_limit
-        env.filters['money_float'] = self._jinja_money_float
-        template = env.get_template(f"./{self.TEMPLATES_DIR}/{template_filename}")
+        return "".join(self.render_stream(template_filename, template_products))
+
+    def render_stream(self, template_filename, template_products):
+        ''' Renders the template piece by piece (a generator of text chunks), so the output never has to be in memory all at once '''
+        # compiled templates are cached by the environment and reloaded only if the file changed
+        template = self.env.get_template(template_filename)
 
         # Render template
-        output = template.render(
+        return template.generate(
             shop=self.SHOP,
             products=template_products,
             date=self._get_formatted_date()
         )
-        
-        return output
     
+    def render_feeds(self, feeds, template_products, progress=None):
+        ''' Renders several feeds in a single pass over the products, writing each item to every feed as it goes.
+
+        feeds is a list of (template_filename, writer) pairs. Templates with "header", "item" (scoped)
+        and "footer" blocks are rendered block by block; any other template is rendered on its own.
+        progress, if given, is called with the number of items rendered so far every PROGRESS_INTERVAL items.
+
+        With a fragment cache, items whose data didn't change since the last refresh aren't rendered again: their
+        fragments are copied from the cache (item blocks must only depend on the product and shop variables).
+        '''
+        variables = {
+            'shop': self.SHOP,
+            'products': template_products,
+            'date': self._get_formatted_date()
+        }
+
+        single_pass_feeds = []
+        for template_filename, writer in feeds:
+            template = self.env.get_template(template_filename)
+            if all(block in template.blocks for block in self.FEED_BLOCKS):
+                single_pass_feeds.append((template, writer))
+            else:
+                self.logger.info(f"Template {template_filename} has no header/item/footer blocks, rendering it separately")
+                for chunk in template.generate(**variables):
+                    writer.write(chunk)
+
+        for template, writer in single_pass_feeds:
+            writer.write(self._render_block(template, 'header', variables))
+
+        # per feed: fragments of the last refresh, and those of this one ({item fingerprint: fragment})
+        cached_fragments = []
+        fragments = [{} for feed in single_pass_feeds]
+        template_hashes = []
+        if self.fragment_cache is not None:
+            for template, writer in single_pass_feeds:
+                template_hashes.append(self._get_template_hash(template))
+                cached_fragments.append(self.fragment_cache.get_fragments(template.name, template_hashes[-1]))
+        fragments_rendered = [0 for feed in single_pass_feeds]
+
+        items_rendered = 0
+        for product in template_products:
+            item_variables = None
+            item_fingerprint = fingerprint(product) if self.fragment_cache is not None else None
+            for i, (template, writer) in enumerate(single_pass_feeds):
+                fragment = None
+                if item_fingerprint is not None:
+                    fragment = fragments[i].get(item_fingerprint) or cached_fragments[i].get(item_fingerprint)
+                if fragment is None:
+                    if item_variables is None:
+                        item_variables = dict(variables, product=product)
+                    fragment = self._render_block(template, 'item', item_variables)
+                    fragments_rendered[i] += 1
+                if item_fingerprint is not None:
+                    fragments[i][item_fingerprint] = fragment
+                self._write_item(writer, product, fragment)
+            items_rendered += 1
+            if progress is not None and items_rendered % self.PROGRESS_INTERVAL == 0:
+                progress(items_rendered=items_rendered)
+        if progress is not None:
+            progress(items_rendered=items_rendered)
+
+        for template, writer in single_pass_feeds:
+            writer.write(self._render_block(template, 'footer', variables))
+
+        if self.fragment_cache is not None:
+            for i, (template, writer) in enumerate(single_pass_feeds):
+                self.logger.info(f"Rendered {fragments_rendered[i]} items of {template.name}, {len(fragments[i]) - fragments_rendered[i]} unchanged items copied from the fragment cache")
+                self.fragment_cache.update(template.name, template_hashes[i], fragments[i], rendered=fragments_rendered[i])
+
+    def can_render_parts(self, template_filename):
+        ''' Whether the items of a feed can be rendered on their own (see render_parts) '''
+        template = self.env.get_template(template_filename)
+        return all(block in template.blocks for block in self.FEED_BLOCKS)
+
+    def render_parts(self, template_filename, template_products):
+        ''' Renders the header, each item and the footer of a feed separately: (header, [item fragments], footer).
+
+        Used to patch a feed in place (see GMCFeedGenerator.patch_feed_files); the template must have
+        header/item/footer blocks.
+        '''
+        if not self.can_render_parts(template_filename):
+            raise ValueError(f"Template {template_filename} has no header/item/footer blocks")
+        template = self.env.get_template(template_filename)
+        variables = {
+            'shop': self.SHOP,
+            'products': template_products,
+            'date': self._get_formatted_date()
+        }
+        items = [self._render_block(template, 'item', dict(variables, product=product)) for product in template_products]
+        return self._render_block(template, 'header', variables), items, self._render_block(template, 'footer', variables)
+
+    def get_feed_hash(self, template_filename):
+        ''' Changes whenever the engine would write the feed differently from the same items (see _get_template_hash) '''
+        template = self.env.get_template(template_filename)
+        return f"{type(self).__name__}:{self._get_template_hash(template)}"
+
+    def _write_item(self, writer, product, fragment):
+        # writers that index the items (see StorageWriter.write_item) are told which item is written
+        if hasattr(writer, 'write_item'):
+            writer.write_item(product['id'], fragment)
+        else:
+            writer.write(fragment)
+
+    def _get_template_hash(self, template):
+        # what an item block renders to depends on the template source and the shop info
+        source = self.env.loader.get_source(self.env, template.name)[0]
+        shop = json.dumps(self.SHOP, sort_keys=True, default=str)
+        return hashlib.sha256(f"{source}\n{shop}".encode('utf-8')).hexdigest()
+
+    def _render_block(self, template, block_name, variables):
+        return "".join(template.blocks[block_name](template.new_context(variables)))
+
+    def _create_environment(self, cache_dir):
+        # Setup a long-lived Jinja environment: templates are compiled once, kept in memory and
+        # recompiled only when the template file's modification time changes (auto_reload)
+        bytecode_cache = None
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            bytecode_cache = FileSystemBytecodeCache(cache_dir)
+        except OSError as e:
+            self.logger.warning(f"Template bytecode cache disabled, cannot use directory [{cache_dir}]: {e}")
+
+        env = Environment(loader=FileSystemLoader(self.TEMPLATES_DIR), bytecode_cache=bytecode_cache, auto_reload=True)
+        env.filters['cdata'] = self._jinja_cdata
+        env.filters['url'] = self._jinja_url
+        env.filters['limit'] = self._jinja_limit
+        # the feed templates use values normalised upfront (see GMCFeedTemplateData.normalize_item),
+        # these filters are kept for custom templates
+        env.filters['url_image'] = self._jinja_url_image
+        env.filters['money_float'] = self._jinja_money_float
+        return env
+
     def _get_formatted_date(self):
         now_utc = datetime.now(pytz.utc)
         now_pacific = now_utc.astimezone(pytz.timezone('US/Pacific'))
         return now_pacific.strftime('%Y-%m-%d %H:%M:%S %Z')
 
     def _jinja_cdata(self, value):
-        if not value:
-            return value
-        return f"<![CDATA[ {value} ]]>"
+        return formatting.cdata(value)
 
     def _jinja_url(self, value):
-        #self.logger.debug(f"Template URL filter: Making sure this is a valid URL: {value}")
-        if value:
-            value = value.replace('http://', 'https://')
-            if not value.startswith(self.SHOP['domain']) and not value.startswith(self.SHOP['domain'].replace('://www.', '://')):
-                value = f"{self.SHOP['domain']}{value}"
-        #self.logger.debug(f"Template URL filter: {value}")
-        return value
+        return formatting.absolute_url(value, self.SHOP['domain'])
 
     def _jinja_url_image(self, value):
-        #self.logger.debug(f"Template Img URL filter: Making sure this is a valid image URL: {value}")
-        if value:
-            value = value.replace('/file.jpg', '/image.jpg')
-        #self.logger.debug(f"Template Img URL filter: {value}")
-        return value
+        return formatting.image_url(value)
 
     def _jinja_limit(self, value, limit):
         #self.logger.debug(f"Template Limit filter: {value} | {limit} | {type(value)}")
@@ -66,9 +208,4 @@ class TemplateEngine:
             return value
     
     def _jinja_money_float(self, value):
-        #self.logger.debug(f"Template Money Float filter: '{value}'")
-        value = str(float(str(value).replace('$', '').replace(',', '')))
-        if "." in value and len(value.split(".")[1]) == 1:
-            value = f"{value}0"
-        #self.logger.debug(f"Template Money Float filter: New value is '{value}'")
-        return value
+        return formatting.money(value)
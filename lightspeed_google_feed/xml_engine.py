@@ -0,0 +1,174 @@
+import os
+import re
+from .template_engine import TemplateEngine
+
+# characters that aren't allowed in XML 1.0 documents (control characters other than tab, newline and carriage return)
+INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+def escape(value):
+    ''' Text content of an element: None is empty, markup characters are escaped and invalid characters removed '''
+    if value is None:
+        return ""
+    text = str(value)
+    if INVALID_XML_CHARS.search(text):
+        text = INVALID_XML_CHARS.sub('', text)
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def escape_attribute(value):
+    return escape(value).replace('"', '&quot;')
+
+class XMLWriter:
+    ''' Incremental XML serializer: elements are appended to a list of text chunks, with no whitespace between them '''
+
+    def __init__(self):
+        self.chunks = []
+
+    def element(self, tag, text):
+        self.chunks.append(f"<{tag}>{escape(text)}</{tag}>")
+
+    def start(self, tag, attributes=None):
+        if attributes:
+            attributes = "".join(f' {name}="{escape_attribute(value)}"' for name, value in attributes.items())
+            self.chunks.append(f"<{tag}{attributes}>")
+        else:
+            self.chunks.append(f"<{tag}>")
+
+    def end(self, tag):
+        self.chunks.append(f"</{tag}>")
+
+    def raw(self, text):
+        self.chunks.append(text)
+
+    def getvalue(self):
+        value = "".join(self.chunks)
+        self.chunks.clear()
+        return value
+
+class XMLFeedEngine(TemplateEngine):
+    ''' Writes the GMC feeds with code instead of rendering their Jinja templates (see FEED_ENGINE in config).
+
+    Each feed is still identified by its template, and the same elements are written in the same order, from the
+    items normalised by GMCFeedTemplateData, but with no insignificant whitespace. Feeds with no writer here
+    (e.g. custom templates) are rendered from their templates.
+    '''
+
+    FOOTER = "</channel></rss>"
+
+    def __init__(self, templates_dir='templates', cache_dir=None, fragment_cache=None):
+        super().__init__(templates_dir=templates_dir, cache_dir=cache_dir, fragment_cache=fragment_cache)
+        # template filename -> method writing one item of that feed
+        self.item_writers = {
+            'TEMPLATE_gmc_shopping_online_inventory.xml': self._write_shopping_online_inventory_item,
+            'TEMPLATE_gmc_local_listings.xml': self._write_local_listings_item
+        }
+
+    def render_feeds(self, feeds, template_products, progress=None):
+        ''' Writes several feeds in a single pass over the products (see TemplateEngine.render_feeds) '''
+        code_feeds = []
+        template_feeds = []
+        for template_filename, writer in feeds:
+            item_writer = self.item_writers.get(os.path.basename(template_filename))
+            if item_writer is not None:
+                code_feeds.append((item_writer, writer))
+            else:
+                template_feeds.append((template_filename, writer))
+
+        if template_feeds:
+            self.logger.info(f"No XML writer for templates {[feed[0] for feed in template_feeds]}, rendering them from the templates")
+            # the products are walked once more for them
+            template_products = list(template_products)
+            super().render_feeds(template_feeds, template_products)
+
+        xml = XMLWriter()
+        header = self._get_header(xml)
+        for item_writer, writer in code_feeds:
+            writer.write(header)
+
+        items_written = 0
+        for product in template_products:
+            for item_writer, writer in code_feeds:
+                item_writer(xml, product)
+                self._write_item(writer, product, xml.getvalue())
+            items_written += 1
+            if progress is not None and items_written % self.PROGRESS_INTERVAL == 0:
+                progress(items_rendered=items_written)
+        if progress is not None:
+            progress(items_rendered=items_written)
+
+        for item_writer, writer in code_feeds:
+            writer.write(self.FOOTER)
+
+    def can_render_parts(self, template_filename):
+        return os.path.basename(template_filename) in self.item_writers or super().can_render_parts(template_filename)
+
+    def render_parts(self, template_filename, template_products):
+        ''' Writes the header, each item and the footer of a feed separately (see TemplateEngine.render_parts) '''
+        item_writer = self.item_writers.get(os.path.basename(template_filename))
+        if item_writer is None:
+            return super().render_parts(template_filename, template_products)
+        xml = XMLWriter()
+        items = []
+        for product in template_products:
+            item_writer(xml, product)
+            items.append(xml.getvalue())
+        return self._get_header(xml), items, self.FOOTER
+
+    def _get_header(self, xml):
+        xml.raw('<?xml version="1.0" encoding="utf-8"?>\n')
+        xml.raw(f"<!-- generated on {self._get_formatted_date()} -->\n")
+        xml.start('rss', {'version': '2.0', 'xmlns:g': 'http://base.google.com/ns/1.0'})
+        xml.start('channel')
+        xml.element('title', self.SHOP['title'])
+        xml.element('link', self.SHOP['domain'])
+        xml.element('description', self.SHOP['description'])
+        return xml.getvalue()
+
+    def _write_availability(self, xml, product):
+        xml.element('g:availability', 'in_stock' if product['available'] else 'out_of_stock')
+        xml.element('g:pickup_SLA', product['pickup_SLA'])
+        xml.element('g:pickup_method', 'buy')
+
+    def _write_prices(self, xml, gmc):
+        xml.element('g:price', gmc['price'])
+        if gmc['sale_price']:
+            xml.element('g:sale_price', gmc['sale_price'])
+
+    def _write_shopping_online_inventory_item(self, xml, product):
+        gmc = product['gmc']
+        xml.start('item')
+        xml.element('g:id', product['id'])
+        xml.element('g:item_group_id', product['item_group_id'])
+        xml.element('g:quantity', product['stock_level'])
+        xml.element('title', product['fulltitle'])
+        xml.element('description', product['description'])
+        xml.element('link', gmc['link'])
+        if gmc['image_link']:
+            xml.element('g:image_link', gmc['image_link'])
+        for image_link in gmc['additional_image_links']:
+            xml.element('g:additional_image_link', image_link)
+        xml.element('g:product_type', gmc['category_path'])
+        self._write_availability(xml, product)
+        self._write_prices(xml, gmc)
+        if product['brand']:
+            xml.element('g:brand', product['brand']['title'])
+        for attribute in ('age_group', 'color', 'gender', 'size'):
+            if product[attribute]:
+                xml.element(f'g:{attribute}', product[attribute])
+        xml.element('g:condition', 'new')
+        xml.element('g:gtin', product['ean'])
+        xml.element('g:mpn', product['code'])
+        xml.element('g:shipping_weight', f"{product['weight']} g")
+        xml.end('item')
+
+    def _write_local_listings_item(self, xml, product):
+        gmc = product['gmc']
+        xml.start('item')
+        xml.element('g:id', product['id'])
+        xml.element('g:store_code', self.SHOP['store_code'])
+        xml.element('g:quantity', product['stock_level'])
+        self._write_prices(xml, gmc)
+        self._write_availability(xml, product)
+        xml.element('g:gtin', product['ean'])
+        xml.element('g:mpn', product['code'])
+        xml.element('g:shipping_weight', f"{product['weight']} g")
+        xml.end('item')
@@ -1,8 +1,12 @@
 import sys
+import hmac
 import logging
 import os
+import functools
 import flask
+from lightspeed_google_feed import config
 from lightspeed_google_feed.gmc_feed import GMCFeedGenerator
+from lightspeed_google_feed.jobs import RefreshJobRunner
 
 try:
     import version #auto-generated by "make deploy"
@@ -13,8 +17,14 @@ IS_RUNNING_ON_CLOUD = False
 if os.getenv('GAE_ENV', '').startswith('standard') or os.getenv('GAE_ENV', '').startswith('flex'):
     IS_RUNNING_ON_CLOUD = True
 
+# token for admin endpoints (e.g. /rollback_feeds) on App Engine, sent in the X-Admin-Token header
+ADMIN_TOKEN = getattr(config, 'ADMIN_TOKEN', None)
+
 app = flask.Flask(__name__)
 feed_gen = GMCFeedGenerator(cloud=IS_RUNNING_ON_CLOUD)
+feed_gen.template_engine.precompile()
+# one refresh at a time across instances, with job statuses any instance can report (see RefreshJobRunner)
+refresh_jobs = RefreshJobRunner(feed_gen, storage=feed_gen.storage)
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(name)s] [%(levelname)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
@@ -32,16 +42,80 @@ Google Merchant Center Feed Generator for Lightspeed<br>
 
 @app.route("/refresh_feeds")
 def refresh_feeds():
-    feed_gen.refresh_feed_files()
-    return "New RSS feed files are ready.<br><a href='/'>Back to home</a>"
+    # the refresh runs in the background (merged into the pending one, if any); its status is at /refresh_feeds/<job id>
+    job = refresh_jobs.trigger()
+    status_url = flask.url_for('refresh_feeds_status', job_id=job.id)
+    return flask.jsonify(dict(job.to_dict(), status_url=status_url)), 202, {'Location': status_url}
+
+@app.route("/refresh_feeds/<job_id>")
+def refresh_feeds_status(job_id):
+    status = refresh_jobs.get_job_status(job_id)
+    if status is None:
+        return flask.jsonify({'error': f"Unknown refresh job: {job_id}"}), 404
+    return flask.jsonify(status)
+
+def admin_required(view):
+    ''' Only lets through requests from App Engine cron jobs or with the admin token (anyone, when running locally) '''
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        # App Engine removes the X-Appengine-Cron header from requests that don't come from its cron service
+        is_cron = flask.request.headers.get('X-Appengine-Cron') == 'true'
+        has_token = bool(ADMIN_TOKEN) and hmac.compare_digest(flask.request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN)
+        if IS_RUNNING_ON_CLOUD and not is_cron and not has_token:
+            return flask.jsonify({'error': "Forbidden"}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route("/rollback_feeds", methods=["POST"])
+@admin_required
+def rollback_feeds():
+    # back to the previous generation of the feeds, or to a given one (generation=<id>)
+    try:
+        generation = feed_gen.rollback_feeds(flask.request.values.get('generation'))
+    except ValueError as e:
+        return flask.jsonify({'error': str(e)}), 409
+    return flask.jsonify({'current': generation['id'], 'created_at': generation['created_at']})
+
+@app.route("/feed_generations")
+def feed_generations():
+    manifest = feed_gen.generations.get_manifest() or {'current': None, 'generations': []}
+    return flask.jsonify({'current': manifest['current'], 'generations': [{'id': generation['id'], 'created_at': generation['created_at']} for generation in manifest['generations']]})
 
 @app.route("/shopping_online_inventory_feed")
 def shopping_online_inventory_feed():
-    return feed_gen.read_feed_file(feed_gen.SHOPPING_ONLINE_INVENTORY_FEED_FILENAME), {'Content-Type': 'application/xml'}
+    return serve_feed(feed_gen.SHOPPING_ONLINE_INVENTORY_FEED_FILENAME)
 
 @app.route("/local_listings_feed")
 def local_listings_feed():
-    return feed_gen.read_feed_file(feed_gen.LOCAL_LISTINGS_FEED_FILENAME), {'Content-Type': 'application/xml'}      
+    return serve_feed(feed_gen.LOCAL_LISTINGS_FEED_FILENAME)
+
+def serve_feed(filename):
+    # precompressed variant of the feed the client accepts best (written when the feeds were generated)
+    encoding = flask.request.accept_encodings.best_match(feed_gen.feed_encodings + ['identity'], default='identity')
+    feed = None
+    if encoding != 'identity':
+        feed = feed_gen.get_feed(filename, encoding=encoding)
+    if feed is None:
+        encoding = 'identity'
+        feed = feed_gen.get_feed(filename)
+    if feed is None:
+        return "<error>Feed file not found. Please generate a feed first.</error>", {'Content-Type': 'application/xml'}
+
+    # unchanged feeds are answered with 304 Not Modified (If-None-Match / If-Modified-Since);
+    # each variant has its own ETag, as it's a different representation of the feed
+    if feed.path is not None:
+        # local file: sent from disk by the server (sendfile when available), with support for Range requests
+        response = flask.send_file(feed.path, mimetype='application/xml', download_name=filename, conditional=True, etag=feed.etag, last_modified=feed.modified_at)
+    else:
+        response = flask.Response(feed.content, content_type='application/xml')
+        response.set_etag(feed.etag)
+        if feed.modified_at is not None:
+            response.last_modified = feed.modified_at
+        response = response.make_conditional(flask.request)
+    if encoding != 'identity':
+        response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    return response
 
 if __name__ == "__main__":
     if len(sys.argv) > 1 and sys.argv[1] == "--generate-feed-locally":
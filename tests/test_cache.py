@@ -1,6 +1,8 @@
 import unittest
 import time
-from lightspeed_google_feed.cache import SimpleCache
+import threading
+from unittest.mock import patch
+from lightspeed_google_feed.cache import SimpleCache, LRUCache, CacheSweeper
 
 class TestLightspeedAPI(unittest.TestCase):
 
@@ -22,5 +24,145 @@ class TestLightspeedAPI(unittest.TestCase):
         time.sleep(2)
         self.assertIsNone(self.cache.get("test_another_key"))
 
+class TestLRUCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = LRUCache(max_entries=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        # "a" becomes the most recently used, so "b" is evicted
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get_stats()['evictions'], 1)
+
+    def test_per_key_ttl(self):
+        cache = LRUCache()
+        with patch('lightspeed_google_feed.cache.system_time.time', return_value=1000):
+            cache.set("short", 1, time=10)
+            cache.set("long", 2, time=100)
+        with patch('lightspeed_google_feed.cache.system_time.time', return_value=1050):
+            self.assertIsNone(cache.get("short"))
+            self.assertEqual(cache.get("long"), 2)
+
+    def test_stats(self):
+        cache = LRUCache()
+        cache.set("a", 1)
+        cache.get("a")
+        cache.get("a")
+        cache.get("b")
+        stats = cache.get_stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['entries'], 1)
+
+    def test_sweep_removes_expired_entries(self):
+        cache = LRUCache(sweep_interval=None)
+        with patch('lightspeed_google_feed.cache.system_time.time', return_value=1000):
+            cache.set("a", 1, time=10)
+            cache.set("b", 2, time=100)
+        with patch('lightspeed_google_feed.cache.system_time.time', return_value=1050):
+            self.assertEqual(cache.sweep(), 1)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get_stats()['expirations'], 1)
+
+    def test_background_sweep(self):
+        cache = LRUCache(sweep_interval=1)
+        cache.set("a", 1, time=0)
+        deadline = time.time() + 5
+        while len(cache) > 0 and time.time() < deadline:
+            time.sleep(0.1)
+        self.assertEqual(len(cache), 0)
+        self.assertTrue(CacheSweeper.thread.is_alive())
+
+    def test_concurrent_access(self):
+        cache = LRUCache(max_entries=50)
+        errors = []
+
+        def worker(n):
+            try:
+                for i in range(2000):
+                    key = f"key-{(n + i) % 100}"
+                    cache.set(key, i, time=0 if i % 3 == 0 else 60)
+                    cache.get(key)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(cache), 50)
+
+class TestGetOrCompute(unittest.TestCase):
+
+    def test_computes_once_and_caches(self):
+        cache = LRUCache()
+        calls = []
+        compute = lambda: calls.append(1) or "value"
+
+        self.assertEqual(cache.get_or_compute("key", compute, time=60), "value")
+        self.assertEqual(cache.get_or_compute("key", compute, time=60), "value")
+        self.assertEqual(len(calls), 1)
+
+    def test_concurrent_callers_share_one_computation(self):
+        cache = LRUCache()
+        calls = []
+        started = threading.Event()
+
+        def slow_compute():
+            calls.append(1)
+            started.set()
+            time.sleep(0.2)
+            return "catalog"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute("key", slow_compute, time=60))) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["catalog"] * 5)
+        self.assertEqual(cache.get_stats()['coalesced'] + cache.get_stats()['hits'], 4)
+
+    def test_errors_are_raised_to_all_callers_and_not_cached(self):
+        cache = LRUCache()
+
+        def failing_compute():
+            raise ValueError("API down")
+
+        with self.assertRaises(ValueError):
+            cache.get_or_compute("key", failing_compute)
+        self.assertIsNone(cache.get("key"))
+        self.assertEqual(cache.get_or_compute("key", lambda: "value"), "value")
+
+    def test_serve_stale_while_refreshing(self):
+        cache = LRUCache()
+        cache.set("key", "old", time=0, stale_time=60)
+        time.sleep(0.01)
+        refreshed = threading.Event()
+
+        def compute():
+            refreshed.wait(1)
+            return "new"
+
+        # the stale value is returned right away, the new one is computed in the background
+        self.assertEqual(cache.get_or_compute("key", compute, time=60, serve_stale=True, stale_time=60), "old")
+        refreshed.set()
+        deadline = time.time() + 2
+        while cache.get("key") != "new" and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(cache.get("key"), "new")
+        self.assertEqual(cache.get_stats()['stale_hits'], 1)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
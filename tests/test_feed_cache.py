@@ -0,0 +1,163 @@
+import os
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timezone
+from unittest.mock import patch, Mock
+from lightspeed_google_feed.storage import Storage
+from lightspeed_google_feed.feed_cache import FeedServingCache, CachedFeed
+
+class FakeStorage:
+    ''' In-memory storage (like Google Cloud Storage) that counts metadata lookups and downloads '''
+
+    cloud = True
+
+    def __init__(self):
+        self.files = {}
+        self.version_checks = 0
+        self.downloads = 0
+
+    def save(self, filename, content):
+        version = self.files[filename][1] + 1 if filename in self.files else 1
+        self.files[filename] = (content, version, datetime.now(timezone.utc))
+
+    def get_version(self, filename):
+        self.version_checks += 1
+        return self.files[filename][1] if filename in self.files else None
+
+    def read_versioned(self, filename):
+        self.downloads += 1
+        return self.files.get(filename, (None, None, None))
+
+class TestFeedServingCache(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = FakeStorage()
+        self.storage.save("feed.xml", b"<rss>v1</rss>")
+
+    def test_serves_from_memory_between_checks(self):
+        cache = FeedServingCache(self.storage, check_interval=60)
+        for i in range(10):
+            self.assertEqual(cache.get("feed.xml").content, b"<rss>v1</rss>")
+
+        self.assertEqual(self.storage.downloads, 1)
+        self.assertEqual(self.storage.version_checks, 0)
+
+    def test_downloads_again_only_when_version_changes(self):
+        cache = FeedServingCache(self.storage, check_interval=0)
+        cache.get("feed.xml")
+        cache.get("feed.xml")
+        self.assertEqual(self.storage.downloads, 1)
+        self.assertEqual(self.storage.version_checks, 1)
+
+        self.storage.save("feed.xml", b"<rss>v2</rss>")
+        self.assertEqual(cache.get("feed.xml").content, b"<rss>v2</rss>")
+        self.assertEqual(self.storage.downloads, 2)
+
+    def test_missing_feed(self):
+        cache = FeedServingCache(self.storage)
+        self.assertIsNone(cache.get("other_feed.xml"))
+
+    def test_invalidate(self):
+        cache = FeedServingCache(self.storage, check_interval=60)
+        cache.get("feed.xml")
+        self.storage.save("feed.xml", b"<rss>v2</rss>")
+        cache.invalidate("feed.xml")
+        self.assertEqual(cache.get("feed.xml").content, b"<rss>v2</rss>")
+
+    def test_retain(self):
+        cache = FeedServingCache(self.storage, check_interval=60)
+        self.storage.save("old_feed.xml", b"<rss>old</rss>")
+        cache.get("feed.xml")
+        cache.get("old_feed.xml")
+        cache.retain(["feed.xml", "new_feed.xml"])
+        self.assertEqual(cache.get_stats()['feeds'], 1)
+        self.assertEqual(list(cache.file_locks), ["feed.xml"])
+        self.assertEqual(cache.get("feed.xml").content, b"<rss>v1</rss>")
+        self.assertEqual(self.storage.downloads, 2)
+
+    def test_serves_cached_feed_when_storage_fails(self):
+        cache = FeedServingCache(self.storage, check_interval=0)
+        cache.get("feed.xml")
+        self.storage.get_version = Mock(side_effect=Exception("Cloud storage error"))
+        self.assertEqual(cache.get("feed.xml").content, b"<rss>v1</rss>")
+
+    def test_concurrent_requests_download_once(self):
+        cache = FeedServingCache(self.storage, check_interval=60)
+        threads = [threading.Thread(target=cache.get, args=("feed.xml",)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.storage.downloads, 1)
+
+class TestLocalZeroCopy(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.temp_dir.name, "feed.xml")
+        self.storage = Storage(cloud=False)
+        self.storage.save_stream(self.filename, ["<rss>v1</rss>"])
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_serves_local_file_from_disk(self):
+        cache = FeedServingCache(self.storage, check_interval=0)
+        self.assertTrue(cache.zero_copy)
+
+        feed = cache.get(self.filename)
+        self.assertIsNone(feed.content)
+        self.assertEqual(feed.path, self.filename)
+        # same validators as a feed kept in memory
+        self.assertEqual(feed.etag, CachedFeed(b"<rss>v1</rss>", None).etag)
+        self.assertIs(cache.get(self.filename), feed)
+
+        self.storage.save_stream(self.filename, ["<rss>version 2</rss>"])
+        self.assertEqual(cache.get(self.filename).etag, CachedFeed(b"<rss>version 2</rss>", None).etag)
+
+    def test_missing_local_file(self):
+        cache = FeedServingCache(self.storage)
+        self.assertIsNone(cache.get(os.path.join(self.temp_dir.name, "other_feed.xml")))
+
+    def test_zero_copy_disabled(self):
+        cache = FeedServingCache(self.storage, zero_copy=False)
+        self.assertEqual(cache.get(self.filename).content, b"<rss>v1</rss>")
+
+class TestStorageVersions(unittest.TestCase):
+
+    def test_local_versions(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            filename = os.path.join(temp_dir, "feed.xml")
+            storage = Storage(cloud=False)
+            self.assertIsNone(storage.get_version(filename))
+            self.assertEqual(storage.read_versioned(filename), (None, None, None))
+
+            storage.save_stream(filename, ["<rss>v1</rss>"])
+            content, version, modified_at = storage.read_versioned(filename)
+            self.assertEqual(content, b"<rss>v1</rss>")
+            self.assertEqual(storage.get_version(filename), version)
+            self.assertEqual(modified_at.tzinfo, timezone.utc)
+
+            storage.save_stream(filename, ["<rss>version 2</rss>"])
+            self.assertNotEqual(storage.get_version(filename), version)
+
+    @patch('lightspeed_google_feed.storage.storage')
+    def test_cloud_versions(self, mock_storage):
+        mock_bucket = mock_storage.Client.return_value.bucket.return_value
+        mock_blob = mock_bucket.get_blob.return_value
+        mock_blob.generation = 42
+        mock_blob.updated = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        mock_blob.download_as_bytes.return_value = b"<rss></rss>"
+
+        storage = Storage(cloud=True)
+        self.assertEqual(storage.get_version("feed.xml"), 42)
+        mock_bucket.get_blob.assert_called_once_with("feed.xml")
+        self.assertEqual(storage.read_versioned("feed.xml"), (b"<rss></rss>", 42, mock_blob.updated))
+
+        mock_bucket.get_blob.return_value = None
+        self.assertIsNone(storage.get_version("feed.xml"))
+        self.assertEqual(storage.read_versioned("feed.xml"), (None, None, None))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import io
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from lightspeed_google_feed.storage import Storage
+from lightspeed_google_feed.template_engine import TemplateEngine
+from lightspeed_google_feed.fragment_cache import FragmentCache, fingerprint
+
+TEMPLATE = ("{% block header %}<rss>{% endblock %}"
+            "{% for product in products %}{% block item scoped %}<item>{{ product.id }}:{{ product.title }}</item>{% endblock %}{% endfor %}"
+            "{% block footer %}</rss>{% endblock %}")
+
+class TestFragmentCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.templates_dir = os.path.join(self.temp_dir.name, 'templates')
+        os.makedirs(self.templates_dir)
+        self.write_template(TEMPLATE)
+        self.products = [{'id': i, 'title': f"Product {i}"} for i in range(5)]
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write_template(self, source):
+        path = os.path.join(self.templates_dir, 'TEMPLATE_test.xml')
+        mtime = os.path.getmtime(path) + 10 if os.path.exists(path) else None
+        with open(path, 'w') as f:
+            f.write(source)
+        if mtime is not None:
+            # edits are noticed by the template's modification time
+            os.utime(path, (mtime, mtime))
+
+    def create_cache(self, storage=None):
+        cache = FragmentCache(storage)
+        # persisted in the temporary directory
+        get_filename = cache.get_filename
+        cache.get_filename = lambda template_name: os.path.join(self.temp_dir.name, get_filename(template_name))
+        return cache
+
+    def render(self, engine, products):
+        writer = io.StringIO()
+        with patch.object(engine, '_render_block', wraps=engine._render_block) as mock_render_block:
+            engine.render_feeds([('TEMPLATE_test.xml', writer)], products)
+        items_rendered = len([call for call in mock_render_block.call_args_list if call.args[1] == 'item'])
+        return writer.getvalue(), items_rendered
+
+    def create_engine(self, fragment_cache):
+        return TemplateEngine(templates_dir=self.templates_dir, cache_dir=os.path.join(self.temp_dir.name, 'cache'), fragment_cache=fragment_cache)
+
+    def test_fingerprint(self):
+        self.assertEqual(fingerprint({'id': 1, 'images': ['a.jpg']}), fingerprint({'id': 1, 'images': ['a.jpg']}))
+        self.assertNotEqual(fingerprint({'id': 1, 'images': ['a.jpg']}), fingerprint({'id': 1, 'images': ['b.jpg']}))
+
+    def test_only_changed_items_are_rendered(self):
+        cache = self.create_cache()
+        engine = self.create_engine(cache)
+        output, items_rendered = self.render(engine, self.products)
+        self.assertEqual(items_rendered, 5)
+
+        output_again, items_rendered = self.render(engine, iter(self.products))
+        self.assertEqual(output_again, output)
+        self.assertEqual(items_rendered, 0)
+
+        self.products[2] = dict(self.products[2], title="Changed")
+        self.products.append({'id': 5, 'title': "New"})
+        output, items_rendered = self.render(engine, self.products)
+        self.assertEqual(items_rendered, 2)
+        self.assertEqual(output, self.create_engine(None).render('TEMPLATE_test.xml', self.products))
+        self.assertEqual(cache.get_stats()['fragments'], 6)
+
+        # fragments of items that are gone are dropped
+        self.render(engine, self.products[:1])
+        self.assertEqual(cache.get_stats()['fragments'], 1)
+
+    def test_template_edit_invalidates_fragments(self):
+        engine = self.create_engine(self.create_cache())
+        self.render(engine, self.products)
+
+        self.write_template(TEMPLATE.replace("<item>", "<entry>").replace("</item>", "</entry>"))
+        output, items_rendered = self.render(engine, self.products)
+        self.assertEqual(items_rendered, 5)
+        self.assertIn("<entry>0:Product 0</entry>", output)
+
+    def test_fragments_are_persisted(self):
+        storage = Storage(cloud=False)
+        output, items_rendered = self.render(self.create_engine(self.create_cache(storage)), self.products)
+
+        # a new instance starts with the fragments saved by the last refresh
+        new_output, items_rendered = self.render(self.create_engine(self.create_cache(storage)), self.products)
+        self.assertEqual(new_output, output)
+        self.assertEqual(items_rendered, 0)
+
+    def test_unreadable_persisted_fragments_are_ignored(self):
+        cache = self.create_cache(Storage(cloud=False))
+        with open(cache.get_filename('TEMPLATE_test.xml'), 'wb') as f:
+            f.write(b"LSGF-FRAGMENT-CACHE 1\nnot gzip")
+
+        output, items_rendered = self.render(self.create_engine(cache), self.products)
+        self.assertEqual(items_rendered, 5)
+
+if __name__ == '__main__':
+    unittest.main()
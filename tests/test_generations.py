@@ -0,0 +1,114 @@
+import json
+import unittest
+from lightspeed_google_feed.storage import Storage
+from lightspeed_google_feed.generations import FeedGenerations
+from tests.test_storage import FakeGCSClient
+
+class TestFeedGenerations(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = Storage(cloud=True, client=FakeGCSClient())
+        self.generations = FeedGenerations(self.storage, keep=2, check_interval=0)
+
+    def publish(self, content):
+        generation_id = self.generations.new_generation_id()
+        files = {}
+        for feed_filename in ["feed_1.xml", "feed_2.xml"]:
+            path = self.generations.get_path(generation_id, feed_filename)
+            self.storage.save_stream(path, [content], encodings=['gzip'])
+            files[feed_filename] = {'path': path, 'size': len(content), 'variants': {'gzip': f"{path}.gz"}}
+        self.generations.publish(generation_id, files)
+        return generation_id
+
+    def read(self, filename, encoding=None):
+        return self.storage.read_bytes(self.generations.resolve(filename, encoding))
+
+    def test_plain_files_before_first_generation(self):
+        self.assertIsNone(self.generations.get_current())
+        self.assertEqual(self.generations.resolve("feed_1.xml"), "feed_1.xml")
+        self.assertEqual(self.generations.resolve("feed_1.xml", 'gzip'), "feed_1.xml.gz")
+
+    def test_publish(self):
+        first_id = self.publish("<rss>1</rss>")
+        self.assertEqual(self.read("feed_1.xml"), b"<rss>1</rss>")
+        self.assertEqual(self.generations.resolve("feed_1.xml", 'gzip'), f"generations/{first_id}/feed_1.xml.gz")
+        self.assertIsNone(self.generations.resolve("other_feed.xml"))
+
+        # readers switch to the new generation (both feeds at once) only when it's published
+        second_id = self.generations.new_generation_id()
+        self.storage.save_stream(self.generations.get_path(second_id, "feed_1.xml"), ["<rss>2</rss>"])
+        self.assertEqual(self.read("feed_1.xml"), b"<rss>1</rss>")
+
+        manifest = json.loads(self.storage.read_bytes(FeedGenerations.MANIFEST_FILENAME))
+        self.assertEqual(manifest['current'], first_id)
+        self.assertEqual(manifest['generations'][0]['files']['feed_2.xml']['size'], len("<rss>1</rss>"))
+
+    def test_old_generations_are_pruned(self):
+        first_id = self.publish("<rss>1</rss>")
+        second_id = self.publish("<rss>2</rss>")
+        third_id = self.publish("<rss>3</rss>")
+
+        self.assertEqual([generation['id'] for generation in self.generations.get_manifest()['generations']], [third_id, second_id])
+        objects = self.storage.get_bucket().objects
+        self.assertFalse([name for name in objects if first_id in name])
+        self.assertEqual(len([name for name in objects if second_id in name]), 4)
+
+    def test_files_shared_with_kept_generations_are_not_pruned(self):
+        first_id = self.publish("<rss>1</rss>")
+        # feed_2 didn't change in the next generations: they refer to the first generation's files
+        unchanged_feed = self.generations.get_current()['files']['feed_2.xml']
+        for content in ["<rss>2</rss>", "<rss>3</rss>"]:
+            generation_id = self.generations.new_generation_id()
+            path = self.generations.get_path(generation_id, "feed_1.xml")
+            self.storage.save_stream(path, [content])
+            self.generations.publish(generation_id, {'feed_1.xml': {'path': path, 'size': len(content), 'variants': {}}, 'feed_2.xml': unchanged_feed})
+
+        objects = self.storage.get_bucket().objects
+        self.assertEqual(sorted(name for name in objects if first_id in name), [unchanged_feed['path'], unchanged_feed['variants']['gzip']])
+        self.assertEqual(self.read("feed_2.xml"), b"<rss>1</rss>")
+
+    def test_update_sources(self):
+        generation_id = self.publish("<rss>1</rss>")
+        self.assertNotIn('sources', self.generations.get_current())
+
+        self.generations.update_sources(generation_id, {'catalog_synced_at': 1.5})
+        other_instance = FeedGenerations(self.storage, check_interval=0)
+        self.assertEqual(other_instance.get_current()['sources'], {'catalog_synced_at': 1.5})
+        with self.assertRaises(ValueError):
+            self.generations.update_sources("unknown", {})
+
+    def test_rollback(self):
+        first_id = self.publish("<rss>1</rss>")
+        second_id = self.publish("<rss>2</rss>")
+
+        self.assertEqual(self.generations.rollback()['id'], first_id)
+        self.assertEqual(self.read("feed_2.xml"), b"<rss>1</rss>")
+        with self.assertRaises(ValueError):
+            self.generations.rollback()
+
+        self.assertEqual(self.generations.rollback(second_id)['id'], second_id)
+        self.assertEqual(self.read("feed_2.xml", 'gzip'), self.storage.read_bytes(f"generations/{second_id}/feed_2.xml.gz"))
+        with self.assertRaises(ValueError):
+            self.generations.rollback("unknown")
+
+    def test_rolled_back_generation_is_kept(self):
+        first_id = self.publish("<rss>1</rss>")
+        self.publish("<rss>2</rss>")
+        self.generations.rollback(first_id)
+        third_id = self.publish("<rss>3</rss>")
+
+        self.assertEqual([generation['id'] for generation in self.generations.get_manifest()['generations']][0], third_id)
+        self.assertEqual(self.read("feed_1.xml"), b"<rss>3</rss>")
+
+    def test_other_instances_see_published_generation(self):
+        other_instance = FeedGenerations(self.storage, check_interval=60)
+        self.assertIsNone(other_instance.get_current())
+
+        generation_id = self.publish("<rss>1</rss>")
+        # until the next check, the manifest it has is used
+        self.assertIsNone(other_instance.get_current())
+        other_instance.manifest_checked_at = 0
+        self.assertEqual(other_instance.get_current()['id'], generation_id)
+
+if __name__ == '__main__':
+    unittest.main()
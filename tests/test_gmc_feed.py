@@ -1,35 +1,57 @@
+import io
+import os
+import glob
+import shutil
+import json
+import tempfile
 import unittest
 from unittest.mock import patch, Mock
-from lightspeed_google_feed.gmc_feed import GMCFeedGenerator, GMCFeedProduct, GMCFeedProductFromLightspeed, GMCFeedProductFromEcwid
+from lightspeed_google_feed.config import SHOP
+from lightspeed_google_feed.xml_engine import XMLFeedEngine
+from lightspeed_google_feed.template_engine import TemplateEngine
+from lightspeed_google_feed.gmc_feed import GMCFeedGenerator, FeedDigestWriter, GMCFeedTemplateData, GMCFeedProduct, GMCFeedProductFromLightspeed, GMCFeedProductFromEcwid, CategoryIndex
 
 class TestGMCFeedGenerator(unittest.TestCase):
     
     def setUp(self):
         """Set up test fixtures before each test method."""
+        # every test starts without a catalog snapshot (or rendered items, or feeds) from a previous one
+        self._remove_persisted_caches()
         self.feed_gen = GMCFeedGenerator(api_type="LS")
-        self.count_response = Mock()
-        self.count_response.json.return_value =  eval('{"count": 1}')
         self.catalog_response_fox_ranger_glove = Mock()
         self.catalog_response_yeti_160e_c2 = Mock()
         
         with open('tests/mock_api_responses/catalog_65626325_fox-ranger-glove.json') as f:
             self.catalog_response_fox_ranger_glove.json.return_value = eval(f.read().replace('true', 'True').replace('false', 'False').replace('null', 'None'))
         
-        with open('tests/mock_api_responses/catalog_65725829_Yeti-Cycles-160E-C2.json') as f:
+        with open('tests/mock_api_responses/catalog_65725829_yeti-cycles-160E-C2.json') as f:
             self.catalog_response_yeti_160e_c2.json.return_value = eval(f.read().replace('true', 'True').replace('false', 'False').replace('null', 'None'))
         
     def tearDown(self):
         """Clean up after each test method."""
-        pass
-    
-    @patch('lightspeed_google_feed.lightspeed.requests')
-    def test_refresh_feed_files(self, mock_requests):
-        mock_requests.get.side_effect = [self.count_response, self.catalog_response_fox_ranger_glove]
+        self._remove_persisted_caches()
 
-        # Execute and check mock requests were called only twice
-        self.feed_gen.refresh_feed_files()
-        self.assertEqual(mock_requests.get.call_count, 2)
+    def _remove_persisted_caches(self):
+        for filename in ['catalog_snapshot_ls.json.gz', 'feeds_manifest.json'] + glob.glob('fragment_cache_*.json.gz'):
+            if os.path.exists(filename):
+                os.remove(filename)
+        shutil.rmtree('generations', ignore_errors=True)
+    
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_refresh_feed_files(self, mock_get):
+        mock_get.side_effect = [self.catalog_response_fox_ranger_glove]
+
+        # Execute and check mock requests were called only once (single page catalog)
+        progress = {}
+        self.feed_gen.refresh_feed_files(progress=lambda stage=None, **counters: progress.update(counters, stage=stage or progress.get('stage')))
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(progress, {'stage': 'publishing', 'pages_fetched': 1, 'products_fetched': 1, 'products_visible': 1, 'items_total': 7, 'items_rendered': 7})
         
+        # Both feeds were published together as the current generation
+        generation = self.feed_gen.generations.get_current()
+        self.assertEqual(sorted(generation['files']), sorted([self.feed_gen.SHOPPING_ONLINE_INVENTORY_FEED_FILENAME, self.feed_gen.LOCAL_LISTINGS_FEED_FILENAME]))
+        self.assertTrue(all(feed['size'] > 0 for feed in generation['files'].values()))
+
         # Read and verify shopping online inventory feed file
         shopping_online_feed = self.feed_gen.read_feed_file(self.feed_gen.SHOPPING_ONLINE_INVENTORY_FEED_FILENAME)
         # Count number of <item> tags in the feed
@@ -42,9 +64,223 @@ class TestGMCFeedGenerator(unittest.TestCase):
         item_count = local_listings_feed.count('<item>')
         self.assertEqual(item_count, 7, "Expected 7 items in local listings feed")
     
-    @patch('lightspeed_google_feed.lightspeed.requests')
-    def test_prepare_template_data_basic(self, mock_requests):
-        mock_requests.get.side_effect = [self.count_response, self.catalog_response_fox_ranger_glove]
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_refresh_feed_files_saves_item_index(self, mock_get):
+        mock_get.side_effect = [self.catalog_response_fox_ranger_glove]
+        self.feed_gen.refresh_feed_files()
+
+        for feed in self.feed_gen.generations.get_current()['files'].values():
+            with open(feed['index']) as f:
+                index = json.load(f)
+            with open(feed['path'], 'rb') as f:
+                content = f.read()
+            self.assertEqual(index['size'], len(content))
+            self.assertEqual(len(index['items']), 7)
+            for item_id, start, end, item_group_id in index['items']:
+                fragment = content[start:end].decode('utf-8')
+                self.assertEqual(fragment.strip()[:6], "<item>")
+                self.assertIn(f"<g:id>{item_id}</g:id>", fragment)
+                self.assertEqual(item_group_id, 65626325)
+
+    @patch('lightspeed_google_feed.gmc_feed.PATCH_MAX_CHANGES', 0.5)
+    @patch.object(TemplateEngine, '_get_formatted_date', return_value='2025-01-01 00:00:00 PST')
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_patch_feed_files(self, mock_get, mock_date):
+        mock_get.side_effect = [self.catalog_response_fox_ranger_glove]
+        self.feed_gen.refresh_feed_files()
+        previous_generation = self.feed_gen.generations.get_current()
+        items = self.feed_gen.template_data.prepare_template_data(self.feed_gen.lightspeed_api.get_all_visible_products())
+
+        # one item out of stock, one removed and a new one
+        changed_item = dict(items[3], stock_level=0, available=False, pickup_SLA="multi-week")
+        new_item = dict(items[0], id="65626325_1")
+        self.feed_gen.template_data.normalize_item(new_item)
+        with patch.object(self.feed_gen, 'refresh_feed_files') as mock_refresh, \
+             patch.object(self.feed_gen.template_engine, '_render_block', wraps=self.feed_gen.template_engine._render_block) as mock_render_block:
+            result = self.feed_gen.patch_feed_files([changed_item, new_item], removed_item_ids=[items[5]['id']])
+        mock_refresh.assert_not_called()
+        generation = result['generation']
+        # only the changed items were rendered (with each feed's header and footer)
+        self.assertEqual(mock_render_block.call_count, 2 * 4)
+
+        self.assertNotEqual(generation['id'], previous_generation['id'])
+        self.assertEqual(self.feed_gen.generations.get_current()['id'], generation['id'])
+        expected_items = items[:3] + [changed_item, items[4], items[6], new_item]
+        for template_filename, feed_filename in self.feed_gen.feeds:
+            expected = io.StringIO()
+            self.feed_gen.template_engine.render_feeds([(template_filename, expected)], expected_items)
+            self.assertEqual(self.feed_gen.read_feed_file(feed_filename), expected.getvalue())
+            with open(generation['files'][feed_filename]['index']) as f:
+                self.assertEqual([item[0] for item in json.load(f)['items']], [item['id'] for item in expected_items])
+
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_unchanged_feeds_are_not_published_again(self, mock_get):
+        mock_get.side_effect = [self.catalog_response_fox_ranger_glove] * 3
+        result = self.feed_gen.refresh_feed_files()
+        self.assertEqual(result['published'], [self.feed_gen.SHOPPING_ONLINE_INVENTORY_FEED_FILENAME, self.feed_gen.LOCAL_LISTINGS_FEED_FILENAME])
+        first_generation = result['generation']
+        self.assertTrue(all(feed['digest'] for feed in first_generation['files'].values()))
+
+        # same catalog (only the generation date in the feeds changes): nothing is saved or published
+        with patch.object(TemplateEngine, '_get_formatted_date', return_value='2030-01-01 00:00:00 PST'):
+            result = self.feed_gen.refresh_feed_files()
+        self.assertEqual(result, {'generation': None, 'published': [], 'unchanged': [self.feed_gen.SHOPPING_ONLINE_INVENTORY_FEED_FILENAME, self.feed_gen.LOCAL_LISTINGS_FEED_FILENAME]})
+        self.assertEqual(self.feed_gen.generations.get_current()['id'], first_generation['id'])
+        self.assertEqual(os.listdir('generations'), [first_generation['id']])
+
+        # a change only in the shopping feed (the title isn't in the local listings feed): only that feed is published
+        self.catalog_response_fox_ranger_glove.json.return_value['products'][0]['fulltitle'] += " (new)"
+        result = self.feed_gen.refresh_feed_files()
+        self.assertEqual(result['published'], [self.feed_gen.SHOPPING_ONLINE_INVENTORY_FEED_FILENAME])
+        self.assertEqual(result['unchanged'], [self.feed_gen.LOCAL_LISTINGS_FEED_FILENAME])
+        files = result['generation']['files']
+        self.assertEqual(files[self.feed_gen.LOCAL_LISTINGS_FEED_FILENAME], first_generation['files'][self.feed_gen.LOCAL_LISTINGS_FEED_FILENAME])
+        self.assertIn("(new)", self.feed_gen.read_feed_file(self.feed_gen.SHOPPING_ONLINE_INVENTORY_FEED_FILENAME))
+        self.assertEqual(self.feed_gen.read_feed_file(self.feed_gen.LOCAL_LISTINGS_FEED_FILENAME).count('<item>'), 7)
+
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_feeds_of_old_generations_are_not_kept_in_serving_cache(self, mock_get):
+        mock_get.side_effect = [self.catalog_response_fox_ranger_glove] * 3
+        # another instance, serving the feeds this one publishes
+        other_instance = GMCFeedGenerator(api_type="LS")
+        other_instance.generations.check_interval = 0
+        for i in range(3):
+            self.catalog_response_fox_ranger_glove.json.return_value['products'][0]['fulltitle'] += f" {i}"
+            self.feed_gen.refresh_feed_files()
+            feed = other_instance.get_feed(self.feed_gen.SHOPPING_ONLINE_INVENTORY_FEED_FILENAME)
+            with open(feed.path) as f:
+                self.assertIn(f" {i}", f.read())
+
+        current_paths = self.feed_gen.generations.get_paths(self.feed_gen.generations.get_current())
+        self.assertEqual(len(other_instance.feed_cache.feeds), 1)
+        self.assertLessEqual(set(other_instance.feed_cache.feeds), current_paths)
+
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_patch_feed_files_falls_back_to_full_refresh(self, mock_get):
+        with patch.object(self.feed_gen, 'refresh_feed_files') as mock_refresh:
+            # nothing to patch yet
+            self.feed_gen.patch_feed_files([])
+            mock_refresh.assert_called_once()
+
+        mock_get.side_effect = [self.catalog_response_fox_ranger_glove]
+        self.feed_gen.refresh_feed_files()
+        items = self.feed_gen.template_data.prepare_template_data(self.feed_gen.lightspeed_api.get_all_visible_products())
+        with patch.object(self.feed_gen, 'refresh_feed_files') as mock_refresh:
+            # too many changes
+            self.feed_gen.patch_feed_files(items[:2])
+            mock_refresh.assert_called_once()
+
+    @patch('lightspeed_google_feed.gmc_feed.PATCH_MAX_CHANGES', 1.0)
+    @patch.object(TemplateEngine, '_get_formatted_date', return_value='2025-01-01 00:00:00 PST')
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_refresh_feed_files_patches_feeds_after_delta_sync(self, mock_get, mock_date):
+        mock_get.side_effect = [self.catalog_response_fox_ranger_glove] * 2
+        self.feed_gen.refresh_feed_files()
+
+        # a variant out of stock and another one gone, synced as a delta
+        variants = self.catalog_response_fox_ranger_glove.json.return_value['products'][0]['variants']
+        variants['110095787']['stockLevel'] = 0
+        del variants['110095779']
+        self.feed_gen.lightspeed_api.lightspeed_api.cache.clear()
+        with patch.object(self.feed_gen.template_engine, 'render_feeds') as mock_render_feeds, \
+             patch.object(self.feed_gen.storage, 'read_bytes', wraps=self.feed_gen.storage.read_bytes) as mock_read_bytes:
+            result = self.feed_gen.refresh_feed_files()
+        self.assertEqual(self.feed_gen.lightspeed_api.get_last_changes()['updated'], [65626325])
+        mock_render_feeds.assert_not_called()
+        # unchanged items are streamed from the current feeds, not read whole
+        self.assertFalse([call for call in mock_read_bytes.call_args_list if not call.args[0].endswith('.index.json')])
+
+        expected_items = self.feed_gen.template_data.prepare_template_data(self.feed_gen.lightspeed_api.get_all_visible_products())
+        self.assertEqual(len(expected_items), 6)
+        for template_filename, feed_filename in self.feed_gen.feeds:
+            expected = io.StringIO()
+            self.feed_gen.template_engine.render_feeds([(template_filename, expected)], expected_items)
+            self.assertEqual(self.feed_gen.read_feed_file(feed_filename), expected.getvalue())
+        self.assertEqual(result['generation']['sources']['catalog_synced_at'], self.feed_gen.lightspeed_api.get_last_changes()['synced_at'])
+
+    @patch('lightspeed_google_feed.gmc_feed.PATCH_MAX_CHANGES', 1.0)
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_refresh_feed_files_generates_feeds_again_after_full_sync_or_template_change(self, mock_get):
+        mock_get.side_effect = [self.catalog_response_fox_ranger_glove] * 4
+        self.feed_gen.refresh_feed_files()
+        variants = self.catalog_response_fox_ranger_glove.json.return_value['products'][0]['variants']
+
+        def refresh(stock_level):
+            variants['110095787']['stockLevel'] = stock_level
+            self.feed_gen.lightspeed_api.lightspeed_api.cache.clear()
+            with patch.object(self.feed_gen.template_engine, 'render_feeds', wraps=self.feed_gen.template_engine.render_feeds) as mock_render_feeds:
+                self.feed_gen.refresh_feed_files()
+            return mock_render_feeds.called
+
+        # full sync
+        with patch('lightspeed_google_feed.lightspeed.FULL_SYNC_INTERVAL', 0):
+            self.assertTrue(refresh(0))
+        # template change
+        with patch.object(TemplateEngine, '_get_template_hash', return_value="changed"):
+            self.assertTrue(refresh(1))
+            # a delta from the catalog (and templates) of the current feeds patches them
+            self.assertFalse(refresh(2))
+        self.assertIn("<g:quantity>2</g:quantity>", self.feed_gen.read_feed_file(self.feed_gen.LOCAL_LISTINGS_FEED_FILENAME))
+
+    @patch('lightspeed_google_feed.gmc_feed.PATCH_MAX_CHANGES', 1.0)
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_patched_feeds_are_unchanged_after_full_sync(self, mock_get):
+        fox_ranger_glove = self.catalog_response_fox_ranger_glove.json.return_value['products'][0]
+        yeti_160e_c2 = self.catalog_response_yeti_160e_c2.json.return_value['products'][0]
+        mock_get.side_effect = [self.catalog_response_yeti_160e_c2, self.catalog_response_fox_ranger_glove, self.catalog_response_yeti_160e_c2]
+        # the first sync doesn't have the glove: the delta adds it to the feeds
+        self.feed_gen.refresh_feed_files()
+        self.feed_gen.lightspeed_api.lightspeed_api.cache.clear()
+        with patch.object(self.feed_gen.template_engine, 'render_feeds') as mock_render_feeds:
+            result = self.feed_gen.refresh_feed_files()
+        mock_render_feeds.assert_not_called()
+        self.assertEqual(len(result['published']), 2)
+
+        # a full sync lists the glove first: same feeds in another order, nothing to publish
+        self.catalog_response_yeti_160e_c2.json.return_value['products'] = [fox_ranger_glove, yeti_160e_c2]
+        self.feed_gen.lightspeed_api.lightspeed_api.cache.clear()
+        with patch('lightspeed_google_feed.lightspeed.FULL_SYNC_INTERVAL', 0):
+            result = self.feed_gen.refresh_feed_files()
+        self.assertEqual(result['published'], [])
+
+    @patch('lightspeed_google_feed.gmc_feed.PATCH_MAX_CHANGES', 1.0)
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_feeds_with_templates_without_blocks_are_generated_again(self, mock_get):
+        mock_get.side_effect = [self.catalog_response_fox_ranger_glove] * 2
+        templates_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, templates_dir)
+        with open(os.path.join(templates_dir, 'TEMPLATE_plain.xml'), 'w') as f:
+            f.write("<rss>{% for product in products %}<item><g:id>{{ product.id }}</g:id><g:quantity>{{ product.stock_level }}</g:quantity></item>{% endfor %}</rss>")
+        self.feed_gen.template_engine.env.loader.searchpath.append(templates_dir)
+        self.feed_gen.register_feed('TEMPLATE_plain.xml', 'plain_feed.xml')
+        self.feed_gen.refresh_feed_files()
+
+        # a delta sync can't patch the plain feed (it has no item index): all feeds are generated again
+        self.catalog_response_fox_ranger_glove.json.return_value['products'][0]['variants']['110095787']['stockLevel'] = 42
+        self.feed_gen.lightspeed_api.lightspeed_api.cache.clear()
+        result = self.feed_gen.refresh_feed_files()
+        self.assertIn('plain_feed.xml', result['published'])
+        plain_feed = self.feed_gen.read_feed_file('plain_feed.xml')
+        self.assertEqual(plain_feed.count('<item>'), 7)
+        self.assertIn("<g:quantity>42</g:quantity>", plain_feed)
+
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_refresh_feed_files_with_xml_engine(self, mock_get):
+        mock_get.side_effect = [self.catalog_response_fox_ranger_glove]
+        feed_gen = GMCFeedGenerator(api_type="LS", feed_engine="xml")
+        self.assertIsInstance(feed_gen.template_engine, XMLFeedEngine)
+
+        feed_gen.refresh_feed_files()
+        shopping_online_feed = feed_gen.read_feed_file(feed_gen.SHOPPING_ONLINE_INVENTORY_FEED_FILENAME)
+        self.assertEqual(shopping_online_feed.count('<item>'), 7)
+        self.assertNotIn('\n', shopping_online_feed.split('<rss', 1)[1])
+
+        with self.assertRaises(ValueError):
+            GMCFeedGenerator(api_type="LS", feed_engine="other")
+
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_prepare_template_data_basic(self, mock_get):
+        mock_get.side_effect = [self.catalog_response_fox_ranger_glove]
 
         products = self.feed_gen.lightspeed_api.get_all_visible_products()
         products_for_template = self.feed_gen.template_data.prepare_template_data(products)
@@ -59,9 +295,9 @@ class TestGMCFeedGenerator(unittest.TestCase):
             for key in product_expected_keys:
                 self.assertIn(key, product)
     
-    @patch('lightspeed_google_feed.lightspeed.requests')
-    def test_prepare_template_data_title_and_size_conversions(self, mock_requests):
-        mock_requests.get.side_effect = [self.count_response, self.catalog_response_fox_ranger_glove]
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_prepare_template_data_title_and_size_conversions(self, mock_get):
+        mock_get.side_effect = [self.catalog_response_fox_ranger_glove]
         products = self.feed_gen.lightspeed_api.get_all_visible_products()
         products_for_template = self.feed_gen.template_data.prepare_template_data(products)
 
@@ -90,9 +326,9 @@ class TestGMCFeedGenerator(unittest.TestCase):
                 self.assertEqual("XL", product['size'])
                 self.assertEqual("hunter green", product['color'])
     
-    @patch('lightspeed_google_feed.lightspeed.requests')
-    def test_prepare_template_data_with_backordered_products(self, mock_requests):
-        mock_requests.get.side_effect = [self.count_response, self.catalog_response_yeti_160e_c2]
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_prepare_template_data_with_backordered_products(self, mock_get):
+        mock_get.side_effect = [self.catalog_response_yeti_160e_c2]
         products = self.feed_gen.lightspeed_api.get_all_visible_products()
         products_for_template = self.feed_gen.template_data.prepare_template_data(products)
 
@@ -108,6 +344,133 @@ class TestGMCFeedGenerator(unittest.TestCase):
                 self.assertEqual("rhino", product['color'])
                 self.assertEqual(1, product['stock_level'])
 
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_prepare_template_data_shares_product_data(self, mock_get):
+        mock_get.side_effect = [self.catalog_response_fox_ranger_glove]
+        products = self.feed_gen.lightspeed_api.get_all_visible_products()
+        products_for_template = self.feed_gen.template_data.prepare_template_data(products)
+
+        # computed once per product and shared by all its variants
+        self.assertTrue(all(product['images'] is products_for_template[0]['images'] for product in products_for_template))
+        self.assertTrue(all(product['categories'] is products_for_template[0]['categories'] for product in products_for_template))
+
+    def test_prepare_template_data_from_ecwid(self):
+        product = {
+            'id': 1,
+            'autogeneratedSlug': 'ranger-glove',
+            'url': 'https://yourstore.com/ranger-glove',
+            'weight': 100,
+            'name': 'Ranger Glove',
+            'description': '<p>Glove for <b>youth</b> riders</p>',
+            'media': {'images': [{'imageOriginalUrl': 'b.jpg', 'orderBy': 2}, {'imageOriginalUrl': 'a.jpg', 'orderBy': 1}]},
+            'attributes': [{'name': 'Brand', 'value': 'Fox'}],
+            'categories': [{'name': 'Gloves', 'enabled': True}],
+            'combinations': [
+                {'id': variant_id, 'quantity': 1, 'sku': f"SKU{variant_id}", 'defaultDisplayedPrice': 30, 'options': [{'name': 'Size', 'value': size}]}
+                for variant_id, size in [(10, 'Small'), (11, 'Large')]
+            ]
+        }
+        products_for_template = GMCFeedTemplateData(api_type="ECWID").prepare_template_data([product])
+
+        self.assertEqual([p['fulltitle'] for p in products_for_template], ["Fox Ranger Glove (Small)", "Fox Ranger Glove (Large)"])
+        self.assertEqual(products_for_template[0]['description'], "Glove for youth riders")
+        self.assertEqual(products_for_template[1]['age_group'], "kids")
+        self.assertEqual(products_for_template[0]['images'], ['a.jpg', 'b.jpg'])
+        self.assertIs(products_for_template[0]['images'], products_for_template[1]['images'])
+        self.assertIs(products_for_template[0]['categories'], products_for_template[1]['categories'])
+        # Ecwid category trees end with None
+        self.assertEqual(products_for_template[0]['gmc']['product_type'], "<![CDATA[ Gloves ]]>")
+
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_prepare_template_data_normalizes_items(self, mock_get):
+        mock_get.side_effect = [self.catalog_response_fox_ranger_glove]
+        products = self.feed_gen.lightspeed_api.get_all_visible_products()
+        products_for_template = self.feed_gen.template_data.prepare_template_data(products)
+
+        gmc = products_for_template[0]['gmc']
+        self.assertEqual(gmc['price'], f"29.95 {SHOP['currency'].upper()}")
+        self.assertIsNone(gmc['sale_price'])
+        self.assertEqual(gmc['link'], f"{SHOP['domain']}ranger-glove.html?source=googlebase")
+        self.assertTrue(gmc['image_link'].endswith("/67984977/image.jpg"))
+        self.assertEqual(len(gmc['additional_image_links']), 3)
+        self.assertEqual(gmc['product_type'], "<![CDATA[ Men > MTB gear > Gloves ]]>")
+        self.assertEqual(gmc['brand'], "<![CDATA[ Fox ]]>")
+        self.assertEqual(gmc['gtin'], "<![CDATA[ 191972896095 ]]>")
+        # normalised once per product, shared by all its variants
+        self.assertTrue(all(product['gmc']['product_type'] is gmc['product_type'] for product in products_for_template))
+
+    def test_normalize_item(self):
+        item = {
+            'id': '1_2', 'url': SHOP['domain'].replace('https://', 'http://') + '/bike.html', 'fulltitle': 'Bike', 'description': '',
+            'images': [f"https://cdn.com/{i}/file.jpg" for i in range(12)],
+            'categories': [{'title': 'Bikes', 'subs': [
+                {'title': 'MTB', 'subs': [{'title': 'Enduro', 'subs': []}, {'title': 'Trail', 'subs': []}]},
+                {'title': 'Road', 'subs': []},
+                {'title': 'Gravel', 'subs': []}
+            ]}, {'title': 'Sale', 'subs': []}],
+            'price': {'price_incl': '1,299.9', 'price_old_incl': 1500},
+            'brand': None, 'ean': None, 'code': 'ABC'
+        }
+        gmc = GMCFeedTemplateData(api_type="LS").normalize_item(item)['gmc']
+
+        currency = SHOP['currency'].upper()
+        self.assertEqual(gmc['price'], f"1500.00 {currency}")
+        self.assertEqual(gmc['sale_price'], f"1299.90 {currency}")
+        self.assertEqual(gmc['link'], f"{SHOP['domain']}/bike.html?source=googlebase")
+        self.assertEqual(gmc['image_link'], "https://cdn.com/0/image.jpg")
+        self.assertEqual(gmc['additional_image_links'], [f"https://cdn.com/{i}/image.jpg" for i in range(1, 10)])
+        self.assertEqual(gmc['product_type'], "<![CDATA[ Bikes > MTB > Enduro > Trail > Road ]]>")
+        self.assertEqual(gmc['description'], "")
+        self.assertIsNone(gmc['brand'])
+        self.assertIsNone(gmc['gtin'])
+        self.assertEqual(gmc['mpn'], "<![CDATA[ ABC ]]>")
+
+class TestFeedDigestWriter(unittest.TestCase):
+
+    def digest(self, chunks):
+        writer = FeedDigestWriter(io.StringIO())
+        for chunk in chunks:
+            writer.write(chunk)
+        return writer.hexdigest()
+
+    def test_comments_are_left_out(self):
+        expected = self.digest(["<rss><item>1</item></rss>"])
+        self.assertEqual(self.digest(["<rss><!-- generated on 2025-01-01 -->", "<item>1</item></rss>"]), expected)
+        # comments split across writes, anywhere
+        self.assertEqual(self.digest(["<rss><!", "-- generated on ", "2025-01-02", " -", "->", "<item>1</item></rss>"]), expected)
+        self.assertNotEqual(self.digest(["<rss><item>2</item></rss>"]), expected)
+        # text that looks like the start of a comment is content
+        self.assertNotEqual(self.digest(["<rss><!", "<item>1</item></rss>"]), expected)
+
+    def test_item_order_is_left_out(self):
+        def digest(items):
+            writer = FeedDigestWriter(Mock())
+            writer.write("<rss>")
+            for item in items:
+                writer.write_item(item, f"<item>{item}</item>")
+            writer.write("</rss>")
+            return writer.hexdigest()
+
+        self.assertEqual(digest(["1", "2", "3"]), digest(["3", "1", "2"]))
+        self.assertNotEqual(digest(["1", "2", "3"]), digest(["1", "2", "4"]))
+        self.assertNotEqual(digest(["1", "2"]), digest(["1", "2", "2"]))
+
+    def test_templates_without_blocks(self):
+        """Test that feeds rendered chunk by chunk (templates without blocks) get the same digest on every run"""
+        with tempfile.TemporaryDirectory() as templates_dir:
+            with open(os.path.join(templates_dir, 'TEMPLATE_plain.xml'), 'w') as f:
+                f.write("<rss>\n<!-- generated on {{ date }} -->\n{% for product in products %}<item>{{ product.id }}</item>{% endfor %}</rss>")
+            engine = TemplateEngine(templates_dir=templates_dir, cache_dir=os.path.join(templates_dir, 'cache'))
+
+            digests = []
+            for date in ['2025-01-01 00:00:00 PST', '2025-01-02 00:00:00 PST']:
+                writer = FeedDigestWriter(io.StringIO())
+                with patch.object(engine, '_get_formatted_date', return_value=date):
+                    engine.render_feeds([('TEMPLATE_plain.xml', writer)], [{'id': 1}, {'id': 2}])
+                self.assertIn(date, writer.writer.getvalue())
+                digests.append(writer.hexdigest())
+            self.assertEqual(digests[0], digests[1])
+
 class TestGMCFeedProduct(unittest.TestCase):
 
     def test_default_weight(self):
@@ -132,6 +495,47 @@ class TestGMCFeedProduct(unittest.TestCase):
         product.set_title("Fox Ranger Glove Youth")
         self.assertEqual(product.get_age_group(), "kids", "Expected age group to be kids")
 
+    def test_memoized_getters(self):
+        product = GMCFeedProductFromLightspeed(id="123", variant_id="456")
+        product.set_title("Fox Ranger Glove")
+
+        product.get_template_data()
+        # used by get_template_data, get_gender and get_age_group, but computed once (not from the attributes every time)
+        product.title = "Changed without a setter"
+        self.assertEqual(product.get_fulltitle(), "Fox Ranger Glove")
+
+        # setters invalidate what was computed
+        product.set_brand_title("Fox Racing")
+        self.assertEqual(product.get_fulltitle(), "Fox Racing Changed without a setter")
+        product.set_title("Ranger Glove Women")
+        self.assertEqual(product.get_gender(), "female")
+
+    def test_setters_invalidate_values_shared_per_product(self):
+        product_cache = {}
+        product = GMCFeedProductFromLightspeed(id="123", variant_id="456", product_cache=product_cache)
+        product.set_description("for men")
+        self.assertEqual(product.get_gender(), "male")
+        product.set_description("for women")
+        self.assertEqual(product.get_gender(), "female")
+
+        # another variant of the product with the same description shares the value
+        variant = GMCFeedProductFromLightspeed(id="123", variant_id="789", product_cache=product_cache)
+        variant.set_description("for women")
+        self.assertEqual(variant.get_gender(), "female")
+        self.assertEqual(len(product_cache), 1)
+
+        product = GMCFeedProductFromEcwid(id="123", variant_id="456", product_cache={})
+        product.set_description("<b>a</b>")
+        product.set_description("<b>b</b>")
+        self.assertEqual(product.description, "b")
+
+    def test_slots(self):
+        product = GMCFeedProductFromEcwid(id="123", variant_id="456")
+        product.set_url("https://yourstore.com/glove")
+        self.assertEqual(product.get_url(), "https://yourstore.com/glove")
+        self.assertFalse(hasattr(product, '__dict__'))
+        self.assertFalse(hasattr(GMCFeedProductFromLightspeed(id="123", variant_id="456"), '__dict__'))
+
 class TestGMCFeedProductFromLightspeed(unittest.TestCase):
     def test_fulltitle_formation(self):
         product = GMCFeedProductFromLightspeed(id="123", variant_id="456")
@@ -292,6 +696,48 @@ class TestGMCFeedProductFromLightspeed(unittest.TestCase):
         self.assertEqual(template_categories[0]["title"], "Men", "Expected first category to be Men")
         self.assertEqual(template_categories[0]["subs"][0]["title"], "MTB gear", "Expected first subcategory to be MTB gear")
         self.assertEqual(template_categories[0]["subs"][0]["subs"][0]["title"], "Gloves", "Expected subcategory's subcategory to be Gloves")
+
+    def test_categories_at_every_depth_sorted(self):
+        product = GMCFeedProductFromLightspeed(id="123", variant_id="456")
+        product.set_categories({
+            "1": {"id": 1, "depth": 1, "sortOrder": 2, "url": "men", "title": "Men"},
+            "2": {"id": 2, "depth": 1, "sortOrder": 1, "url": "women", "title": "Women"},
+            "3": {"id": 3, "depth": 2, "sortOrder": 1, "url": "men/mtb-gear", "title": "MTB gear"},
+            "4": {"id": 4, "depth": 3, "sortOrder": 2, "url": "men/mtb-gear/shoes", "title": "Shoes"},
+            "5": {"id": 5, "depth": 3, "sortOrder": 1, "url": "men/mtb-gear/gloves", "title": "Gloves"},
+            "6": {"id": 6, "depth": 2, "sortOrder": 1, "url": "women/mtb-gear", "title": "MTB gear"},
+            "7": {"id": 7, "depth": 3, "sortOrder": 1, "url": "women/mtb-gear/gloves", "title": "Gloves"}
+        })
+
+        self.assertEqual(product.get_categories(), [
+            {"title": "Women", "subs": [{"title": "MTB gear", "subs": [{"title": "Gloves", "subs": []}]}]},
+            {"title": "Men", "subs": [{"title": "MTB gear", "subs": [
+                {"title": "Gloves", "subs": []},
+                {"title": "Shoes", "subs": []}
+            ]}]}
+        ])
+
+    def test_categories_ancestors_from_catalog_index(self):
+        # the product is only in the deepest category, its ancestors are known from other products
+        index = CategoryIndex.from_products([
+            {"id": 1, "categories": {
+                "1": {"id": 1, "depth": 1, "sortOrder": 1, "url": "men", "title": "Men"},
+                "2": {"id": 2, "depth": 2, "sortOrder": 1, "url": "men/mtb-gear", "title": "MTB gear"}
+            }},
+            {"id": 2, "categories": False}
+        ])
+        gloves = {"id": 3, "depth": 3, "sortOrder": 1, "url": "men/mtb-gear/gloves", "title": "Gloves"}
+        product = GMCFeedProductFromLightspeed(id="123", variant_id="456", category_index=index)
+        product.set_categories({"3": gloves})
+
+        self.assertEqual(product.get_categories(), [
+            {"title": "Men", "subs": [{"title": "MTB gear", "subs": [{"title": "Gloves", "subs": []}]}]}
+        ])
+        self.assertEqual([category["title"] for category in index.get_path(gloves)], ["Men", "MTB gear", "Gloves"])
+
+        # without the index, the product's own categories don't make a tree
+        product.set_category_index(None)
+        self.assertEqual(product.get_categories(), [])
     
     def test_backordered_products_have_special_availability_status_and_delivery_date(self):
         product = GMCFeedProductFromLightspeed(id="123", variant_id="456")
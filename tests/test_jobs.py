@@ -0,0 +1,214 @@
+import time
+import threading
+import unittest
+from datetime import timedelta
+from lightspeed_google_feed.storage import Storage
+from lightspeed_google_feed.jobs import RefreshJob, RefreshJobRunner, RefreshLease
+from tests.test_storage import FakeGCSClient
+
+class FakeFeedGenerator:
+    ''' Refreshes that report progress and wait until they are released '''
+
+    def __init__(self, error=None):
+        self.error = error
+        self.refreshes = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def refresh_feed_files(self, progress=None):
+        self.refreshes += 1
+        progress(stage="fetching")
+        progress(pages_fetched=3, products_fetched=750)
+        self.started.set()
+        self.release.wait(5)
+        progress(stage="rendering", items_total=10)
+        progress(items_rendered=10)
+        if self.error is not None:
+            raise self.error
+        return {'generation': {'id': "20250101T000000-abcdef12", 'files': {}}, 'published': ["feed_1.xml"], 'unchanged': ["feed_2.xml"]}
+
+class SlowFeedGenerator(FakeFeedGenerator):
+    ''' Refreshes that report progress for a while '''
+
+    def __init__(self, duration):
+        super().__init__()
+        self.duration = duration
+
+    def refresh_feed_files(self, progress=None):
+        self.refreshes += 1
+        progress(stage="rendering")
+        self.started.set()
+        deadline = time.time() + self.duration
+        while time.time() < deadline:
+            progress(items_rendered=1)
+            time.sleep(0.01)
+        progress(stage="publishing")
+        return {'generation': None, 'published': [], 'unchanged': ["feed_1.xml"]}
+
+class TestRefreshJobRunner(unittest.TestCase):
+
+    def test_refresh_runs_in_background(self):
+        feed_gen = FakeFeedGenerator()
+        runner = RefreshJobRunner(feed_gen)
+        job = runner.trigger()
+
+        self.assertTrue(feed_gen.started.wait(5))
+        status = job.to_dict()
+        self.assertEqual(status['status'], RefreshJob.RUNNING)
+        self.assertEqual(status['stage'], "fetching")
+        self.assertEqual(status['progress'], {'pages_fetched': 3, 'products_fetched': 750})
+
+        feed_gen.release.set()
+        self.assertTrue(job.wait(5))
+        status = job.to_dict()
+        self.assertEqual(status['status'], RefreshJob.SUCCEEDED)
+        self.assertIsNone(status['stage'])
+        self.assertEqual(status['progress']['items_rendered'], 10)
+        self.assertEqual(list(status['stage_durations']), ["fetching", "rendering"])
+        self.assertIsNotNone(status['finished_at'])
+        self.assertEqual(status['result'], {'generation': "20250101T000000-abcdef12", 'published': ["feed_1.xml"], 'unchanged': ["feed_2.xml"]})
+        self.assertIs(runner.get_job(job.id), job)
+
+    def test_later_triggers_are_merged(self):
+        feed_gen = FakeFeedGenerator()
+        runner = RefreshJobRunner(feed_gen)
+        running_job = runner.trigger()
+        self.assertTrue(feed_gen.started.wait(5))
+
+        # the running refresh may have fetched the catalog already: one more refresh is queued for all later requests
+        queued_job = runner.trigger()
+        self.assertIsNot(queued_job, running_job)
+        self.assertIs(runner.trigger(), queued_job)
+        self.assertEqual(queued_job.to_dict()['status'], RefreshJob.QUEUED)
+        self.assertEqual(queued_job.triggers, 2)
+
+        feed_gen.release.set()
+        self.assertTrue(queued_job.wait(5))
+        self.assertEqual(running_job.status, RefreshJob.SUCCEEDED)
+        self.assertEqual(queued_job.status, RefreshJob.SUCCEEDED)
+        self.assertEqual(feed_gen.refreshes, 2)
+
+        # nothing running anymore: a new request starts a new refresh
+        self.assertIsNot(runner.trigger(), queued_job)
+
+    def test_failed_refresh(self):
+        feed_gen = FakeFeedGenerator(error=RuntimeError("API is down"))
+        feed_gen.release.set()
+        job = RefreshJobRunner(feed_gen).trigger()
+
+        self.assertTrue(job.wait(5))
+        self.assertEqual(job.to_dict()['status'], RefreshJob.FAILED)
+        self.assertEqual(job.to_dict()['error'], "API is down")
+
+    def test_job_history_is_bounded(self):
+        feed_gen = FakeFeedGenerator()
+        feed_gen.release.set()
+        runner = RefreshJobRunner(feed_gen, max_history=2)
+        jobs = []
+        for i in range(3):
+            jobs.append(runner.trigger())
+            jobs[-1].wait(5)
+
+        self.assertIsNone(runner.get_job(jobs[0].id))
+        self.assertIs(runner.get_job(jobs[2].id), jobs[2])
+
+class TestRefreshAcrossInstances(unittest.TestCase):
+
+    def setUp(self):
+        # storage shared by the instances of the app
+        self.storage = Storage(cloud=True, client=FakeGCSClient())
+
+    def wait_for_stage(self, job, stage):
+        deadline = time.time() + 5
+        while job.to_dict()['stage'] != stage and time.time() < deadline:
+            time.sleep(0.01)
+        return job.to_dict()['stage'] == stage
+
+    def test_one_refresh_at_a_time_across_instances(self):
+        feed_gens = [FakeFeedGenerator(), FakeFeedGenerator()]
+        runners = [RefreshJobRunner(feed_gen, storage=self.storage, lease_poll_interval=0.01) for feed_gen in feed_gens]
+        first_job = runners[0].trigger()
+        self.assertTrue(feed_gens[0].started.wait(5))
+
+        # the other instance waits for the running refresh to finish
+        second_job = runners[1].trigger()
+        self.assertTrue(self.wait_for_stage(second_job, "waiting"))
+        self.assertFalse(feed_gens[1].started.is_set())
+        # and can report the status of a job it didn't start
+        self.assertEqual(runners[1].get_job_status(first_job.id)['status'], RefreshJob.RUNNING)
+
+        feed_gens[0].release.set()
+        feed_gens[1].release.set()
+        self.assertTrue(second_job.wait(5))
+        self.assertEqual(feed_gens[1].refreshes, 1)
+        self.assertIn("waiting", second_job.to_dict()['stage_durations'])
+        self.assertEqual(runners[1].get_job_status(first_job.id)['status'], RefreshJob.SUCCEEDED)
+        self.assertIsNone(self.storage.read_bytes(RefreshLease.FILENAME))
+
+        self.assertIsNone(runners[1].get_job_status("0" * 32))
+        self.assertIsNone(runners[1].get_job_status("../feeds_manifest"))
+
+    def test_abandoned_lease_is_taken_over(self):
+        self.assertTrue(self.storage.create_file(RefreshLease.FILENAME, '{"job": "shut down instance"}'))
+        self.assertFalse(RefreshLease(self.storage).acquire("a" * 32))
+
+        lease = RefreshLease(self.storage, ttl=0)
+        self.assertTrue(lease.acquire("b" * 32))
+        self.assertIn(b"b" * 32, self.storage.read_bytes(RefreshLease.FILENAME))
+        lease.release()
+        self.assertIsNone(self.storage.read_bytes(RefreshLease.FILENAME))
+
+    def test_lease_is_renewed_while_refreshing(self):
+        feed_gens = [SlowFeedGenerator(duration=1), SlowFeedGenerator(duration=0)]
+        runners = [RefreshJobRunner(feed_gen, storage=self.storage, lease_poll_interval=0.01) for feed_gen in feed_gens]
+        for runner in runners:
+            runner.lease.ttl = 0.3
+        first_job = runners[0].trigger()
+        self.assertTrue(feed_gens[0].started.wait(5))
+
+        # the refresh takes longer than the ttl, but its lease isn't taken over
+        second_job = runners[1].trigger()
+        self.assertTrue(first_job.wait(5))
+        self.assertEqual(first_job.to_dict()['status'], RefreshJob.SUCCEEDED)
+        self.assertTrue(second_job.wait(5))
+        self.assertGreaterEqual(second_job.to_dict()['stage_durations']['waiting'], 0.5)
+        self.assertEqual(second_job.to_dict()['status'], RefreshJob.SUCCEEDED)
+
+    def test_refresh_fails_when_its_lease_is_lost(self):
+        feed_gen = SlowFeedGenerator(duration=1)
+        runner = RefreshJobRunner(feed_gen, storage=self.storage)
+        runner.lease.ttl = 0.3
+        job = runner.trigger()
+        self.assertTrue(feed_gen.started.wait(5))
+
+        # e.g. this instance was stuck for longer than the ttl
+        self.assertTrue(self.storage.delete_file(RefreshLease.FILENAME))
+        self.assertTrue(self.storage.create_file(RefreshLease.FILENAME, '{"job": "other instance"}'))
+
+        self.assertTrue(job.wait(5))
+        status = job.to_dict()
+        self.assertEqual(status['status'], RefreshJob.FAILED)
+        self.assertIn("taken over", status['error'])
+        self.assertNotIn("publishing", status['stage_durations'])
+        # the other instance keeps its lease
+        self.assertEqual(self.storage.read_bytes(RefreshLease.FILENAME), b'{"job": "other instance"}')
+
+    def test_stale_job_statuses_are_deleted(self):
+        bucket = self.storage.get_bucket()
+        for job_id in ["a" * 32, "b" * 32]:
+            self.storage.save_stream(f"{RefreshJobRunner.STATUS_DIRECTORY}/{job_id}.json", ['{"status": "running"}'])
+        # left by an instance shut down two days ago
+        bucket.updated[f"{RefreshJobRunner.STATUS_DIRECTORY}/{'a' * 32}.json"] -= timedelta(days=2)
+
+        feed_gen = FakeFeedGenerator()
+        feed_gen.release.set()
+        runner = RefreshJobRunner(feed_gen, storage=self.storage)
+        job = runner.trigger()
+        self.assertTrue(job.wait(5))
+
+        self.assertIsNone(runner.get_job_status("a" * 32))
+        self.assertEqual(runner.get_job_status("b" * 32), {'status': "running"})
+        self.assertEqual(runner.get_job_status(job.id)['status'], RefreshJob.SUCCEEDED)
+
+if __name__ == '__main__':
+    unittest.main()
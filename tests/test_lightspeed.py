@@ -1,55 +1,78 @@
 import unittest
+import time
+import threading
 from unittest.mock import patch, Mock
-from lightspeed_google_feed.lightspeed import LightspeedEcomAPI
+from tests.test_scheduler import StubAPIServer
+from lightspeed_google_feed.lightspeed import LightspeedEcomAPI, LightspeedEcwidAPI, LightspeedAPI, FETCH_TIMEOUT, FULL_SYNC_INTERVAL, SYNC_OVERLAP
+
+def mock_page_response(json_data):
+    response = Mock()
+    response.json.return_value = json_data
+    return response
 
 class TestLightspeedEcomAPI(unittest.TestCase):
 
     def setUp(self):
         self.api = LightspeedEcomAPI()
 
-    @patch('lightspeed_google_feed.lightspeed.requests')
-    def test_get_product_count(self, mock_requests):
-        # Setup mock response
-        mock_response = Mock()
-        mock_response.json.return_value = {"count": 123}
-        mock_requests.get.return_value = mock_response
-
-        # Call method and verify result
-        count = self.api.get_product_count()
-        self.assertEqual(count, 123)
-
-        # Verify request was made correctly
-        mock_requests.get.assert_called_once_with(
-            f"{self.api.BASE_URL}/catalog/count.json",
-            auth=self.api.AUTH
-        )
-
-    @patch('lightspeed_google_feed.lightspeed.requests')
-    def test_get_all_products(self, mock_requests):
-        # Setup mock responses
-        count_response = Mock()
-        count_response.json.return_value = {"count": 300}
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_get_all_products(self, mock_get):
+        # Setup mock responses: one full page, one partial page and empty pages after that
+        def get_page(url, auth=None, params=None, timeout=None):
+            if params["page"] == 1:
+                return mock_page_response({"products": [{"id": i} for i in range(250)]})
+            elif params["page"] == 2:
+                return mock_page_response({"products": [{"id": 250}, {"id": 251}]})
+            return mock_page_response({"products": []})
+        mock_get.side_effect = get_page
 
-        products_response = Mock()
-        products_response.json.return_value = {
-            "products": [{"id": 1}, {"id": 2}]
-        }
+        # Call method
+        products = self.api.get_all_products()
 
-        mock_requests.get.side_effect = [count_response] + [products_response] * 2
+        # Verify results: all products, in page order, and no count.json request
+        self.assertEqual(len(products), 252)
+        self.assertEqual([p["id"] for p in products], list(range(252)))
+        for call in mock_get.call_args_list:
+            self.assertTrue(call.args[0].endswith("/catalog.json"))
+
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_get_all_products_requests_few_pages_past_the_end(self, mock_get):
+        def get_page(url, auth=None, params=None, timeout=None):
+            first = (params["page"] - 1) * 250
+            return mock_page_response({"products": [{"id": i} for i in range(first, min(first + 250, 600))]})
+        mock_get.side_effect = get_page
+        api = LightspeedEcomAPI(workers=8)
+
+        # pages requested ahead grow with every full page: 1, 2, then 3 and 4 (past the end)
+        self.assertEqual(len(api.get_all_products()), 600)
+        self.assertEqual(mock_get.call_count, 4)
+
+        # a full sync requests the pages of the last synced catalog right away, and no more
+        mock_get.reset_mock()
+        api.cache.clear()
+        api.last_full_sync_at -= FULL_SYNC_INTERVAL
+        self.assertEqual(len(api.get_all_products()), 600)
+        self.assertEqual(mock_get.call_count, 3)
+        # a delta sync (a page at most here) only requests one page
+        mock_get.reset_mock()
+        api.cache.clear()
+        mock_get.side_effect = [mock_page_response({"products": [{"id": 1}]})]
+        api.get_all_products()
+        self.assertEqual(mock_get.call_count, 1)
+
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_get_all_products_single_page(self, mock_get):
+        mock_get.side_effect = [mock_page_response({"products": [{"id": 1}, {"id": 2}]})]
 
-        # Call method
         products = self.api.get_all_products()
 
-        # Verify results
-        self.assertEqual(len(products), 4)  # 2 products per page * 2 pages
-        self.assertEqual(mock_requests.get.call_count, 3)  # 1 count call + 2 product page calls
+        # a short first page is the whole catalog
+        self.assertEqual(len(products), 2)
+        self.assertEqual(mock_get.call_count, 1)
 
-    @patch('lightspeed_google_feed.lightspeed.requests')
-    def test_get_all_visible_products(self, mock_requests):
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_get_all_visible_products(self, mock_get):
         # Setup mock responses
-        count_response = Mock()
-        count_response.json.return_value = {"count": 250}
-
         products_response = Mock()
         products_response.json.return_value = {
             "products": [
@@ -59,7 +82,7 @@ class TestLightspeedEcomAPI(unittest.TestCase):
             ]
         }
 
-        mock_requests.get.side_effect = [count_response, products_response]
+        mock_get.side_effect = [products_response]
 
         # Call method
         visible_products = self.api.get_all_visible_products()
@@ -68,5 +91,222 @@ class TestLightspeedEcomAPI(unittest.TestCase):
         self.assertEqual(len(visible_products), 2)
         self.assertTrue(all(p["isVisible"] for p in visible_products))
 
+class TestLightspeedEcwidAPI(unittest.TestCase):
+
+    def setUp(self):
+        self.api = LightspeedEcwidAPI()
+
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_get_all_visible_products(self, mock_get):
+        # 250 products = 3 pages of 100; the total comes from the first page
+        def get_page(url, params=None, headers=None, timeout=None):
+            offset = int(params["offset"])
+            items = [{"id": i} for i in range(offset, min(offset + 100, 250))]
+            return mock_page_response({"total": 250, "items": items})
+        mock_get.side_effect = get_page
+
+        products = self.api.get_all_visible_products()
+
+        self.assertEqual([p["id"] for p in products], list(range(250)))
+        self.assertEqual(mock_get.call_count, 3)
+        self.assertEqual(self.api.get_product_count(), 250)
+        self.assertEqual(mock_get.call_count, 3)
+
+class TestSingleFlight(unittest.TestCase):
+
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_concurrent_refreshes_download_catalog_once(self, mock_get):
+        def slow_get_page(url, auth=None, params=None, timeout=None):
+            time.sleep(0.2)
+            return mock_page_response({"products": [{"id": 1, "isVisible": True}]})
+        mock_get.side_effect = slow_get_page
+        api = LightspeedEcomAPI()
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(api.get_all_visible_products())) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(len(results), 4)
+
+class TestDeltaSync(unittest.TestCase):
+
+    def expire_cache(self, api):
+        api.cache.clear()
+
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_ecom_delta_sync_merges_updated_products(self, mock_get):
+        api = LightspeedEcomAPI()
+        mock_get.side_effect = [mock_page_response({"products": [{"id": 1, "title": "A"}, {"id": 2, "title": "B"}]})]
+        api.get_all_products()
+        self.assertNotIn("updated_at_min", mock_get.call_args.kwargs["params"])
+        self.assertIsNone(api.get_last_changes()['since'])
+
+        # next refresh only asks for products updated since the last sync and merges them by id
+        self.expire_cache(api)
+        previous_sync_at = api.last_sync_at
+        mock_get.side_effect = [mock_page_response({"products": [{"id": 2, "title": "B v2"}, {"id": 3, "title": "C"}]})]
+        products = api.get_all_products()
+
+        self.assertIn("updated_at_min", mock_get.call_args.kwargs["params"])
+        self.assertEqual([(p["id"], p["title"]) for p in products], [(1, "A"), (2, "B v2"), (3, "C")])
+        self.assertEqual(api.get_last_changes(), {'synced_at': api.last_sync_at, 'since': previous_sync_at, 'updated': [2, 3], 'removed': []})
+
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_ecwid_delta_sync_merges_updated_products(self, mock_get):
+        api = LightspeedEcwidAPI()
+        mock_get.side_effect = [mock_page_response({"total": 2, "items": [{"id": 1, "name": "A"}, {"id": 2, "name": "B"}]})]
+        api.get_all_visible_products()
+
+        self.expire_cache(api)
+        # the sync replaces last_sync_at, so the filter is checked against the previous one
+        previous_sync_at = api.last_sync_at
+        mock_get.side_effect = [mock_page_response({"total": 1, "items": [{"id": 1, "name": "A v2"}]})]
+        products = api.get_all_visible_products()
+
+        self.assertEqual(mock_get.call_args.kwargs["params"]["updatedFrom"], str(int(previous_sync_at - SYNC_OVERLAP)))
+        self.assertEqual([(p["id"], p["name"]) for p in products], [(1, "A v2"), (2, "B")])
+
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_ecwid_delta_sync_drops_disabled_and_hidden_products(self, mock_get):
+        api = LightspeedEcwidAPI()
+        mock_get.side_effect = [mock_page_response({"total": 3, "items": [{"id": 1, "enabled": True}, {"id": 2, "enabled": True}, {"id": 3, "enabled": True}]})]
+        api.get_all_visible_products()
+        self.assertEqual(mock_get.call_args.kwargs["params"]["enabled"], "true")
+
+        # the delta isn't filtered by the API, so products disabled or hidden since the last sync show up in it
+        self.expire_cache(api)
+        mock_get.side_effect = [mock_page_response({"total": 3, "items": [
+            {"id": 1, "enabled": False},
+            {"id": 2, "enabled": True, "categories": [{"id": 10, "enabled": False}]},
+            {"id": 4, "enabled": False}
+        ]})]
+        products = api.get_all_visible_products()
+
+        params = mock_get.call_args.kwargs["params"]
+        self.assertIn("updatedFrom", params)
+        self.assertNotIn("enabled", params)
+        self.assertNotIn("visibleInStorefront", params)
+        # same catalog as a full sync would return
+        self.assertEqual([p["id"] for p in products], [3])
+        self.assertEqual(api.get_last_changes()['removed'], [1, 2])
+
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_periodic_full_sync_drops_deleted_products(self, mock_get):
+        api = LightspeedEcomAPI()
+        mock_get.side_effect = [mock_page_response({"products": [{"id": 1}, {"id": 2}]})]
+        api.get_all_products()
+
+        # once the full sync interval has passed, the whole catalog is downloaded again
+        self.expire_cache(api)
+        api.last_full_sync_at -= FULL_SYNC_INTERVAL
+        mock_get.side_effect = [mock_page_response({"products": [{"id": 2}]})]
+        products = api.get_all_products()
+
+        self.assertNotIn("updated_at_min", mock_get.call_args.kwargs["params"])
+        self.assertEqual([p["id"] for p in products], [2])
+
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_delta_sync_disabled(self, mock_get):
+        api = LightspeedEcomAPI()
+        api.delta_sync = False
+        mock_get.side_effect = [mock_page_response({"products": [{"id": 1}]})] * 2
+        api.get_all_products()
+        self.expire_cache(api)
+        api.get_all_products()
+
+        self.assertNotIn("updated_at_min", mock_get.call_args.kwargs["params"])
+
+class TestParallelPageFetching(unittest.TestCase):
+    ''' Fetches the catalog from a mocked slow API, sequentially and in parallel '''
+
+    LATENCY = 0.04
+
+    def fetch_ecwid_catalog(self, workers):
+        def slow_get_page(url, params=None, headers=None, timeout=None):
+            time.sleep(self.LATENCY)
+            offset = int(params["offset"])
+            items = [{"id": i} for i in range(offset, min(offset + 100, 3250))]
+            return mock_page_response({"total": 3250, "items": items})
+
+        api = LightspeedEcwidAPI(workers=workers)
+        with patch('lightspeed_google_feed.lightspeed.requests.Session.get') as mock_get:
+            mock_get.side_effect = slow_get_page
+            start = time.perf_counter()
+            products = api.get_all_visible_products()
+            elapsed = time.perf_counter() - start
+        return products, elapsed
+
+    def fetch_ecom_catalog(self, workers):
+        def slow_get_page(url, auth=None, params=None, timeout=None):
+            time.sleep(self.LATENCY)
+            first = (params["page"] - 1) * 250
+            return mock_page_response({"products": [{"id": i} for i in range(first, min(first + 250, 8100))]})
+
+        api = LightspeedEcomAPI(workers=workers)
+        with patch('lightspeed_google_feed.lightspeed.requests.Session.get') as mock_get:
+            mock_get.side_effect = slow_get_page
+            api.get_all_products()
+            # a periodic full sync, which knows how many pages to expect from the last one
+            api.cache.clear()
+            api.last_full_sync_at -= FULL_SYNC_INTERVAL
+            start = time.perf_counter()
+            products = api.get_all_products()
+            elapsed = time.perf_counter() - start
+        return products, elapsed
+
+    def test_ecwid_parallel_speedup(self):
+        sequential_products, sequential_time = self.fetch_ecwid_catalog(workers=1)
+        parallel_products, parallel_time = self.fetch_ecwid_catalog(workers=8)
+
+        # same products in the same order, and close to linear speedup
+        # (33 pages: 33 round-trips sequentially vs. 1 + ceil(32/8) = 5 in parallel)
+        self.assertEqual(sequential_products, parallel_products)
+        self.assertEqual(len(parallel_products), 3250)
+        self.assertGreater(sequential_time / parallel_time, 4, f"Expected >4x speedup (sequential: {sequential_time:.2f}s, parallel: {parallel_time:.2f}s)")
+
+    def test_ecom_parallel_speedup(self):
+        sequential_products, sequential_time = self.fetch_ecom_catalog(workers=1)
+        parallel_products, parallel_time = self.fetch_ecom_catalog(workers=8)
+
+        self.assertEqual(sequential_products, parallel_products)
+        self.assertEqual(len(parallel_products), 8100)
+        self.assertGreater(sequential_time / parallel_time, 4, f"Expected >4x speedup (sequential: {sequential_time:.2f}s, parallel: {parallel_time:.2f}s)")
+
+class TestPooledSession(unittest.TestCase):
+
+    def test_pool_size_follows_workers(self):
+        api = LightspeedEcomAPI(workers=6)
+        adapter = api.session.get_adapter("https://api.shoplightspeed.com")
+        self.assertEqual(adapter._pool_maxsize, 6)
+        self.assertEqual(api.session.headers['Accept-Encoding'], 'gzip, deflate')
+
+    def test_connections_are_reused(self):
+        with StubAPIServer(total=2000, throttle_every=1000) as server:
+            api = LightspeedEcwidAPI(workers=4)
+            api.BASE_URL = server.url
+
+            products = api.get_all_visible_products()
+            stats = api.get_pool_stats()
+
+            # 20 pages over at most 4 keep-alive connections
+            self.assertEqual(len(products), 2000)
+            self.assertEqual(stats['requests'], 20)
+            self.assertLessEqual(stats['connections_opened'], 4)
+            self.assertEqual(stats['connections_reused'], stats['requests'] - stats['connections_opened'])
+
+class TestLightspeedAPI(unittest.TestCase):
+
+    def test_workers_are_passed_to_backend(self):
+        self.assertEqual(LightspeedAPI(api_type="LS", workers=3).lightspeed_api.workers, 3)
+        self.assertEqual(LightspeedAPI(api_type="ECWID", workers=5).lightspeed_api.workers, 5)
+
+    def test_invalid_api_type(self):
+        with self.assertRaises(ValueError):
+            LightspeedAPI(api_type="INVALID")
+
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
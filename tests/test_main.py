@@ -0,0 +1,140 @@
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timezone
+from unittest.mock import patch
+from lightspeed_google_feed.feed_cache import CachedFeed
+import main
+
+class TestFeedRoutes(unittest.TestCase):
+
+    def setUp(self):
+        self.client = main.app.test_client()
+        self.feed = CachedFeed(b"<rss><item>1</item></rss>", 1, datetime(2025, 1, 2, 3, 4, 5, tzinfo=timezone.utc))
+        patcher = patch.object(main.feed_gen, 'get_feed', return_value=self.feed)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_feed_with_validators(self):
+        response = self.client.get('/shopping_online_inventory_feed')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, self.feed.content)
+        self.assertEqual(response.headers['Content-Type'], 'application/xml')
+        self.assertEqual(response.headers['ETag'], f'"{self.feed.etag}"')
+        self.assertEqual(response.headers['Last-Modified'], 'Thu, 02 Jan 2025 03:04:05 GMT')
+
+    def test_if_none_match(self):
+        response = self.client.get('/local_listings_feed', headers={'If-None-Match': f'"{self.feed.etag}"'})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b"")
+
+        response = self.client.get('/local_listings_feed', headers={'If-None-Match': '"another-version"'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_if_modified_since(self):
+        response = self.client.get('/local_listings_feed', headers={'If-Modified-Since': 'Thu, 02 Jan 2025 03:04:05 GMT'})
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get('/local_listings_feed', headers={'If-Modified-Since': 'Wed, 01 Jan 2025 00:00:00 GMT'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_precompressed_variant(self):
+        gzip_feed = CachedFeed(gzip.compress(self.feed.content), 1)
+        main.feed_gen.get_feed.side_effect = lambda filename, encoding=None: gzip_feed if encoding == 'gzip' else self.feed
+
+        response = self.client.get('/shopping_online_inventory_feed', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(gzip.decompress(response.data), self.feed.content)
+        # every variant has its own ETag
+        self.assertEqual(response.headers['ETag'], f'"{gzip_feed.etag}"')
+        response = self.client.get('/shopping_online_inventory_feed', headers={'Accept-Encoding': 'gzip', 'If-None-Match': f'"{self.feed.etag}"'})
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get('/shopping_online_inventory_feed', headers={'Accept-Encoding': 'gzip;q=0, deflate'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(response.data, self.feed.content)
+
+    def test_missing_precompressed_variant(self):
+        main.feed_gen.get_feed.side_effect = lambda filename, encoding=None: None if encoding else self.feed
+        response = self.client.get('/shopping_online_inventory_feed', headers={'Accept-Encoding': 'gzip, br'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.data, self.feed.content)
+
+    def test_local_file_with_range(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "feed.xml")
+            with open(path, 'wb') as f:
+                f.write(self.feed.content)
+            local_feed = CachedFeed(None, 1, self.feed.modified_at, path=path, etag=self.feed.etag)
+            main.feed_gen.get_feed.return_value = local_feed
+
+            response = self.client.get('/local_listings_feed')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data, self.feed.content)
+            self.assertEqual(response.mimetype, 'application/xml')
+            self.assertEqual(response.headers['ETag'], f'"{self.feed.etag}"')
+            response.close()
+
+            response = self.client.get('/local_listings_feed', headers={'Range': 'bytes=5-10'})
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response.data, self.feed.content[5:11])
+            response.close()
+
+            response = self.client.get('/local_listings_feed', headers={'If-None-Match': f'"{self.feed.etag}"'})
+            self.assertEqual(response.status_code, 304)
+            response.close()
+
+    def test_refresh_feeds_in_background(self):
+        # job statuses are saved to storage (see RefreshJobRunner)
+        self.addCleanup(shutil.rmtree, main.RefreshJobRunner.STATUS_DIRECTORY, ignore_errors=True)
+        result = {'generation': None, 'published': [], 'unchanged': [main.feed_gen.SHOPPING_ONLINE_INVENTORY_FEED_FILENAME]}
+        with patch.object(main.feed_gen, 'refresh_feed_files', return_value=result) as mock_refresh:
+            response = self.client.get('/refresh_feeds')
+            self.assertEqual(response.status_code, 202)
+            job_id = response.get_json()['id']
+            self.assertEqual(response.headers['Location'], f"/refresh_feeds/{job_id}")
+            main.refresh_jobs.get_job(job_id).wait(5)
+
+            response = self.client.get(f"/refresh_feeds/{job_id}")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_json()['status'], 'succeeded')
+            self.assertEqual(response.get_json()['result']['unchanged'], [main.feed_gen.SHOPPING_ONLINE_INVENTORY_FEED_FILENAME])
+            mock_refresh.assert_called_once()
+
+        self.assertEqual(self.client.get('/refresh_feeds/unknown').status_code, 404)
+
+    def test_rollback_feeds(self):
+        generation = {'id': '20250102T030405-abcdef12', 'created_at': '2025-01-02T03:04:05+00:00', 'files': {}}
+        with patch.object(main.feed_gen, 'rollback_feeds', return_value=generation) as mock_rollback:
+            response = self.client.post('/rollback_feeds', data={'generation': '20250102T030405-abcdef12'})
+            self.assertEqual(response.get_json()['current'], generation['id'])
+            mock_rollback.assert_called_once_with(generation['id'])
+
+            mock_rollback.side_effect = ValueError("There is no feed generation before 20250102T030405-abcdef12")
+            self.assertEqual(self.client.post('/rollback_feeds').status_code, 409)
+
+    @patch.object(main, 'ADMIN_TOKEN', 'secret')
+    @patch.object(main, 'IS_RUNNING_ON_CLOUD', True)
+    def test_rollback_feeds_requires_admin(self):
+        generation = {'id': '20250102T030405-abcdef12', 'created_at': '2025-01-02T03:04:05+00:00', 'files': {}}
+        with patch.object(main.feed_gen, 'rollback_feeds', return_value=generation) as mock_rollback:
+            # links followed by crawlers or browsers don't change the feeds
+            self.assertEqual(self.client.get('/rollback_feeds').status_code, 405)
+            self.assertEqual(self.client.post('/rollback_feeds').status_code, 403)
+            self.assertEqual(self.client.post('/rollback_feeds', headers={'X-Admin-Token': 'wrong'}).status_code, 403)
+            mock_rollback.assert_not_called()
+
+            self.assertEqual(self.client.post('/rollback_feeds', headers={'X-Admin-Token': 'secret'}).status_code, 200)
+            self.assertEqual(self.client.post('/rollback_feeds', headers={'X-Appengine-Cron': 'true'}).status_code, 200)
+
+    def test_missing_feed(self):
+        main.feed_gen.get_feed.return_value = None
+        response = self.client.get('/local_listings_feed')
+        self.assertIn(b"Feed file not found", response.data)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+import unittest
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import requests
+from lightspeed_google_feed.scheduler import RequestScheduler
+from lightspeed_google_feed.lightspeed import LightspeedEcwidAPI
+
+class StubAPIServer:
+    ''' Local Ecwid-like products API that answers 429 to every Nth request '''
+
+    def __init__(self, total=1000, per_page=100, throttle_every=3, retry_after="0", always_throttle=False):
+        self.total = total
+        self.per_page = per_page
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.always_throttle = always_throttle
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep-alive, so clients can reuse their connections
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                with server.lock:
+                    server.requests += 1
+                    server.in_flight += 1
+                    server.max_in_flight = max(server.max_in_flight, server.in_flight)
+                    throttle = server.always_throttle or server.requests % server.throttle_every == 0
+                    if throttle:
+                        server.throttled += 1
+                try:
+                    if throttle:
+                        self.send_response(429)
+                        if server.retry_after is not None:
+                            self.send_header('Retry-After', server.retry_after)
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+
+                    params = parse_qs(urlparse(self.path).query)
+                    offset = int(params.get('offset', ['0'])[0])
+                    items = [{"id": i} for i in range(offset, min(offset + server.per_page, server.total))]
+                    body = json.dumps({"total": server.total, "items": items}).encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.send_header('X-RateLimit-Remaining', '100/1000/10000')
+                    self.end_headers()
+                    self.wfile.write(body)
+                finally:
+                    with server.lock:
+                        server.in_flight -= 1
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class TestRequestScheduler(unittest.TestCase):
+
+    def test_retries_throttled_requests_against_stub_server(self):
+        with StubAPIServer(total=1000, throttle_every=3) as server:
+            api = LightspeedEcwidAPI(workers=4)
+            api.BASE_URL = server.url
+
+            products = api.get_all_visible_products()
+
+            # every page made it despite the injected 429s, in page order
+            self.assertEqual([p["id"] for p in products], list(range(1000)))
+            self.assertGreater(server.throttled, 0)
+            self.assertEqual(api.scheduler.get_stats()['throttled'], server.throttled)
+            self.assertLessEqual(server.max_in_flight, 4)
+
+    def test_gives_up_after_retry_budget(self):
+        with StubAPIServer(always_throttle=True) as server:
+            scheduler = RequestScheduler(max_retries=2, backoff=0.01)
+
+            with self.assertRaises(requests.HTTPError):
+                scheduler.request(requests.get, f"{server.url}/products")
+
+            # first attempt + 2 retries
+            self.assertEqual(server.requests, 3)
+            self.assertEqual(scheduler.get_stats()['failures'], 1)
+
+    def test_other_errors_free_their_slot(self):
+        scheduler = RequestScheduler(max_concurrency=2, max_retries=2)
+
+        def broken_send():
+            raise requests.exceptions.ChunkedEncodingError("Connection broken")
+
+        for i in range(3):
+            with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+                scheduler.request(broken_send)
+        self.assertEqual(scheduler.get_stats()['in_flight'], 0)
+        # not retried
+        self.assertEqual(scheduler.get_stats()['requests'], 3)
+
+        ok = type('Response', (), {'status_code': 200, 'headers': {}})()
+        self.assertIs(scheduler.request(lambda: ok), ok)
+
+    def test_backoff_without_retry_after(self):
+        with StubAPIServer(throttle_every=2, retry_after=None) as server:
+            scheduler = RequestScheduler(max_retries=3, backoff=0.01)
+            response = scheduler.request(requests.get, f"{server.url}/products")
+            self.assertEqual(response.status_code, 200)
+
+    def test_aimd_concurrency(self):
+        scheduler = RequestScheduler(max_concurrency=8, initial_concurrency=4)
+        ok = type('Response', (), {'status_code': 200, 'headers': {}})()
+        throttled = type('Response', (), {'status_code': 429, 'headers': {'Retry-After': '0'}})()
+
+        # additive increase: +1 after a full round of successes
+        for i in range(4):
+            scheduler._on_success(ok)
+        self.assertEqual(scheduler.limit, 5)
+
+        # multiplicative decrease, only once for requests started in the same epoch
+        epoch = scheduler.epoch
+        scheduler._on_throttled(throttled, epoch, 1)
+        scheduler._on_throttled(throttled, epoch, 1)
+        self.assertEqual(scheduler.limit, 2)
+
+        # never above the maximum
+        for i in range(100):
+            scheduler._on_success(ok)
+        self.assertEqual(scheduler.limit, 8)
+
+    def test_rate_limit_headers(self):
+        scheduler = RequestScheduler(max_concurrency=8, initial_concurrency=8, max_backoff=5)
+        nearly_exhausted = type('Response', (), {'status_code': 200, 'headers': {'X-RateLimit-Remaining': '3/2999/29999', 'X-RateLimit-Reset': '20/3500/86000'}})()
+        exhausted = type('Response', (), {'status_code': 200, 'headers': {'X-RateLimit-Remaining': '0/2999/29999', 'X-RateLimit-Reset': '2/3500/86000'}})()
+
+        # never more requests in flight than the API has left
+        scheduler._on_success(nearly_exhausted)
+        self.assertEqual(scheduler.limit, 3)
+        self.assertEqual(scheduler.paused_until, 0)
+
+        # an exhausted window pauses new requests until it resets
+        scheduler._on_success(exhausted)
+        self.assertGreater(scheduler.paused_until, 0)
+
+    def test_retry_after_formats(self):
+        scheduler = RequestScheduler(max_backoff=60)
+        self.assertEqual(scheduler._retry_after({'Retry-After': '7'}), 7)
+        self.assertEqual(scheduler._retry_after({'Retry-After': '3600'}), 60)
+        self.assertEqual(scheduler._retry_after({'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}), 0)
+        self.assertIsNone(scheduler._retry_after({'Retry-After': 'soon'}))
+        self.assertIsNone(scheduler._retry_after({}))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import os
+import io
+import tempfile
+import unittest
+from unittest.mock import patch, Mock
+import requests
+from google.cloud.exceptions import NotFound
+from lightspeed_google_feed.storage import Storage
+from lightspeed_google_feed.snapshot import CatalogSnapshotStore
+from lightspeed_google_feed.lightspeed import LightspeedEcomAPI, LightspeedAPI
+from tests.test_lightspeed import mock_page_response
+
+class TestCatalogSnapshotStore(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.temp_dir.name, "catalog_snapshot.json.gz")
+        self.store = CatalogSnapshotStore(Storage(cloud=False), self.filename, source="https://api.example.com")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_save_and_load(self):
+        products = [{"id": 1, "title": "Glove"}, {"id": 2, "title": "Bike ç"}]
+        self.store.save(products, last_sync_at=1000.0, last_full_sync_at=900.0)
+
+        snapshot = self.store.load()
+        self.assertEqual(snapshot['products'], products)
+        self.assertEqual(snapshot['last_sync_at'], 1000.0)
+        self.assertEqual(snapshot['last_full_sync_at'], 900.0)
+
+    def test_missing_snapshot(self):
+        self.assertIsNone(self.store.load())
+
+    def test_unsupported_version_is_ignored(self):
+        self.store.save([{"id": 1}], 1000.0, 900.0)
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+        with open(self.filename, 'wb') as f:
+            f.write(data.replace(b"LSGF-CATALOG-SNAPSHOT 1\n", b"LSGF-CATALOG-SNAPSHOT 99\n", 1))
+
+        self.assertIsNone(self.store.load())
+
+    def test_corrupted_snapshot_is_ignored(self):
+        with open(self.filename, 'wb') as f:
+            f.write(b"LSGF-CATALOG-SNAPSHOT 1\nnot gzip")
+        self.assertIsNone(self.store.load())
+
+    def test_snapshot_from_another_source_is_ignored(self):
+        self.store.save([{"id": 1}], 1000.0, 900.0)
+        other_store = CatalogSnapshotStore(Storage(cloud=False), self.filename, source="https://other.example.com")
+        self.assertIsNone(other_store.load())
+
+    @patch('lightspeed_google_feed.storage.storage')
+    def test_cloud_snapshot(self, mock_storage):
+        mock_bucket = mock_storage.Client.return_value.bucket.return_value
+        uploaded = io.BytesIO()
+        uploaded.close = Mock()
+        mock_bucket.blob.return_value.open.return_value = uploaded
+        store = CatalogSnapshotStore(Storage(cloud=True), "catalog_snapshot.json.gz")
+
+        store.save([{"id": 1}], 1000.0, 900.0)
+        mock_bucket.blob.assert_called_with("catalog_snapshot.json.gz.tmp")
+        mock_bucket.blob.return_value.open.assert_called_once_with('wb', chunk_size=unittest.mock.ANY, content_type='application/octet-stream', ignore_flush=True)
+        mock_bucket.rename_blob.assert_called_once_with(mock_bucket.blob.return_value, "catalog_snapshot.json.gz")
+        self.assertTrue(uploaded.getvalue().startswith(b"LSGF-CATALOG-SNAPSHOT 1\n"))
+
+        mock_bucket.blob.return_value.download_as_bytes.return_value = uploaded.getvalue()
+        self.assertEqual(store.load()['products'], [{"id": 1}])
+
+        mock_bucket.blob.return_value.download_as_bytes.side_effect = NotFound("no snapshot")
+        self.assertIsNone(store.load())
+
+class TestCatalogSnapshotSync(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.temp_dir.name, "catalog_snapshot.json.gz")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def create_api(self):
+        api = LightspeedEcomAPI()
+        api.snapshot_store = CatalogSnapshotStore(Storage(cloud=False), self.filename, source=api.BASE_URL)
+        return api
+
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_new_instance_starts_from_snapshot(self, mock_get):
+        mock_get.side_effect = [mock_page_response({"products": [{"id": 1, "title": "A"}, {"id": 2, "title": "B"}]})]
+        first_api = self.create_api()
+        first_api.get_all_products()
+
+        # a new instance (e.g. after a cold start) only asks for what changed since the snapshot
+        mock_get.side_effect = [mock_page_response({"products": [{"id": 2, "title": "B v2"}]})]
+        api = self.create_api()
+        products = api.get_all_products()
+
+        self.assertIn("updated_at_min", mock_get.call_args.kwargs["params"])
+        self.assertEqual([(p["id"], p["title"]) for p in products], [(1, "A"), (2, "B v2")])
+        self.assertEqual(api.last_full_sync_at, first_api.last_full_sync_at)
+
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_falls_back_to_snapshot_when_api_is_down(self, mock_get):
+        mock_get.side_effect = [mock_page_response({"products": [{"id": 1}, {"id": 2}]})]
+        self.create_api().get_all_products()
+
+        mock_get.side_effect = requests.exceptions.ConnectionError("API is down")
+        api = self.create_api()
+        api.scheduler.backoff = 0
+        products = api.get_all_products()
+
+        self.assertEqual([p["id"] for p in products], [1, 2])
+
+    @patch('lightspeed_google_feed.lightspeed.requests.Session.get')
+    def test_fails_without_snapshot_when_api_is_down(self, mock_get):
+        mock_get.side_effect = requests.exceptions.ConnectionError("API is down")
+        api = self.create_api()
+        api.scheduler.backoff = 0
+
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            api.get_all_products()
+
+    def test_snapshot_store_from_storage(self):
+        api = LightspeedAPI(api_type="LS", storage=Storage(cloud=False))
+        self.assertEqual(api.lightspeed_api.snapshot_store.filename, "catalog_snapshot_ls.json.gz")
+        self.assertIsNone(LightspeedAPI(api_type="LS").lightspeed_api.snapshot_store)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,136 @@
+import io
+import os
+import gzip
+import time
+import threading
 import unittest
+from datetime import datetime, timezone
+from contextlib import ExitStack
 from unittest.mock import patch, Mock
-from lightspeed_google_feed.storage import Storage
+from google.cloud.exceptions import NotFound
+from google.api_core.exceptions import PreconditionFailed
+from lightspeed_google_feed.storage import Storage, UPLOAD_CHUNK_SIZE, BACKGROUND_UPLOAD_BUFFER_SIZE, brotli
+
+class FakeGCSClient:
+    ''' In-memory stand-in for a Google Cloud Storage client (only what Storage uses), with slow uploads '''
+
+    def __init__(self, upload_latency=0.0, fail_uploads=False):
+        self.buckets = {}
+        self.upload_latency = upload_latency
+        self.fail_uploads = fail_uploads
+        self.lock = threading.Lock()
+        self.uploads_in_flight = 0
+        self.max_uploads_in_flight = 0
+        # names of the uploads finalized, and of those cancelled after they were started
+        self.finalized_uploads = []
+        self.cancelled_uploads = []
+
+    def bucket(self, name):
+        return self.buckets.setdefault(name, FakeGCSBucket(self))
+
+class FakeGCSBucket:
+
+    def __init__(self, client):
+        self.client = client
+        self.objects = {}
+        # name -> time the object was last written
+        self.updated = {}
+        self.generation = 0
+
+    def blob(self, name):
+        return FakeGCSBlob(self, name)
+
+    def get_blob(self, name):
+        if name not in self.objects:
+            return None
+        blob = FakeGCSBlob(self, name)
+        blob.generation = self.objects[name][1]
+        blob.updated = self.updated[name]
+        return blob
+
+    def list_blobs(self, prefix='', delimiter=None):
+        names = [name for name in self.objects if name.startswith(prefix) and not (delimiter and delimiter in name[len(prefix):])]
+        return [self.get_blob(name) for name in sorted(names)]
+
+    def rename_blob(self, blob, new_name):
+        self.objects[new_name] = self.objects.pop(blob.name)
+        self.updated[new_name] = self.updated.pop(blob.name)
+        return FakeGCSBlob(self, new_name)
+
+    def store(self, name, content):
+        self.generation += 1
+        self.objects[name] = (content, self.generation)
+        self.updated[name] = datetime.now(timezone.utc)
+
+class FakeGCSBlob:
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.generation = None
+        self.updated = datetime.now(timezone.utc)
+
+    def open(self, mode, chunk_size=None, content_type=None, ignore_flush=False):
+        if mode == 'rb':
+            return io.BytesIO(self.download_as_bytes())
+        return FakeGCSUpload(self, chunk_size)
+
+    def upload_from_string(self, content, content_type=None, if_generation_match=None):
+        self.check_generation(if_generation_match)
+        self.bucket.store(self.name, content.encode('utf-8'))
+
+    def download_as_bytes(self):
+        if self.name not in self.bucket.objects:
+            raise NotFound(self.name)
+        return self.bucket.objects[self.name][0]
+
+    download_as_string = download_as_bytes
+
+    def delete(self, if_generation_match=None):
+        self.check_generation(if_generation_match)
+        self.bucket.objects.pop(self.name, None)
+
+    def check_generation(self, if_generation_match):
+        # precondition on the current generation of the object (0 if it doesn't exist)
+        if if_generation_match is not None and self.bucket.objects.get(self.name, (None, 0))[1] != if_generation_match:
+            raise PreconditionFailed(self.name)
+
+class FakeGCSUpload:
+    ''' Resumable upload like BlobWriter's: started with the first full chunk, finalized when closed '''
+
+    def __init__(self, blob, chunk_size=None):
+        self.blob = blob
+        self.chunk_size = chunk_size or UPLOAD_CHUNK_SIZE
+        self.data = bytearray()
+        self._upload_and_transport = None
+
+    def write(self, data):
+        client = self.blob.bucket.client
+        if client.fail_uploads:
+            raise ConnectionError("Upload failed")
+        with client.lock:
+            client.uploads_in_flight += 1
+            client.max_uploads_in_flight = max(client.max_uploads_in_flight, client.uploads_in_flight)
+        time.sleep(client.upload_latency)
+        self.data += data
+        if self._upload_and_transport is None and len(self.data) >= self.chunk_size:
+            self._upload_and_transport = (Mock(resumable_url=self.blob.name), FakeGCSTransport(client))
+        with client.lock:
+            client.uploads_in_flight -= 1
+        return len(data)
+
+    def close(self):
+        self.blob.bucket.store(self.blob.name, bytes(self.data))
+        self.blob.bucket.client.finalized_uploads.append(self.blob.name)
+
+class FakeGCSTransport:
+
+    def __init__(self, client):
+        self.client = client
+
+    def delete(self, url):
+        # deleting a resumable upload session cancels the upload
+        self.client.cancelled_uploads.append(url)
 
 class TestStorage(unittest.TestCase):
 
@@ -117,5 +247,260 @@ class TestStorage(unittest.TestCase):
         
         self.assertEqual(content, "<error>Feed file not found. Please generate a feed first.</error>")
 
+    def test_save_stream_local_file(self):
+        '''Test saving a file from a stream of chunks'''
+        filename = "test.xml"
+        storage = Storage(cloud=False)
+        storage.save_stream(filename, (f"<item>{i}</item>" for i in range(1000)))
+
+        content_read = storage.read_file(filename)
+        self.assertEqual(content_read, "".join(f"<item>{i}</item>" for i in range(1000)))
+        self.assertFalse(os.path.exists(f"{filename}.tmp"))
+
+    def test_writer_records_item_ranges(self):
+        '''Test that items written with write_item are indexed by their byte range'''
+        filename = "test.xml"
+        storage = Storage(cloud=False)
+        with storage.open_writer(filename) as writer:
+            writer.write("<rss>")
+            writer.write_item("1_1", "<item>Glöve</item>")
+            writer.write_item("1_2", "<item>Bike</item>")
+            writer.write("</rss>")
+
+        with open(filename, 'rb') as f:
+            content = f.read()
+        self.assertEqual([content[start:end].decode('utf-8') for start, end in writer.items.values()], ["<item>Glöve</item>", "<item>Bike</item>"])
+        self.assertEqual(list(writer.items), ["1_1", "1_2"])
+
+    def test_open_reader(self):
+        '''Test reading byte ranges of a file without reading all of it'''
+        for storage in [Storage(cloud=True, client=FakeGCSClient()), Storage(cloud=False)]:
+            storage.save_stream("test.xml", ["<rss>", "<item>Glöve</item>", "</rss>"])
+            with storage.open_reader("test.xml") as f:
+                self.assertEqual(f.seek(0, io.SEEK_END), len("<rss><item>Glöve</item></rss>".encode('utf-8')))
+                f.seek(5)
+                self.assertEqual(f.read(19).decode('utf-8'), "<item>Glöve</item>")
+
+    def test_save_stream_local_file_error_keeps_previous_file(self):
+        '''Test that an interrupted stream doesn't replace the previous file'''
+        filename = "test.xml"
+        storage = Storage(cloud=False)
+        storage.save_file(filename, "previous content")
+
+        def broken_chunks():
+            yield "<item>1</item>"
+            raise RuntimeError("Rendering failed")
+
+        with self.assertRaises(RuntimeError):
+            storage.save_stream(filename, broken_chunks())
+
+        self.assertEqual(storage.read_file(filename), "previous content")
+        self.assertFalse(os.path.exists(f"{filename}.tmp"))
+
+    def test_discarded_write_keeps_previous_file(self):
+        '''Test that a discarded write leaves the file and its variants as they were'''
+        filename = "test.xml"
+        storage = Storage(cloud=False)
+        storage.save_stream(filename, ["previous content"], encodings=['gzip'])
+        with storage.open_writer(filename, encodings=['gzip']) as writer:
+            writer.write("<rss></rss>")
+            writer.discard()
+
+        self.assertEqual(storage.read_file(filename), "previous content")
+        with open(f"{filename}.gz", 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), b"previous content")
+        os.remove(f"{filename}.gz")
+        self.assertFalse(os.path.exists(f"{filename}.tmp"))
+        self.assertFalse(os.path.exists(f"{filename}.gz.tmp"))
+
+    @patch('lightspeed_google_feed.storage.UPLOAD_CHUNK_SIZE', 256 * 1024)
+    def test_discarded_write_cloud(self):
+        '''Test that a discarded write isn't uploaded: its upload is cancelled, not finalized'''
+        client = FakeGCSClient()
+        storage = Storage(cloud=True, client=client)
+        storage.save_file("test.xml", "previous content")
+
+        for size in [10, 300 * 1024]:
+            with storage.open_writer("test.xml", encodings=['gzip']) as writer:
+                writer.write("x" * size)
+                writer.discard()
+
+        self.assertEqual(client.finalized_uploads, [])
+        # only the large upload was started (the compressed one stayed under a chunk)
+        self.assertEqual(client.cancelled_uploads, ["test.xml.tmp"])
+        self.assertEqual(sorted(storage.get_bucket().objects), ["test.xml"])
+        self.assertEqual(storage.read_bytes("test.xml"), b"previous content")
+
+    @patch('lightspeed_google_feed.storage.storage')
+    def test_save_stream_cloud(self, mock_storage):
+        '''Test streaming a file to cloud storage with a resumable upload'''
+        filename = "test.xml"
+        mock_bucket = mock_storage.Client.return_value.bucket.return_value
+        mock_temp_blob = mock_bucket.blob.return_value
+        mock_upload = mock_temp_blob.open.return_value
+
+        storage = Storage(cloud=True)
+        storage.save_stream(filename, ["<rss>", "<item>ção</item>", "</rss>"])
+
+        mock_bucket.blob.assert_called_once_with(f"{filename}.tmp")
+        mock_temp_blob.open.assert_called_once_with('wb', chunk_size=UPLOAD_CHUNK_SIZE, content_type='application/xml', ignore_flush=True)
+        self.assertEqual(b"".join(c.args[0] for c in mock_upload.write.call_args_list), "<rss><item>ção</item></rss>".encode('utf-8'))
+        mock_upload.close.assert_called_once()
+        mock_bucket.rename_blob.assert_called_once_with(mock_temp_blob, filename)
+
+    def test_save_stream_cloud_error(self):
+        '''Test that an interrupted stream isn't uploaded to cloud storage'''
+        def broken_chunks():
+            yield "<item>1</item>"
+            raise RuntimeError("Rendering failed")
+
+        for background_uploads in [True, False]:
+            client = FakeGCSClient()
+            storage = Storage(cloud=True, client=client)
+            storage.background_uploads = background_uploads
+            with self.assertRaises(RuntimeError):
+                storage.save_stream("test.xml", broken_chunks(), encodings=['gzip'])
+
+            self.assertEqual(client.finalized_uploads, [])
+            self.assertEqual(storage.get_bucket().objects, {})
+
+    def test_save_stream_compressed_variants(self):
+        '''Test writing a gzip variant of a file while streaming it'''
+        filename = "test.xml"
+        chunks = [f"<item>ção {i}</item>" for i in range(1000)]
+        storage = Storage(cloud=False)
+        with storage.open_writer(filename, encodings=['gzip']) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+
+        with open(f"{filename}.gz", 'rb') as f:
+            compressed = f.read()
+        os.remove(f"{filename}.gz")
+        self.assertEqual(gzip.decompress(compressed), "".join(chunks).encode('utf-8'))
+        self.assertLess(len(compressed), writer.size / 5)
+
+    @unittest.skipIf(brotli is None, "brotli is not installed")
+    def test_save_stream_brotli_variant(self):
+        '''Test writing a brotli variant of a file while streaming it'''
+        filename = "test.xml"
+        storage = Storage(cloud=False)
+        with storage.open_writer(filename, encodings=['br']) as writer:
+            writer.write("<rss></rss>")
+
+        with open(f"{filename}.br", 'rb') as f:
+            self.assertEqual(brotli.decompress(f.read()), b"<rss></rss>")
+        os.remove(f"{filename}.br")
+
+    @patch('lightspeed_google_feed.storage.storage')
+    def test_save_stream_cloud_compressed_variants(self, mock_storage):
+        '''Test uploading a gzip variant of a file to cloud storage'''
+        mock_bucket = mock_storage.Client.return_value.bucket.return_value
+
+        storage = Storage(cloud=True)
+        with storage.open_writer("test.xml", encodings=['gzip']) as writer:
+            writer.write("<rss></rss>")
+
+        self.assertEqual([c.args[0] for c in mock_bucket.blob.call_args_list], ["test.xml.tmp", "test.xml.gz.tmp"])
+        self.assertEqual([c.kwargs['content_type'] for c in mock_bucket.blob.return_value.open.call_args_list], ['application/xml', 'application/gzip'])
+        self.assertEqual([c.args[1] for c in mock_bucket.rename_blob.call_args_list], ["test.xml.gz", "test.xml"])
+
+    @patch('lightspeed_google_feed.storage.storage')
+    def test_cloud_client_is_created_once(self, mock_storage):
+        '''Test that the client and bucket are created on first use and shared by all threads'''
+        mock_storage.Client.side_effect = lambda: time.sleep(0.05) or Mock()
+        storage = Storage(cloud=True)
+        mock_storage.Client.assert_not_called()
+
+        threads = [threading.Thread(target=storage.read_bytes, args=("test.xml",)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        storage.save_file("test.xml", "test content")
+        storage.get_version("test.xml")
+
+        mock_storage.Client.assert_called_once()
+        storage.storage_client.bucket.assert_called_once()
+
+class TestStorageWithFakeGCS(unittest.TestCase):
+
+    def test_files_written_together_upload_concurrently(self):
+        '''Test that files (and their compressed variants) written at the same time, like the feeds of a refresh, are uploaded concurrently'''
+        client = FakeGCSClient(upload_latency=0.2)
+        storage = Storage(cloud=True, client=client)
+        # (hardly compressible) content large enough to be handed over to the uploads while it's written
+        content = os.urandom(BACKGROUND_UPLOAD_BUFFER_SIZE).hex()
+        with ExitStack() as stack:
+            writers = [stack.enter_context(storage.open_writer(f"feed_{i}.xml", encodings=['gzip'])) for i in [1, 2]]
+            for writer in writers:
+                writer.write(content)
+
+        bucket = storage.get_bucket()
+        self.assertEqual(sorted(bucket.objects), ["feed_1.xml", "feed_1.xml.gz", "feed_2.xml", "feed_2.xml.gz"])
+        self.assertEqual(storage.read_bytes("feed_1.xml"), content.encode('utf-8'))
+        self.assertEqual(gzip.decompress(storage.read_bytes("feed_2.xml.gz")), content.encode('utf-8'))
+        self.assertEqual(client.max_uploads_in_flight, 4)
+
+    def test_streamed_variants_upload_in_background(self):
+        '''Test that a file and its variants are uploaded concurrently while being written'''
+        client = FakeGCSClient(upload_latency=0.05)
+        storage = Storage(cloud=True, client=client)
+        with storage.open_writer("feed.xml", encodings=['gzip']) as writer:
+            writer.write("<rss></rss>")
+
+        self.assertEqual(client.max_uploads_in_flight, 2)
+        self.assertEqual(storage.read_versioned("feed.xml")[0], b"<rss></rss>")
+        self.assertEqual(storage.get_version("feed.xml"), storage.get_bucket().objects["feed.xml"][1])
+
+    def test_failed_background_upload(self):
+        '''Test that a failed background upload fails the write and isn't published'''
+        client = FakeGCSClient(fail_uploads=True)
+        storage = Storage(cloud=True, client=client)
+        storage.save_file("feed.xml", "previous content")
+
+        with self.assertRaises(ConnectionError):
+            storage.save_stream("feed.xml", ["<rss></rss>"])
+
+        self.assertEqual(storage.read_file("feed.xml"), b"previous content")
+        self.assertEqual(sorted(storage.get_bucket().objects), ["feed.xml"])
+
+    def test_replace_file_version(self):
+        '''Test that a file is only replaced if it's still the given version'''
+        for storage in [Storage(cloud=True, client=FakeGCSClient()), Storage(cloud=False)]:
+            self.addCleanup(storage.delete_file, "lease.json")
+            storage.create_file("lease.json", '{"job": 1}')
+            version = storage.get_version("lease.json")
+            self.assertTrue(storage.replace_file("lease.json", '{"job": 1, "renewed": 1}', version))
+            self.assertFalse(storage.replace_file("lease.json", '{"job": 2}', version))
+            self.assertEqual(storage.read_bytes("lease.json"), b'{"job": 1, "renewed": 1}')
+
+    def test_list_files(self):
+        '''Test listing the files of a directory, with their modification time'''
+        for storage in [Storage(cloud=True, client=FakeGCSClient()), Storage(cloud=False)]:
+            self.assertEqual(storage.list_files("test_jobs"), [])
+            for filename in ["test_jobs/1.json", "test_jobs/2.json", "test_jobs/old/3.json"]:
+                storage.save_stream(filename, ["{}"])
+                self.addCleanup(storage.delete_file, filename)
+
+            files = sorted(storage.list_files("test_jobs"))
+            self.assertEqual([filename for filename, modified_at in files], ["test_jobs/1.json", "test_jobs/2.json"])
+            self.assertTrue(all((datetime.now(timezone.utc) - modified_at).total_seconds() < 60 for filename, modified_at in files))
+
+    def test_create_file_and_delete_version(self):
+        '''Test that a file is only created if it doesn't exist, and only deleted if it's still the given version'''
+        for storage in [Storage(cloud=True, client=FakeGCSClient()), Storage(cloud=False)]:
+            self.assertTrue(storage.create_file("lease.json", '{"job": 1}'))
+            self.assertFalse(storage.create_file("lease.json", '{"job": 2}'))
+            self.assertEqual(storage.read_bytes("lease.json"), b'{"job": 1}')
+
+            version = storage.get_version("lease.json")
+            storage.delete_file("lease.json")
+            self.assertTrue(storage.create_file("lease.json", '{"job": 3}'))
+            if storage.cloud:
+                self.assertFalse(storage.delete_file("lease.json", version=version))
+                self.assertEqual(storage.read_bytes("lease.json"), b'{"job": 3}')
+            self.assertTrue(storage.delete_file("lease.json", version=storage.get_version("lease.json")))
+            self.assertIsNone(storage.read_bytes("lease.json"))
+
     if __name__ == '__main__':
         unittest.main()
\ No newline at end of file
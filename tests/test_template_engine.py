@@ -1,5 +1,12 @@
+import io
+import os
+import re
 import unittest
+import types
+import tempfile
+from unittest.mock import patch
 from lightspeed_google_feed.template_engine import TemplateEngine
+from lightspeed_google_feed.gmc_feed import GMCFeedTemplateData
 
 class TestTemplateEngine(unittest.TestCase):
     def setUp(self):
@@ -87,3 +94,103 @@ class TestTemplateEngine(unittest.TestCase):
 
         # Test integer conversion
         self.assertEqual(self.engine._jinja_money_float("010"), "10.00")
+
+        # Test exact decimal values (no float rounding)
+        self.assertEqual(self.engine._jinja_money_float("19999999999999999.99"), "19999999999999999.99")
+        self.assertEqual(self.engine._jinja_money_float(12.345), "12.345")
+
+
+    @patch.object(TemplateEngine, '_get_formatted_date', return_value='2025-01-01 00:00:00 PST')
+    def test_render_stream(self, mock_date):
+        """Test that streaming renders the same output as render, in chunks"""
+        products = [{
+            'id': '1_2', 'stock_level': 3, 'price': {'price_incl': 10, 'price_old_incl': 0},
+            'available': True, 'pickup_SLA': 'same_day', 'ean': '123', 'code': 'ABC', 'weight': 25,
+            'gmc': {'price': '10.00 USD', 'sale_price': None, 'gtin': '<![CDATA[ 123 ]]>', 'mpn': '<![CDATA[ ABC ]]>'}
+        }]
+        chunks = self.engine.render_stream('TEMPLATE_gmc_local_listings.xml', products)
+
+        self.assertIsInstance(chunks, types.GeneratorType)
+        output = "".join(chunks)
+        self.assertEqual(output, self.engine.render('TEMPLATE_gmc_local_listings.xml', products))
+        self.assertIn('<g:id>1_2</g:id>', output)
+
+
+    @patch.object(TemplateEngine, '_get_formatted_date', return_value='2025-01-01 00:00:00 PST')
+    def test_render_feeds_single_pass(self, mock_date):
+        """Test that rendering several feeds in one pass gives the same feeds as rendering them one by one"""
+        products = [{
+            'id': f'1_{i}', 'item_group_id': '1', 'stock_level': i, 'fulltitle': f'Product {i}', 'description': 'Description',
+            'url': '/product', 'images': ['https://cdn.com/1/file.jpg', 'https://cdn.com/2/file.jpg'],
+            'categories': [{'title': 'Men', 'subs': [{'title': 'Gloves', 'subs': []}]}], 'brand': {'title': 'Fox'},
+            'price': {'price_incl': 10, 'price_old_incl': 12.5 if i % 2 else 0}, 'available': i > 0,
+            'pickup_SLA': 'same_day', 'ean': '123', 'code': 'ABC', 'weight': 25,
+            'age_group': 'adult', 'color': 'red', 'gender': 'male', 'size': 'M'
+        } for i in range(5)]
+        template_data = GMCFeedTemplateData(api_type="LS")
+        for product in products:
+            template_data.normalize_item(product)
+        templates = ['TEMPLATE_gmc_shopping_online_inventory.xml', 'TEMPLATE_gmc_local_listings.xml']
+        writers = [io.StringIO() for template in templates]
+
+        # a one-shot iterator proves the products are only walked once
+        self.engine.render_feeds(list(zip(templates, writers)), iter(products))
+
+        for template, writer in zip(templates, writers):
+            expected = self.engine.render(template, products)
+            self.assertEqual(re.sub(r'\s+', '', writer.getvalue()), re.sub(r'\s+', '', expected))
+            self.assertEqual(writer.getvalue().count('<item>'), 5)
+
+class TestTemplateEngineCaching(unittest.TestCase):
+    def setUp(self):
+        self.templates_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.template_path = os.path.join(self.templates_dir.name, 'TEMPLATE_test.xml')
+        with open(self.template_path, 'w') as f:
+            f.write("<rss>{% for product in products %}<item>{{ product.id }}</item>{% endfor %}</rss>")
+        self.engine = TemplateEngine(templates_dir=self.templates_dir.name, cache_dir=self.cache_dir.name)
+
+    def tearDown(self):
+        self.templates_dir.cleanup()
+        self.cache_dir.cleanup()
+
+    def test_compiled_template_is_reused(self):
+        """Test that the template is compiled once and reused between renders"""
+        self.assertEqual(self.engine.render('TEMPLATE_test.xml', [{'id': 1}]), "<rss><item>1</item></rss>")
+        template = self.engine.env.get_template('TEMPLATE_test.xml')
+        self.assertEqual(self.engine.render('TEMPLATE_test.xml', [{'id': 2}]), "<rss><item>2</item></rss>")
+        self.assertIs(self.engine.env.get_template('TEMPLATE_test.xml'), template)
+
+    def test_edited_template_is_reloaded(self):
+        """Test that templates are recompiled when the file changes"""
+        self.engine.render('TEMPLATE_test.xml', [{'id': 1}])
+        with open(self.template_path, 'w') as f:
+            f.write("<feed>{% for product in products %}<entry>{{ product.id }}</entry>{% endfor %}</feed>")
+        mtime = os.path.getmtime(self.template_path) + 10
+        os.utime(self.template_path, (mtime, mtime))
+
+        self.assertEqual(self.engine.render('TEMPLATE_test.xml', [{'id': 1}]), "<feed><entry>1</entry></feed>")
+
+    def test_precompile_writes_bytecode_cache(self):
+        """Test that precompiling fills the on-disk bytecode cache, which a new engine picks up"""
+        self.assertEqual(self.engine.precompile(), ['TEMPLATE_test.xml'])
+        self.assertEqual(len(os.listdir(self.cache_dir.name)), 1)
+
+        new_engine = TemplateEngine(templates_dir=self.templates_dir.name, cache_dir=self.cache_dir.name)
+        with patch.object(new_engine.env, 'compile', wraps=new_engine.env.compile) as mock_compile:
+            self.assertEqual(new_engine.render('TEMPLATE_test.xml', [{'id': 1}]), "<rss><item>1</item></rss>")
+            mock_compile.assert_not_called()
+
+    def test_render_feeds_template_without_blocks(self):
+        """Test that templates without header/item/footer blocks are still rendered"""
+        writer = io.StringIO()
+        self.engine.render_feeds([('TEMPLATE_test.xml', writer)], [{'id': 1}, {'id': 2}])
+        self.assertEqual(writer.getvalue(), "<rss><item>1</item><item>2</item></rss>")
+
+    def test_unusable_cache_dir(self):
+        """Test that templates still render if the bytecode cache directory can't be created"""
+        with open(os.path.join(self.cache_dir.name, 'file'), 'w') as f:
+            f.write("not a directory")
+        engine = TemplateEngine(templates_dir=self.templates_dir.name, cache_dir=os.path.join(self.cache_dir.name, 'file'))
+        self.assertIsNone(engine.env.bytecode_cache)
+        self.assertEqual(engine.render('TEMPLATE_test.xml', [{'id': 1}]), "<rss><item>1</item></rss>")
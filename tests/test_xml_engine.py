@@ -0,0 +1,112 @@
+import io
+import os
+import time
+import unittest
+import xml.etree.ElementTree as ET
+from unittest.mock import patch
+from lightspeed_google_feed.gmc_feed import GMCFeedTemplateData
+from lightspeed_google_feed.template_engine import TemplateEngine
+from lightspeed_google_feed.xml_engine import XMLFeedEngine, escape
+
+FEED_TEMPLATES = ['TEMPLATE_gmc_shopping_online_inventory.xml', 'TEMPLATE_gmc_local_listings.xml']
+
+def load_catalog_products():
+    products = []
+    for filename in ['catalog_65626325_fox-ranger-glove.json', 'catalog_65725829_yeti-cycles-160E-C2.json']:
+        with open(os.path.join('tests/mock_api_responses', filename)) as f:
+            products += eval(f.read().replace('true', 'True').replace('false', 'False').replace('null', 'None'))['products']
+    return products
+
+def render_feeds(engine, template_products):
+    writers = [io.StringIO() for template in FEED_TEMPLATES]
+    engine.render_feeds(list(zip(FEED_TEMPLATES, writers)), template_products)
+    return [writer.getvalue() for writer in writers]
+
+def elements(feed):
+    ''' (tag, attributes, stripped text) of every element of a feed, in document order '''
+    return [(element.tag, element.attrib, (element.text or "").strip()) for element in ET.fromstring(feed.encode('utf-8')).iter()]
+
+@patch.object(TemplateEngine, '_get_formatted_date', return_value='2025-01-01 00:00:00 PST')
+class TestXMLFeedEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.template_products = GMCFeedTemplateData(api_type="LS").prepare_template_data(load_catalog_products())
+        self.engine = XMLFeedEngine()
+
+    def test_same_elements_as_templates(self, mock_date):
+        """Test that the XML engine writes the same feeds as the Jinja templates, element for element"""
+        expected_feeds = render_feeds(TemplateEngine(), self.template_products)
+        feeds = render_feeds(self.engine, iter(self.template_products))
+
+        for feed, expected_feed in zip(feeds, expected_feeds):
+            self.assertGreater(feed.count('<item>'), 1)
+            self.assertEqual(elements(feed), elements(expected_feed))
+            self.assertLess(len(feed), len(expected_feed))
+            self.assertIn('<!-- generated on 2025-01-01 00:00:00 PST -->', feed)
+
+    def test_sale_price_and_missing_values(self, mock_date):
+        """Test optional elements against the templates"""
+        product = dict(self.template_products[0], brand=None, color=None, size='', images=[], ean=None)
+        product['price'] = {'price_incl': 10, 'price_old_incl': '12.5'}
+        GMCFeedTemplateData(api_type="LS").normalize_item(product)
+
+        feeds = render_feeds(self.engine, [product])
+        self.assertIn('<g:price>12.50 ', feeds[0])
+        self.assertIn('<g:sale_price>10.00 ', feeds[1])
+        self.assertNotIn('<g:brand>', feeds[0])
+        self.assertNotIn('<g:image_link>', feeds[0])
+        # without a value, the element is empty (the templates write "None")
+        self.assertIn('<g:gtin></g:gtin>', feeds[0])
+
+        expected_feeds = render_feeds(TemplateEngine(), [product])
+        for feed, expected_feed in zip(feeds, expected_feeds):
+            expected_elements = [element if element[0] != '{http://base.google.com/ns/1.0}gtin' else (element[0], {}, '') for element in elements(expected_feed)]
+            self.assertEqual(elements(feed), expected_elements)
+
+    def test_escaping(self, mock_date):
+        """Test that text is escaped instead of wrapped in CDATA sections, which can't contain "]]>" """
+        product = dict(self.template_products[0], fulltitle='Glove <XL> & "more" ]]> \x0b', description='<p>5 < 6</p>')
+        GMCFeedTemplateData(api_type="LS").normalize_item(product)
+
+        feed = render_feeds(self.engine, [product])[0]
+        item = ET.fromstring(feed.encode('utf-8')).find('channel/item')
+        self.assertEqual(item.find('title').text, 'Glove <XL> & "more" ]]> ')
+        self.assertEqual(item.find('description').text, '<p>5 < 6</p>')
+        self.assertEqual(escape(None), "")
+
+    def test_progress(self, mock_date):
+        """Test that items written are reported like with the templates"""
+        progress = []
+        self.engine.render_feeds([(FEED_TEMPLATES[1], io.StringIO())], self.template_products, progress=lambda **counters: progress.append(counters))
+        self.assertEqual(progress, [{'items_rendered': len(self.template_products)}])
+
+    def test_render_parts(self, mock_date):
+        """Test that the header, items and footer rendered separately make the same feed"""
+        feeds = render_feeds(self.engine, self.template_products)
+        for template_filename, feed in zip(FEED_TEMPLATES, feeds):
+            header, items, footer = self.engine.render_parts(template_filename, self.template_products)
+            self.assertEqual(header + "".join(items) + footer, feed)
+
+    def test_templates_without_writer_are_rendered(self, mock_date):
+        """Test that feeds the engine has no writer for are rendered from their templates"""
+        with patch.object(self.engine, 'item_writers', {FEED_TEMPLATES[0]: self.engine.item_writers[FEED_TEMPLATES[0]]}):
+            feeds = render_feeds(self.engine, iter(self.template_products))
+
+        self.assertEqual(elements(feeds[1]), elements(TemplateEngine().render(FEED_TEMPLATES[1], self.template_products)))
+        self.assertIn('\n            <item>', feeds[1])
+        self.assertEqual(feeds[0].count('<item>'), len(self.template_products))
+
+    @unittest.skipUnless(os.environ.get('RUN_BENCHMARKS'), "set RUN_BENCHMARKS=1 to run benchmarks (make benchmark)")
+    def test_benchmark(self, mock_date):
+        """Benchmark of both engines rendering both feeds for a large catalog"""
+        template_products = self.template_products * (20000 // len(self.template_products))
+        timings = {}
+        for name, engine in [('jinja', TemplateEngine()), ('xml', self.engine)]:
+            start = time.perf_counter()
+            render_feeds(engine, template_products)
+            timings[name] = time.perf_counter() - start
+        print(f"\nRendering {len(template_products)} items: jinja {timings['jinja']:.2f}s, xml {timings['xml']:.2f}s ({timings['jinja'] / timings['xml']:.1f}x faster)")
+        self.assertLess(timings['xml'], timings['jinja'])
+
+if __name__ == '__main__':
+    unittest.main()